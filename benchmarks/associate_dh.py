@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+# txopenid
+# Copyright (c) 2007 Phil Christensen
+#
+# See LICENSE for details
+
+"""
+Associate requests per second for each session type.
+
+Diffie-Hellman sessions are measured with keypairs computed on demand,
+and with keypairs taken from a DHKeyPool. The pool is refilled between
+requests, and the refill is timed too: when the provider is running it
+happens on the same thread, so it costs the same CPU. The pooled figure
+without the refill is only reached during a burst that the pool can
+absorb; it's shown separately as the per-request rate.
+
+Usage::
+    python benchmarks/associate_dh.py [count]
+"""
+
+import sys, time, base64
+
+from txopenid import util, protocol
+
+def request(session_type):
+	"""
+	Return the arguments for an associate request.
+	"""
+	requestData = {'openid.mode':'associate'}
+	if(session_type):
+		consumer = protocol.DiffieHellman()
+		requestData['openid.session_type'] = session_type
+		requestData['openid.dh_consumer_public'] = base64.b64encode(util.btwoc(consumer.public))
+	return requestData
+
+def rate(session_type, count, pool=None):
+	registry = protocol.OpenIDRegistry()
+	requestData = request(session_type)
+	protocol.DH_KEY_POOL = pool
+	elapsed = 0.0
+	in_request = 0.0
+	for i in range(count):
+		start = time.time()
+		if(pool is not None):
+			pool.fill()
+		filled = time.time()
+		protocol.associate(registry, requestData)
+		elapsed += time.time() - start
+		in_request += time.time() - filled
+	protocol.DH_KEY_POOL = None
+	return count / elapsed, count / in_request
+
+def main(count=1000):
+	print '%-22s %12s %14s' % ('session type', 'assoc/s', 'per-request/s')
+	for name, session_type, pool in (
+			('no-encryption', None, None),
+			('DH-SHA1', 'DH-SHA1', None),
+			('DH-SHA1 (pooled)', 'DH-SHA1', protocol.DHKeyPool(1))
+		):
+		print '%-22s %12.0f %14.0f' % ((name,) + rate(session_type, count, pool))
+
+if(__name__ == '__main__'):
+	main(*[int(x) for x in sys.argv[1:]])
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+# txopenid
+# Copyright (c) 2007 Phil Christensen
+#
+# See LICENSE for details
+
+"""
+Memory used per live association by the dict-backed record used before
+slots, a slotted association keeping its own prepared HMAC object, and
+the slotted association used now.
+
+Each size is the growth in resident memory while creating the
+associations, so it counts everything they own, including the hash
+contexts inside an HMAC object, which sys.getsizeof can't see. Every
+kind is measured in a forked child, so each starts from the same heap.
+Prepared HMAC objects are now kept in L{txopenid.protocol.HMAC_CACHE},
+whose size doesn't grow with the number of associations. Linux only.
+
+Usage::
+    python benchmarks/association_memory.py [count]
+"""
+
+import os, sys, time, base64, resource
+
+from txopenid import util, protocol
+
+class DictAssociation(object):
+	"""
+	The dict-backed association record used before slots.
+	"""
+	def __init__(self):
+		self.handle = base64.b64encode(util.handle())
+		self.assoc_type = 'HMAC-SHA1'
+		self.secret = util.secret(self.handle, self.assoc_type)
+		self.created = time.time()
+		self.expires_in = '86400'
+		self.mac_key = base64.b64encode(self.secret)
+
+class PreparedAssociation(protocol.OpenIDAssociation):
+	"""
+	A slotted association that keeps its own prepared HMAC object.
+	"""
+	__slots__ = ('mac',)
+	
+	def __init__(self):
+		protocol.OpenIDAssociation.__init__(self)
+		self.mac = util.prepare_hmac(self.secret, self.assoc_type)
+
+def rss():
+	"""
+	Return the resident memory of this process, in bytes.
+	"""
+	return int(open('/proc/self/statm').read().split()[1]) * resource.getpagesize()
+
+def measure(factory, count):
+	"""
+	Return the resident memory used per object created by factory.
+	"""
+	read, write = os.pipe()
+	pid = os.fork()
+	if(pid == 0):
+		os.close(read)
+		factory()
+		objects = []
+		start = rss()
+		for i in range(count):
+			objects.append(factory())
+		os.write(write, repr((rss() - start) / float(count)))
+		os._exit(0)
+	os.close(write)
+	result = float(os.read(read, 64))
+	os.close(read)
+	os.waitpid(pid, 0)
+	return result
+
+def main(count=100000):
+	print '%-40s %7s' % ('association', 'bytes')
+	for name, factory in (
+			('dict-backed', DictAssociation),
+			('slotted, with a prepared HMAC', PreparedAssociation),
+			('slotted', protocol.OpenIDAssociation),
+		):
+		print '%-40s %7.0f' % (name, measure(factory, count))
+
+if(__name__ == '__main__'):
+	main(*[int(x) for x in sys.argv[1:]])
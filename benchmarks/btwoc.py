@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+# txopenid
+# Copyright (c) 2007 Phil Christensen
+#
+# See LICENSE for details
+
+"""
+Conversions per second between longs and big-endian two's complement
+strings, before and after replacing the pickle-based codecs.
+
+Usage::
+    python benchmarks/btwoc.py [count]
+"""
+
+import sys, time, pickle, random
+
+from txopenid import util, protocol
+
+def pickle_btwoc(value):
+	"""
+	The pickle-based encoder used before.
+	"""
+	l = list(pickle.encode_long(value))
+	l.reverse()
+	return ''.join(l)
+
+def pickle_mklong(btwoc):
+	"""
+	The pickle-based decoder used before.
+	"""
+	l = list(btwoc)
+	l.reverse()
+	return pickle.decode_long(''.join(l))
+
+def rate(func, values, count):
+	start = time.time()
+	for i in range(count):
+		for value in values:
+			func(value)
+	return (count * len(values)) / (time.time() - start)
+
+def main(count=2000):
+	print '%-10s %-8s %12s %12s' % ('bits', 'op', 'pickle/s', 'native/s')
+	for bits in (160, 512, 1024):
+		values = [random.getrandbits(bits) for i in range(10)]
+		if(bits == 1024):
+			values[0] = protocol.DH_P_VALUE
+		encoded = [util.btwoc(value) for value in values]
+		print '%-10d %-8s %12.0f %12.0f' % (bits, 'btwoc', rate(pickle_btwoc, values, count), rate(util.btwoc, values, count))
+		print '%-10d %-8s %12.0f %12.0f' % (bits, 'mklong', rate(pickle_mklong, encoded, count), rate(util.mklong, encoded, count))
+
+if(__name__ == '__main__'):
+	main(*[int(x) for x in sys.argv[1:]])
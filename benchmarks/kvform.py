@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+# txopenid
+# Copyright (c) 2007 Phil Christensen
+#
+# See LICENSE for details
+
+"""
+Key-value form messages encoded per second, with the old util.kvstr and
+with the kvform codec, for the messages the provider builds most often.
+
+Usage::
+    python benchmarks/kvform.py [count]
+"""
+
+import sys, time, cStringIO
+
+from txopenid import kvform, protocol
+
+def kvstr(data=None, **kwargs):
+	"""
+	The encoder used before.
+	"""
+	if(data is None):
+		data = {}
+	data.update(kwargs)
+	
+	keys = data.keys()
+	keys.sort()
+	return ''.join(['%s:%s\n' % (x, data[x]) for x in keys])
+
+def rate(func, count):
+	start = time.time()
+	for i in range(count):
+		func()
+	return count / (time.time() - start)
+
+def main(count=200000):
+	association = dict(
+		assoc_type		= 'HMAC-SHA1',
+		assoc_handle	= 'x' * 88,
+		expires_in		= 86400,
+		mac_key			= 'y' * 28,
+	)
+	response = {
+		'openid.mode'			: 'id_res',
+		'openid.identity'		: 'http://www.example.com/test',
+		'openid.return_to'		: 'http://www.example.com/return',
+	}
+	identity = response['openid.identity']
+	return_to = response['openid.return_to']
+	buffer = cStringIO.StringIO()
+	
+	def write():
+		buffer.seek(0)
+		kvform.write(buffer, association)
+	
+	print '%-22s %-24s %12s' % ('message', 'encoder', 'per second')
+	for message, encoder, func in (
+			('associate', 'kvstr', lambda: kvstr(**association)),
+			('associate', 'kvform.encode', lambda: kvform.encode(association)),
+			('associate', 'kvform.write', write),
+			('check_authentication', 'kvstr', lambda: kvstr({'openid.mode':'id_res'}, is_valid='true')),
+			('check_authentication', 'kvform.encode', lambda: kvform.encode({'openid.mode':'id_res', 'is_valid':'true'})),
+			('signed token', 'kvstr', lambda: kvstr(mode='id_res', identity=identity, return_to=return_to)),
+			('signed token', 'kvform.encode_signed', lambda: kvform.encode_signed(response, protocol.SIGNED_FIELDS)),
+			('signed token', 'get_token_contents', lambda: protocol.get_token_contents(identity, return_to)),
+		):
+		print '%-22s %-24s %12.0f' % (message, encoder, rate(func, count))
+
+if(__name__ == '__main__'):
+	main(*[int(x) for x in sys.argv[1:]])
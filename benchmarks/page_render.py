@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+# txopenid
+# Copyright (c) 2007 Phil Christensen
+#
+# See LICENSE for details
+
+"""
+Renders per second for each user-facing page.
+
+Only the template rendering is measured; the user is already
+authenticated, and their identities and roots come from memory.
+
+Usage::
+    python benchmarks/page_render.py [count]
+"""
+
+import sys, time
+
+from twisted.internet.defer import succeed, Deferred
+
+from nevow import testutil, context, rend
+
+from txopenid import protocol, resource
+
+class BenchUser(dict):
+	def getIdentities(self):
+		return succeed([dict(id=i, url='http://www.example.com/id/%d' % i) for i in range(5)])
+	
+	def getTrustedRoots(self):
+		return succeed([dict(id=i, url='http://www.example.com/root/%d/' % i) for i in range(5)])
+
+OPENID_ARGS = {
+	'openid.mode'			: 'checkid_setup',
+	'openid.identity'		: 'http://www.example.com/id/new',
+	'openid.return_to'		: 'http://www.example.com/return',
+	'openid.trust_root'		: 'http://www.example.com/',
+}
+
+def pages():
+	"""
+	Return the pages to render, with the user and arguments for each.
+	"""
+	user = BenchUser(id=1, username='bench', first='Bench', last='User')
+	return [
+		('login', resource.LoginPage(None, None), None, OPENID_ARGS),
+		('info', resource.InfoPage(None, None), user, {}),
+		('identity', resource.IdentityPage(None, None), user, OPENID_ARGS),
+		('trust', resource.TrustPage(None, None), user, OPENID_ARGS),
+		('consumer', resource.ConsumerPage(None, None), None, {}),
+	]
+
+def render(page, user, args):
+	"""
+	Render the provided page, returning the output.
+	"""
+	request = testutil.FakeRequest(args=dict([(k, [v]) for k, v in args.items()]))
+	request.setComponent(resource.ICurrentUser, user)
+	ctx = context.RequestContext(tag=request)
+	result = rend.Page.renderHTTP(page, ctx)
+	if(isinstance(result, Deferred)):
+		output = []
+		result.addCallback(output.append)
+		result = output[0]
+	return ''.join(request.accumulator) + result
+
+def main(count=2000):
+	protocol.configure_urls('localhost', 8888)
+	
+	print '%-10s %10s %8s' % ('page', 'renders/s', 'bytes')
+	for name, page, user, args in pages():
+		size = len(render(page, user, args))
+		start = time.time()
+		for i in range(count):
+			render(page, user, args)
+		print '%-10s %10.0f %8d' % (name, count / (time.time() - start), size)
+
+if(__name__ == '__main__'):
+	main(*[int(x) for x in sys.argv[1:]])
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+# txopenid
+# Copyright (c) 2007 Phil Christensen
+#
+# See LICENSE for details
+
+"""
+Requests per second for each openid.mode, through the full ProviderPage
+path and through the direct-mode fast path.
+
+The database and the portal are replaced with trivial in-memory versions
+that answer immediately, so this measures the provider's own overhead;
+against a real database the full path also pays for its queries.
+
+Usage::
+    python benchmarks/provider_modes.py [count]
+"""
+
+import sys, time
+
+from twisted.internet.defer import succeed, Deferred
+
+from nevow import testutil, context, inevow
+
+from txopenid import util, protocol, session, resource
+
+class BenchPool(object):
+	def loadSession(self, sid):
+		return succeed(None)
+	
+	def saveSession(self, session, columns=None):
+		return succeed(None)
+
+class BenchRealm(object):
+	def __init__(self):
+		self.registry = protocol.OpenIDRegistry()
+
+class BenchPortal(object):
+	def __init__(self):
+		self.realm = BenchRealm()
+	
+	def login(self, creds, mind, *interfaces):
+		return succeed((inevow.IResource, None, lambda: None))
+
+def requests(registry):
+	"""
+	Return request arguments for each mode.
+	"""
+	association = registry.initiate({}, False)
+	token_contents = util.kvstr(mode='id_res',
+							identity='http://www.example.com/test',
+							return_to='http://www.example.com/return')
+	return [
+		('associate', {
+			'openid.mode'			: 'associate',
+		}),
+		('check_authentication', {
+			'openid.mode'			: 'check_authentication',
+			'openid.identity'		: 'http://www.example.com/test',
+			'openid.return_to'		: 'http://www.example.com/return',
+			'openid.assoc_handle'	: association.handle,
+			'openid.sig'			: util.get_hmac(association.secret, token_contents).encode('base64').strip(),
+			'openid.signed'			: 'identity,mode,return_to',
+		}),
+		('checkid_immediate', {
+			'openid.mode'			: 'checkid_immediate',
+			'openid.identity'		: 'http://www.example.com/test',
+			'openid.return_to'		: 'http://www.example.com/return',
+			'openid.trust_root'		: 'http://www.example.com/',
+		}),
+		('checkid_setup', {
+			'openid.mode'			: 'checkid_setup',
+			'openid.identity'		: 'http://www.example.com/test',
+			'openid.return_to'		: 'http://www.example.com/return',
+			'openid.trust_root'		: 'http://www.example.com/',
+		}),
+	]
+
+def rate(page, args, count):
+	"""
+	Return requests per second for the provided request arguments.
+	"""
+	args = dict([(k, [v]) for k, v in args.items()])
+	start = time.time()
+	for i in range(count):
+		request = testutil.FakeRequest(args=dict(args))
+		request.method = 'POST'
+		output = page.renderHTTP(context.RequestContext(tag=request))
+		if(isinstance(output, Deferred)):
+			output.addErrback(lambda f: sys.stderr.write(f.getTraceback()))
+	return count / (time.time() - start)
+
+def main(count=5000):
+	session.INFANT_SESSIONS = session.InfantSessionStore(maxsize=count)
+	protocol.configure_urls('localhost', 8888)
+	page = resource.ProviderPage(BenchPool(), BenchPortal())
+	
+	print '%-22s %12s %12s' % ('mode', 'full req/s', 'direct req/s')
+	for mode, args in requests(page.portal.realm.registry):
+		session.LAZY_SESSIONS = False
+		before = rate(page, args, count)
+		session.LAZY_SESSIONS = True
+		after = rate(page, args, count)
+		print '%-22s %12.0f %12.0f' % (mode, before, after)
+
+if(__name__ == '__main__'):
+	main(*[int(x) for x in sys.argv[1:]])
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+# txopenid
+# Copyright (c) 2007 Phil Christensen
+#
+# See LICENSE for details
+
+"""
+Login responses signed and signatures verified per second, for each
+association type, before and after keeping prepared HMAC objects in
+L{txopenid.protocol.HMAC_CACHE}.
+
+Usage::
+    python benchmarks/signing.py [count]
+"""
+
+import sys, time, cgi
+
+from txopenid import util, protocol
+
+class UnpreparedAssociation(protocol.OpenIDAssociation):
+	"""
+	An association that signs the way it was done before, deriving the
+	HMAC key state again for every message.
+	"""
+	__slots__ = ()
+	
+	def sign(self, message):
+		return util.get_hmac(self.secret, message, self.assoc_type)
+
+class BenchRegistry(protocol.OpenIDRegistry):
+	"""
+	A registry that creates associations of the provided class.
+	"""
+	def __init__(self, association_class, assoc_type):
+		protocol.OpenIDRegistry.__init__(self)
+		self.association = association_class(assoc_type)
+		self.smart.save(self.association)
+		self.dumb.save(self.association)
+	
+	def initiate(self, requestData, is_smart):
+		return self.association
+
+def rate(func, count):
+	start = time.time()
+	for i in range(count):
+		func()
+	return count / (time.time() - start)
+
+def main(count=50000):
+	print '%-12s %-22s %14s %14s' % ('type', 'operation', 'per-message/s', 'prepared/s')
+	for assoc_type in sorted(util.ASSOC_TYPES):
+		bench(assoc_type, count)
+
+def bench(assoc_type, count):
+	results = {}
+	for name, association_class in (('before', UnpreparedAssociation), ('after', protocol.OpenIDAssociation)):
+		registry = BenchRegistry(association_class, assoc_type)
+		request = {
+			'openid.mode'			: 'checkid_setup',
+			'openid.identity'		: 'http://www.example.com/test',
+			'openid.assoc_handle'	: registry.association.handle,
+			'openid.return_to'		: 'http://www.example.com/return',
+		}
+		response = protocol.get_login_response(registry, request)
+		query = dict([(key, value[0]) for key, value in cgi.parse_qs(response.split('?', 1)[1]).items()])
+		if not(registry.validate(query, True)):
+			raise AssertionError('signature did not verify')
+		
+		results[name] = (
+			rate(lambda: protocol.get_login_response(registry, request), count),
+			rate(lambda: registry.validate(query, True), count),
+			rate(lambda: registry.association.sign('mode:id_res\n'), count),
+		)
+	
+	for i, operation in enumerate(('get_login_response', 'validate', 'sign')):
+		print '%-12s %-22s %14.0f %14.0f' % (assoc_type, operation, results['before'][i], results['after'][i])
+
+if(__name__ == '__main__'):
+	main(*[int(x) for x in sys.argv[1:]])
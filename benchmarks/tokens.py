@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+# txopenid
+# Copyright (c) 2007 Phil Christensen
+#
+# See LICENSE for details
+
+"""
+Association handles and session ids generated per second, before and
+after drawing them from a buffered pool of OS entropy.
+
+Usage::
+    python benchmarks/tokens.py [count]
+"""
+
+import sys, time, os, md5, random
+
+from txopenid import util
+
+def randint_handle():
+	"""
+	The handle generator used before.
+	"""
+	result = ''
+	for i in range(64):
+		result += chr(random.randint(0,255))
+	return result
+
+def md5_session_id():
+	"""
+	The session id generator used before.
+	"""
+	t = long(time.time()*10000)
+	pid = os.getpid()
+	rnd1 = random.randint(0, 999999999)
+	rnd2 = random.randint(0, 999999999)
+	ip = '127.0.0.1'
+	
+	return md5.new("%d%d%d%d%s" % (t, pid, rnd1, rnd2, ip)).hexdigest()
+
+def urandom_handle():
+	"""
+	One os.urandom call per handle, without the pool.
+	"""
+	return os.urandom(64)
+
+def rate(func, count):
+	start = time.time()
+	for i in range(count):
+		func()
+	return count / (time.time() - start)
+
+def main(count=100000):
+	print '%-12s %-18s %12s' % ('token', 'generator', 'per second')
+	print '%-12s %-18s %12.0f' % ('handle', 'random.randint', rate(randint_handle, count))
+	print '%-12s %-18s %12.0f' % ('handle', 'os.urandom', rate(urandom_handle, count))
+	print '%-12s %-18s %12.0f' % ('handle', 'util.handle', rate(util.handle, count))
+	print '%-12s %-18s %12.0f' % ('session id', 'md5', rate(md5_session_id, count))
+	print '%-12s %-18s %12.0f' % ('session id', 'util.hextoken', rate(util.hextoken, count))
+
+if(__name__ == '__main__'):
+	main(*[int(x) for x in sys.argv[1:]])
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+# txopenid
+# Copyright (c) 2007 Phil Christensen
+#
+# See LICENSE for details
+
+"""
+Signature verifications per second in OpenIDRegistry.validate, before
+and after comparing raw digests against a preformatted token.
+
+Usage::
+    python benchmarks/verify.py [count]
+"""
+
+import sys, time, base64
+
+from txopenid import util, protocol
+
+def kvstr_validate(registry, requestData, is_smart):
+	"""
+	The verification used before: rebuild the token with kvstr, then
+	compare base64 strings with ==.
+	"""
+	association = registry.smart.get(requestData['openid.assoc_handle'])
+	if(association is None or time.time() > association.expires):
+		return False
+	
+	token_contents = util.kvstr(mode='id_res',
+							identity=requestData['openid.identity'],
+							return_to=requestData['openid.return_to'])
+	
+	valid_sig = base64.b64encode(association.sign(token_contents))
+	
+	return requestData['openid.sig'] == valid_sig
+
+def rate(func, registry, requestData, count):
+	start = time.time()
+	for i in range(count):
+		func(registry, requestData, True)
+	return count / (time.time() - start)
+
+def main(count=100000):
+	registry = protocol.OpenIDRegistry()
+	association = registry.initiate({}, True)
+	token_contents = protocol.get_token_contents('http://www.example.com/test', 'http://www.example.com/return')
+	valid_sig = association.sign(token_contents)
+	
+	print '%-10s %12s %12s' % ('signature', 'kvstr/s', 'validate/s')
+	for name, sig in (('valid', valid_sig), ('forged', '\0' * len(valid_sig))):
+		requestData = {
+			'openid.mode'			: 'check_authentication',
+			'openid.identity'		: 'http://www.example.com/test',
+			'openid.return_to'		: 'http://www.example.com/return',
+			'openid.assoc_handle'	: association.handle,
+			'openid.sig'			: base64.b64encode(sig),
+			'openid.signed'			: protocol.SIGNED_FIELDS,
+		}
+		print '%-10s %12.0f %12.0f' % (name,
+			rate(kvstr_validate, registry, requestData, count),
+			rate(protocol.OpenIDRegistry.validate, registry, requestData, count))
+
+if(__name__ == '__main__'):
+	main(*[int(x) for x in sys.argv[1:]])
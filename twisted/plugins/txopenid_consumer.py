@@ -12,9 +12,9 @@ from twisted.plugin import IPlugin
 from twisted.application import internet, service
 from twisted.cred import portal, checkers, credentials
 
-from nevow import appserver, guard, static
+from nevow import appserver, guard
 
-from txopenid import session, db, protocol, resource
+from txopenid import session, db, protocol, resource, webroot
 
 class Options(usage.Options):
 	optParameters = [
@@ -24,6 +24,9 @@ class Options(usage.Options):
 						["username", "u", 'txopenid', "Database username."],
 						["secret", "s", 'txopenid', "Database password."],
 						["server-port", "P", 8887, "Port to use for web server."],
+						["reap-interval", None, 60, "Seconds between expired session cleanups."],
+						["reap-chunk-size", None, 1000, "Most expired sessions to delete per statement."],
+						["reap-max-chunks", None, 10, "Most delete statements per expired session cleanup."],
 					]
 
 class txOpenIDConsumer(object):
@@ -41,13 +44,20 @@ class txOpenIDConsumer(object):
 		openIDPortal.registerChecker(session_checker)
 		
 		siteRoot = resource.ConsumerPage(pool, openIDPortal)
-		assetsRoot = static.File(resource.get_assets_path('webroot'))
+		assetsRoot = webroot.AssetsResource()
 		
 		siteRoot.putChild('assets', assetsRoot)
 		
 		webFactory = appserver.NevowSite(siteRoot)
 		webService = internet.TCPServer(int(config['server-port']), webFactory)
 		
-		return webService
+		consumerService = service.MultiService()
+		webService.setServiceParent(consumerService)
+		
+		reapService = session.SessionReaper(pool, float(config['reap-interval']),
+			int(config['reap-chunk-size']), int(config['reap-max-chunks']))
+		reapService.setServiceParent(consumerService)
+		
+		return consumerService
 
 serviceMaker = txOpenIDConsumer()
\ No newline at end of file
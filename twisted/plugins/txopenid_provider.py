@@ -12,11 +12,16 @@ from twisted.plugin import IPlugin
 from twisted.application import internet, service
 from twisted.cred import portal, checkers, credentials
 
-from nevow import appserver, guard, static
+from nevow import appserver, guard
 
-from txopenid import session, db, protocol, resource
+from txopenid import session, db, protocol, resource, store, util, cache, webroot
 
 class Options(usage.Options):
+	optFlags = [
+					["debug", "d", "Log protocol debugging messages."],
+					["eager-sessions", None, "Create sessions for associate and check_authentication requests too."],
+				]
+	
 	optParameters = [
 						["host", "h", 'localhost', "MySQL server hostname."],
 						["port", "p", 3306, "MySQL server port."],
@@ -25,9 +30,30 @@ class Options(usage.Options):
 						["secret", "s", 'txopenid', "Database password."],
 						["hostname", "H", None, "Hostname to use for txOpenID server URLs."],
 						["server-port", "P", 8888, "Port to use for txOpenID server."],
-					 	["access-log", "a", '-', "Path to access log."]
+					 	["access-log", "a", '-', "Path to access log."],
+						["association-store", None, None, "Path to a SQLite association store shared between provider processes on this host. Its queries block, so it only suits low-volume providers; see --master-key."],
+						["master-key", None, None, "Path to a master key file, enabling stateless association handles."],
+						["max-associations", None, None, "Maximum number of in-memory associations per bank."],
+						["sweep-interval", None, 60, "Seconds between expired association sweeps."],
+						["session-write-interval", None, 0.5, "Seconds between batched session access time writes, or 0 to write immediately."],
+						["session-touch-interval", None, 60, "Seconds a session's stored access time may lag before it is updated."],
+						["session-cache-size", None, 0, "Number of sessions to cache in this process, or 0 to disable the session cache. Only use this with a single provider process; otherwise, use --memcache."],
+						["session-cache-timeout", None, 60, "Seconds to cache a session."],
+						["memcache", None, None, "Comma-separated memcached servers, to share cached and new sessions between processes."],
+						["reap-interval", None, 60, "Seconds between expired session cleanups."],
+						["reap-chunk-size", None, 1000, "Most expired sessions to delete per statement."],
+						["reap-max-chunks", None, 10, "Most delete statements per expired session cleanup."],
+						["max-infant-sessions", None, 100000, "Most new sessions to hold in memory before they're used again."],
+						["dh-pool-size", None, 100, "Number of Diffie-Hellman keypairs to compute ahead of time, or 0 to compute them on demand."],
 					]
 
+	def postOptions(self):
+		if(self['memcache'] is not None):
+			try:
+				import memcache
+			except ImportError:
+				raise usage.UsageError("--memcache requires the python-memcached package.")
+
 class txOpenIDProvider(object):
 	implements(service.IServiceMaker, IPlugin)
 	tapname = "txopenid-provider"
@@ -35,6 +61,9 @@ class txOpenIDProvider(object):
 	options = Options
 	
 	def makeService(self, config):
+		if(config['debug']):
+			util.set_log_level(util.DEBUG)
+		
 		pool = db.Connection(
 			host	= config['host'],
 			port	= config['port'],
@@ -42,7 +71,25 @@ class txOpenIDProvider(object):
 			passwd	= config['secret'],
 			db		= config['name'],
 		)
-		registry = protocol.OpenIDRegistry()
+		if(config['master-key'] is not None):
+			master_key = store.MasterKey.fromFile(config['master-key'])
+			registry = protocol.OpenIDRegistry(
+				smart	= store.StatelessAssociationStore(master_key, 'smart'),
+				dumb	= store.StatelessAssociationStore(master_key, 'dumb'),
+			)
+		elif(config['association-store'] is not None):
+			registry = protocol.OpenIDRegistry(
+				smart	= store.SQLiteAssociationStore(config['association-store'], 'smart'),
+				dumb	= store.SQLiteAssociationStore(config['association-store'], 'dumb'),
+			)
+		else:
+			max_associations = config['max-associations']
+			if(max_associations is not None):
+				max_associations = int(max_associations)
+			registry = protocol.OpenIDRegistry(
+				smart	= store.MemoryAssociationStore(max_associations),
+				dumb	= store.MemoryAssociationStore(max_associations),
+			)
 		
 		session_checker = session.SessionChecker(pool)
 		session_realm = session.SessionRealm(pool, registry)
@@ -51,7 +98,7 @@ class txOpenIDProvider(object):
 		openIDPortal.registerChecker(session_checker)
 		
 		siteRoot = resource.ProviderPage(pool, openIDPortal)
-		assetsRoot = static.File(resource.get_assets_path('webroot'))
+		assetsRoot = webroot.AssetsResource()
 		userRoot = resource.UserStubPage()
 		
 		loginPage = resource.LoginPage(pool, openIDPortal)
@@ -80,7 +127,38 @@ class txOpenIDProvider(object):
 		else:
 			webFactory = appserver.NevowSite(siteRoot)
 		webService = internet.TCPServer(int(config['server-port']), webFactory)
+		sweepService = internet.TimerService(int(config['sweep-interval']), registry.sweep)
+		
+		providerService = service.MultiService()
+		webService.setServiceParent(providerService)
+		sweepService.setServiceParent(providerService)
+		
+		if(int(config['dh-pool-size'])):
+			protocol.DH_KEY_POOL = protocol.DHKeyPool(int(config['dh-pool-size']))
+			dhService = internet.TimerService(1, protocol.DH_KEY_POOL.fill)
+			dhService.setServiceParent(providerService)
+		
+		session.LAZY_SESSIONS = not config['eager-sessions']
+		session.TOUCH_INTERVAL = int(config['session-touch-interval'])
+		session.SESSION_CACHE_TIMEOUT = int(config['session-cache-timeout'])
+		if(config['memcache'] is not None):
+			import memcache
+			client = memcache.Client(config['memcache'].split(','))
+			session.SESSION_CACHE = cache.ThreadedCache(client)
+			session.INFANT_SESSIONS = session.SharedInfantSessionStore(session.SESSION_CACHE)
+		else:
+			session.INFANT_SESSIONS = session.InfantSessionStore(maxsize=int(config['max-infant-sessions']))
+			if(int(config['session-cache-size'])):
+				session.SESSION_CACHE = cache.LRUCache(int(config['session-cache-size']), session.SESSION_CACHE_TIMEOUT)
+		
+		reapService = session.SessionReaper(pool, float(config['reap-interval']),
+			int(config['reap-chunk-size']), int(config['reap-max-chunks']))
+		reapService.setServiceParent(providerService)
+		
+		if(float(config['session-write-interval'])):
+			session.SESSION_WRITER = session.SessionWriter(pool, float(config['session-write-interval']))
+			session.SESSION_WRITER.setServiceParent(providerService)
 		
-		return webService
+		return providerService
 
 serviceMaker = txOpenIDProvider()
\ No newline at end of file
@@ -0,0 +1,137 @@
+# txopenid
+# Copyright (c) 2007 Phil Christensen
+#
+# See LICENSE for details
+
+"""
+In-process caching.
+
+L{LRUCache} follows the get/set/delete conventions of a memcache client,
+so code that uses one can be handed a shared cache instead. The memcache
+client blocks, so it should be wrapped in a L{ThreadedCache}; callers
+that accept either use L{twisted.internet.defer.maybeDeferred}.
+"""
+
+import time
+
+from collections import OrderedDict
+
+from twisted.internet import threads
+
+# set() takes a memcache-style 'time' argument, which shadows the module
+_now = time.time
+
+class LRUCache(object):
+	"""
+	A size-bounded cache whose entries expire after a time limit.
+	
+	When full, the least recently used entry is discarded.
+	
+	@ivar maxsize: the most entries to keep
+	@type maxsize: int
+	
+	@ivar timeout: default lifetime of an entry, in seconds
+	@type timeout: int
+	
+	@ivar hits: count of successful lookups
+	@type hits: int
+	
+	@ivar misses: count of failed (or expired) lookups
+	@type misses: int
+	"""
+	def __init__(self, maxsize=10000, timeout=300):
+		"""
+		Create a new, empty cache.
+		
+		@param maxsize: the most entries to keep
+		@type maxsize: int
+		
+		@param timeout: default lifetime of an entry, in seconds
+		@type timeout: int
+		"""
+		self.maxsize = maxsize
+		self.timeout = timeout
+		self.entries = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+	
+	def get(self, key):
+		"""
+		Return the value cached for the provided key.
+		
+		@return: the cached value, or None
+		"""
+		entry = self.entries.pop(key, None)
+		if(entry is None or entry[0] < _now()):
+			self.misses += 1
+			return None
+		self.entries[key] = entry
+		self.hits += 1
+		return entry[1]
+	
+	def set(self, key, value, time=0):
+		"""
+		Cache the provided value.
+		
+		@param time: lifetime of this entry in seconds, or 0 for the default
+		@type time: int
+		"""
+		self.entries.pop(key, None)
+		self.entries[key] = (_now() + (time or self.timeout), value)
+		while(len(self.entries) > self.maxsize):
+			self.entries.popitem(last=False)
+		return True
+	
+	def delete(self, key):
+		"""
+		Remove the provided key from the cache, if present.
+		"""
+		self.entries.pop(key, None)
+		return True
+	
+	def stats(self):
+		"""
+		Return hit, miss and size counters.
+		
+		@rtype: dict(str => int)
+		"""
+		return dict(
+			hits	= self.hits,
+			misses	= self.misses,
+			size	= len(self.entries),
+		)
+	
+	def __len__(self):
+		return len(self.entries)
+
+class ThreadedCache(object):
+	"""
+	Make the calls to a blocking cache client in the reactor's thread pool.
+	
+	Each method returns a Deferred, so the reactor thread never waits on
+	the network. python-memcached clients keep a connection per thread,
+	so one client can be shared by every thread in the pool.
+	
+	@ivar client: the blocking cache client
+	@type client: C{memcache.Client}
+	"""
+	def __init__(self, client):
+		self.client = client
+	
+	def get(self, key):
+		"""
+		@return: a Deferred firing with the cached value, or None
+		"""
+		return threads.deferToThread(self.client.get, key)
+	
+	def set(self, key, value, time=0):
+		"""
+		@return: a Deferred firing when the value is stored
+		"""
+		return threads.deferToThread(self.client.set, key, value, time)
+	
+	def delete(self, key):
+		"""
+		@return: a Deferred firing when the key is removed
+		"""
+		return threads.deferToThread(self.client.delete, key)
@@ -18,6 +18,8 @@ from MySQLdb import cursors
 from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.enterprise import adbapi
 
+from txopenid import cache
+
 class Connection(object):
 	"""
 	A representation of a database connection.
@@ -26,12 +28,27 @@ class Connection(object):
 	L{twisted.enterprise.adbapi.ConnectionPool}. This class
 	just adds a bunch of convenience methods for the limited
 	amount of DB access needed by txOpenID.
+	
+	Each user's identities and trusted roots are cached for
+	the identity and trust checks made by every OpenID login.
+	
+	@ivar user_cache: cache of identity and trusted root URL sets, by user
+	@type user_cache: L{txopenid.cache.LRUCache}
+	
+	@ivar user_fills: queries in flight and generation of each URL set
+		being loaded into the cache, by cache key
+	@type user_fills: dict(str => list(int, int))
 	"""
 	
 	def __init__(self, **kwargs):
 		"""
 		Create a new connection to the DB.
+		
+		In addition to the connection parameters, C{cache_size} and
+		C{cache_timeout} configure the identity and trusted root cache.
 		"""
+		self.user_cache = cache.LRUCache(kwargs.get('cache_size', 10000), kwargs.get('cache_timeout', 300))
+		self.user_fills = {}
 		self.conn = adbapi.ConnectionPool('MySQLdb',
 										host=kwargs.get('host', 'localhost'),
 										db=kwargs.get('db', 'txopenid'),
@@ -57,11 +74,8 @@ class Connection(object):
 		
 		@return: True if there were no errors.
 		"""
-		identity_query = "SELECT 1 FROM identity WHERE user_id = %s and url = %s"
-		result = yield self.conn.runQuery(identity_query, [user['id'], identity])
-		if(result):
-			returnValue(True)
-		returnValue(False)
+		urls = yield self._getUserURLs('identity', user)
+		returnValue(identity in urls)
 	
 	@inlineCallbacks
 	def getUserIdentities(self, user):
@@ -109,6 +123,7 @@ class Connection(object):
 		"""
 		identity_operation = "INSERT INTO identity (user_id, url) VALUES (%s, %s)"
 		yield self.conn.runOperation(identity_operation, [user['id'], identity])
+		self._forgetUserURLs('identity', user)
 		returnValue(True)
 	
 	@inlineCallbacks
@@ -128,6 +143,7 @@ class Connection(object):
 			identity_ids = [identity_ids]
 		identity_operation = "DELETE FROM identity WHERE user_id = %%s AND id IN (%s)" % ','.join(['%s']*len(identity_ids))
 		yield self.conn.runOperation(identity_operation, [user['id']] + identity_ids)
+		self._forgetUserURLs('identity', user)
 		returnValue(True)
 	
 	@inlineCallbacks
@@ -143,11 +159,8 @@ class Connection(object):
 		
 		@return: True if there were no errors.
 		"""
-		trust_query = "SELECT 1 FROM trusted_root WHERE user_id = %s and url = %s"
-		result = yield self.conn.runQuery(trust_query, [user['id'], root])
-		if(result):
-			returnValue(True)
-		returnValue(False)
+		urls = yield self._getUserURLs('trusted_root', user)
+		returnValue(root in urls)
 	
 	@inlineCallbacks
 	def getUserTrustedRoots(self, user):
@@ -179,6 +192,7 @@ class Connection(object):
 		"""
 		root_operation = "INSERT INTO trusted_root (user_id, url) VALUES (%s, %s)"
 		yield self.conn.runOperation(root_operation, [user['id'], root])
+		self._forgetUserURLs('trusted_root', user)
 		returnValue(True)
 	
 	@inlineCallbacks
@@ -198,8 +212,57 @@ class Connection(object):
 			root_ids = [root_ids]
 		root_operation = "DELETE FROM trusted_root WHERE user_id = %%s AND id IN (%s)" % ','.join(['%s']*len(root_ids))
 		yield self.conn.runOperation(root_operation, [user['id']] + root_ids)
+		self._forgetUserURLs('trusted_root', user)
 		returnValue(True)
 	
+	@inlineCallbacks
+	def _getUserURLs(self, table, user):
+		"""
+		Return the set of URLs in the provided table for this user.
+		
+		@param table: 'identity' or 'trusted_root'
+		@type table: str
+		
+		@param user: the user in question
+		@type user: L{txopenid.user.User}
+		
+		@return: the user's URLs
+		@rtype: frozenset(str)
+		"""
+		key = '%s:%s' % (table, user['id'])
+		urls = self.user_cache.get(key)
+		if(urls is not None):
+			returnValue(urls)
+		
+		# If the URLs change while this query runs, its result may be
+		# stale, so it's only cached if the generation hasn't moved.
+		fill = self.user_fills.setdefault(key, [0, 0])
+		generation = fill[1]
+		fill[0] += 1
+		try:
+			url_query = "SELECT url FROM %s WHERE user_id = %%s" % table
+			result = yield self.conn.runQuery(url_query, [user['id']])
+		finally:
+			fill[0] -= 1
+			if not(fill[0]):
+				del self.user_fills[key]
+		
+		urls = frozenset([record['url'] for record in result])
+		if(fill[1] == generation):
+			self.user_cache.set(key, urls)
+		returnValue(urls)
+	
+	def _forgetUserURLs(self, table, user):
+		"""
+		Remove this user's cached URLs for the provided table.
+		
+		Any query for them that's still running won't be cached.
+		"""
+		key = '%s:%s' % (table, user['id'])
+		if(key in self.user_fills):
+			self.user_fills[key][1] += 1
+		self.user_cache.delete(key)
+	
 	@inlineCallbacks
 	def loadUser(self, user_id):
 		"""
@@ -218,6 +281,46 @@ class Connection(object):
 				returnValue(u)
 		returnValue(None)
 	
+	@inlineCallbacks
+	def loadAuthorization(self, sid, identity, root):
+		"""
+		Return the user for this session, along with their identity and trust status.
+		
+		This replaces the separate session, user, identity and trust queries
+		made during a checkid request with a single query. That query reads
+		the tables directly, so it neither uses nor fills L{user_cache} or
+		the session cache.
+		
+		@param sid: the login session ID
+		@type sid: str
+		
+		@param identity: the identity to check
+		@type identity: str
+		
+		@param root: the root URL to check
+		@type root: str
+		
+		@return: the user object, with the identity and root checks answered, or None
+		@rtype: L{txopenid.user.User}
+		"""
+		authorization_query = ("SELECT u.*, "
+			"EXISTS(SELECT 1 FROM identity i WHERE i.user_id = u.id AND i.url = %s) AS has_identity, "
+			"EXISTS(SELECT 1 FROM trusted_root t WHERE t.user_id = u.id AND t.url = %s) AS trusts_root "
+			"FROM session s INNER JOIN user u ON u.id = s.user_id "
+			"WHERE s.id = %s AND s.accessed - s.created < s.timeout")
+		result = yield self.conn.runQuery(authorization_query, [identity, root, sid])
+		if(result):
+			from txopenid import user
+			record = dict(result[0])
+			has_identity = record.pop('has_identity')
+			trusts_root = record.pop('trusts_root')
+			u = user.User(record)
+			u.pool = self
+			u.known_identities[identity] = bool(has_identity)
+			u.known_roots[root] = bool(trusts_root)
+			returnValue(u)
+		returnValue(None)
+	
 	@inlineCallbacks
 	def loadSession(self, sid):
 		"""
@@ -236,22 +339,26 @@ class Connection(object):
 		returnValue(None)
 	
 	@inlineCallbacks
-	def saveSession(self, session):
+	def saveSession(self, session, columns=None):
 		"""
 		Save the provided session record.
 		
 		@param session: the session record to save
 		@type session: dict
 		
+		@param columns: for existing sessions, only update these columns
+		@type columns: list(str)
+		
 		@return: True if there were no errors.
 		"""
 		if(session.get('_new') is None):
+			if(columns is None):
+				columns = [column for column in session if column != 'id']
 			fields = []
 			values = []
-			for column, value in session.items():
-				if(column != 'id'):
-					fields.append('%s = %%s' % column)
-					values.append(value)
+			for column in columns:
+				fields.append('%s = %%s' % column)
+				values.append(session[column])
 			values.append(session['id'])
 			save_query = "UPDATE session SET %s WHERE id = %%s" % ', '.join(fields)
 		else:
@@ -263,6 +370,37 @@ class Connection(object):
 		yield self.conn.runOperation(save_query, values)
 		returnValue(True)
 	
+	def touchSessions(self, accessed, batch_size=500):
+		"""
+		Update the access time of many sessions at once.
+		
+		Sessions are updated in multi-row statements of up to C{batch_size}
+		rows, all in one transaction. An access time is never moved
+		backwards, in case a newer one has already been saved. The expiry
+		time is moved along with the access time.
+		
+		@param accessed: new access times
+		@type accessed: dict(str => int)
+		
+		@param batch_size: the most sessions to update per statement
+		@type batch_size: int
+		"""
+		items = accessed.items()
+		def _touch(cursor):
+			for index in range(0, len(items), batch_size):
+				batch = items[index:index + batch_size]
+				# MySQL applies single-table SET assignments in order, so
+				# expires_at is computed from the updated access time
+				touch_operation = ("UPDATE session SET accessed = GREATEST(accessed, CASE id %s END), "
+					"expires_at = accessed + timeout WHERE id IN (%s)") % (
+					' '.join(['WHEN %s THEN %s'] * len(batch)), ', '.join(['%s'] * len(batch)))
+				values = []
+				for sid, timestamp in batch:
+					values.extend([sid, timestamp])
+				values.extend([sid for sid, timestamp in batch])
+				cursor.execute(touch_operation, values)
+		return self.conn.runInteraction(_touch)
+	
 	@inlineCallbacks
 	def verifyLogin(self, username, password):
 		"""
@@ -307,9 +445,18 @@ class Connection(object):
 		destroy_query = "DELETE FROM session WHERE id = %s"
 		return self.conn.runOperation(destroy_query, [sid])
 	
-	def cleanupSessions(self):
+	def reapSessions(self, limit):
 		"""
-		Remove expired sessions from the database.
+		Remove up to C{limit} expired sessions from the database.
+		
+		@param limit: the most sessions to remove
+		@type limit: int
+		
+		@return: the number of sessions removed
+		@rtype: int
 		"""
-		cleanup_query = "DELETE FROM session WHERE timeout < (%s - accessed)"
-		return self.conn.runOperation(cleanup_query, [int(time.time())])
\ No newline at end of file
+		reap_operation = "DELETE FROM session WHERE expires_at < %s LIMIT %s"
+		def _reap(cursor):
+			cursor.execute(reap_operation, [int(time.time()), limit])
+			return cursor.rowcount
+		return self.conn.runInteraction(_reap)
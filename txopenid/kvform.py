@@ -0,0 +1,90 @@
+# txopenid
+# Copyright (c) 2007 Phil Christensen
+#
+# See LICENSE for details
+
+"""
+OpenID key-value form encoding.
+
+Key-value form is a series of 'key:value' lines, each ended by a newline.
+It's used for direct responses (associate, check_authentication) and for
+the message a signature covers. Keys can't contain a colon or a newline,
+and values can't contain a newline; the encoder doesn't check for them.
+"""
+
+def encode(data, order=None):
+	"""
+	Return the key-value form of the provided fields.
+	
+	@param data: the fields to encode
+	@type data: dict
+	
+	@param order: the keys to encode, in order; by default, every key, sorted
+	@type order: sequence of str
+	
+	@rtype: str
+	"""
+	if(order is None):
+		order = sorted(data)
+	return ''.join(['%s:%s\n' % (key, data[key]) for key in order])
+
+def encode_signed(data, signed):
+	"""
+	Return the key-value form of the fields listed in an openid.signed value.
+	
+	The fields are encoded in the order they're listed, without their
+	'openid.' prefix, which is the message an OpenID signature covers.
+	
+	@param data: the request or response fields, with their 'openid.' prefix
+	@type data: dict
+	
+	@param signed: a comma-separated list of field names, e.g., 'identity,mode,return_to'
+	@type signed: str
+	
+	@rtype: str
+	"""
+	return ''.join(['%s:%s\n' % (key, data['openid.' + key]) for key in signed.split(',')])
+
+def write(buffer, data, order=None):
+	"""
+	Write the key-value form of the provided fields to a buffer.
+	
+	This saves building the whole response as a string when the caller
+	has somewhere to put it already, like a L{cStringIO} buffer or a request.
+	
+	@param buffer: anything with a write() method
+	
+	@param data: the fields to encode
+	@type data: dict
+	
+	@param order: the keys to encode, in order; by default, every key, sorted
+	@type order: sequence of str
+	"""
+	if(order is None):
+		order = sorted(data)
+	for key in order:
+		buffer.write('%s:%s\n' % (key, data[key]))
+
+def decode(text):
+	"""
+	Parse a key-value form message, as received by a consumer.
+	
+	Blank lines are ignored, as is a missing newline after the last line.
+	
+	@param text: the message
+	@type text: str
+	
+	@return: the fields in the message
+	@rtype: dict(str => str)
+	
+	@raise ValueError: if a line has no colon
+	"""
+	result = {}
+	for line in text.split('\n'):
+		if not(line):
+			continue
+		key, sep, value = line.partition(':')
+		if not(sep):
+			raise ValueError("invalid key-value form line: %r" % line)
+		result[key] = value
+	return result
@@ -20,16 +20,28 @@ Test Page::
 @var OPENID_IDENTITY_URL: Add/remove OpenID identities.
 @var OPENID_TRUST_URL: Add/remove OpenID trusted roots.
 @var OPENID_INFO_URL: Overview of user account, redirects to login page when necessary.
+@var ASSOCIATION_LIFETIME: Seconds until a new association expires.
+@var DH_ENABLED: Should consumers be allowed to encrypt the MAC key with Diffie-Hellman?
+@var DH_SESSION_TYPES: Hash constructors for each supported Diffie-Hellman session type.
+@var DH_P_VALUE: The default Diffie-Hellman modulus.
+@var DH_G_VALUE: The default Diffie-Hellman generator.
+@var DH_KEY_POOL: If set, server keypairs for the default modulus are taken from here.
+@var DH_MAX_MODULUS_BITS: The largest Diffie-Hellman modulus a consumer may ask for.
+@var DIRECT_MODES: Handlers for the modes sent directly by the ID Consumer's server, rather than the user's browser.
+@var SIGNED_FIELDS: The fields signed in a positive assertion, as listed in openid.signed.
+@var HMAC_CACHE: The secret and prepared HMAC object of recently used associations, by handle.
+@var HMAC_CACHE_SIZE: The most prepared HMAC objects to keep.
 """
 
-import base64, urllib, time
+import base64, urllib, time, hashlib
+
+from zope.interface import Interface
 
-from twisted.python import log
 from twisted.internet.defer import inlineCallbacks, returnValue, maybeDeferred
 
 from nevow.url import URL
 
-from txopenid import util
+from txopenid import util, store, kvform
 
 OPENID_PROVIDER_URL = 'http://%s/'
 OPENID_LOGIN_URL = 'http://%s/user/login'
@@ -37,13 +49,31 @@ OPENID_IDENTITY_URL = 'http://%s/user/identity'
 OPENID_TRUST_URL = 'http://%s/user/trust'
 OPENID_INFO_URL = 'http://%s/user/info'
 
-DH_SHA1_ENABLED = False
+DH_ENABLED = True
+DH_SESSION_TYPES = {
+	'DH-SHA1'	: hashlib.sha1,
+	'DH-SHA256'	: hashlib.sha256,
+}
+
+ASSOCIATION_LIFETIME = 86400
+
+SIGNED_FIELDS = 'identity,mode,return_to'
+
+# key-value form of SIGNED_FIELDS, as kvform.encode_signed would produce it
+_TOKEN_FORMAT = 'identity:%s\nmode:id_res\nreturn_to:%s\n'
 
 DH_P_VALUE = int('155172898181473697471232257763715539915724801966915404479707795'
 				'314057629378541917580651227423698188993727816152646631438561595'
 				'825688188889951272158842675419950341258706556549803580104870537'
 				'681476726513255747040765857479291291572334510643245094715007229'
 				'621094194349783925984760375594985848253359305585439638443')
+DH_G_VALUE = 2
+
+DH_KEY_POOL = None
+DH_MAX_MODULUS_BITS = 2048
+
+HMAC_CACHE = {}
+HMAC_CACHE_SIZE = 1000
 
 def configure_urls(hostname, port=80):
 	"""
@@ -87,6 +117,23 @@ def associate(registry, requestData):
 	@return: association response
 	@rtype: str or L{nevow.url.URL}
 	"""
+	assoc_type = requestData.get('openid.assoc_type', 'HMAC-SHA1')
+	if(assoc_type not in util.ASSOC_TYPES):
+		return associate_error("unsupported assoc_type: %s" % assoc_type)
+	
+	session_type = requestData.get('openid.session_type', '')
+	if(session_type and session_type not in DH_SESSION_TYPES):
+		return associate_error("unsupported session_type: %s" % session_type)
+	
+	use_dh = DH_ENABLED and session_type in DH_SESSION_TYPES
+	if(use_dh):
+		if(DH_SESSION_TYPES[session_type]().digest_size != util.ASSOC_TYPES[assoc_type]().digest_size):
+			return associate_error("session_type %s can't be used with assoc_type %s" % (session_type, assoc_type))
+		try:
+			modulus, generator, consumer_public = get_dh_parameters(requestData)
+		except ValueError, e:
+			return associate_error(str(e))
+	
 	association = registry.initiate(requestData, True)
 	response = dict(
 		assoc_type		= association.assoc_type,
@@ -94,13 +141,89 @@ def associate(registry, requestData):
 		expires_in		= association.expires_in
 	)
 	
-	if(DH_SHA1_ENABLED and requestData.get('openid.session_type') == 'DH-SHA1'):
-		response['enc_mac_key'] = association.enc_mac_key
+	if(use_dh):
+		keypair = get_dh_keypair(modulus, generator)
+		enc_mac_key = keypair.encrypt(consumer_public, association.secret, DH_SESSION_TYPES[session_type])
+		response['session_type'] = session_type
+		response['dh_server_public'] = base64.b64encode(util.btwoc(keypair.public))
+		response['enc_mac_key'] = base64.b64encode(enc_mac_key)
 	else:
 		response['mac_key'] = association.mac_key
 	
-	log.msg('[associate] new consumer association, dict: %r' % association.__dict__);
-	return util.kvstr(**response)
+	util.debug('[associate] new consumer association: %r', association)
+	return kvform.encode(response)
+
+def associate_error(message):
+	"""
+	Return the response to an associate request we can't satisfy.
+	
+	The response suggests an association type the consumer can retry
+	with, and a session type if Diffie-Hellman sessions are enabled;
+	otherwise the consumer should retry without one.
+	
+	@param message: a description of the problem
+	@type message: str
+	
+	@rtype: str
+	"""
+	response = dict(
+		error			= message,
+		error_code		= 'unsupported-type',
+		assoc_type		= 'HMAC-SHA1',
+	)
+	if(DH_ENABLED):
+		response['session_type'] = 'DH-SHA1'
+	return kvform.encode(response)
+
+def get_dh_parameters(requestData):
+	"""
+	Return the modulus, generator and consumer public key from a
+	Diffie-Hellman associate request.
+	
+	The modulus and generator default to L{DH_P_VALUE} and L{DH_G_VALUE}.
+	
+	@param requestData: the current request data
+	@type requestData: L{OpenIDRequest}
+	
+	@rtype: tuple(long, long, long)
+	
+	@raise ValueError: if a parameter is missing, malformed or out of range
+	"""
+	try:
+		if('openid.dh_modulus' in requestData):
+			modulus = util.mklong(base64.b64decode(requestData['openid.dh_modulus']))
+		else:
+			modulus = DH_P_VALUE
+		if('openid.dh_gen' in requestData):
+			generator = util.mklong(base64.b64decode(requestData['openid.dh_gen']))
+		else:
+			generator = DH_G_VALUE
+		consumer_public = util.mklong(base64.b64decode(requestData['openid.dh_consumer_public']))
+	except KeyError:
+		raise ValueError("missing dh_consumer_public")
+	except TypeError:
+		raise ValueError("malformed Diffie-Hellman parameter")
+	
+	if(modulus.bit_length() > DH_MAX_MODULUS_BITS):
+		raise ValueError("dh_modulus is larger than %d bits" % DH_MAX_MODULUS_BITS)
+	if not(1 < generator < modulus - 1):
+		raise ValueError("invalid dh_gen")
+	if not(1 < consumer_public < modulus - 1):
+		raise ValueError("invalid dh_consumer_public")
+	return modulus, generator, consumer_public
+
+def get_dh_keypair(modulus=DH_P_VALUE, generator=DH_G_VALUE):
+	"""
+	Return a new server keypair for a Diffie-Hellman exchange.
+	
+	Keypairs for the default modulus and generator come from
+	DH_KEY_POOL, if it's set.
+	
+	@rtype: L{DiffieHellman}
+	"""
+	if(DH_KEY_POOL is not None and modulus == DH_P_VALUE and generator == DH_G_VALUE):
+		return DH_KEY_POOL.get()
+	return DiffieHellman(modulus, generator)
 
 @inlineCallbacks
 def checkid_immediate(registry, requestData, user=None):
@@ -195,35 +318,37 @@ def get_login_response(registry, requestData):
 	@return: a response URL
 	@rtype: str
 	"""
-	log.msg('[get_login_response] request: %r' % requestData)
-	
 	association = registry.initiate(requestData, 'openid.assoc_handle' in requestData)
-	log.msg('[get_login_response] association: %r' % association)
-	
-	log.msg('[get_login_response] Using handle: %r' % association.handle)
-	token_key = util.secret(association.handle)
-	log.msg('[get_login_response] Found key: %r' % token_key)
-	token_contents = util.kvstr(
-		mode		= 'id_res',
-		identity	= requestData['openid.identity'],
-		return_to	= requestData['openid.return_to'],
-	)
+	util.debug('[get_login_response] identity %r using association %r', requestData['openid.identity'], association)
+	
+	token_contents = get_token_contents(requestData['openid.identity'], requestData['openid.return_to'])
 	
 	return_dict = {
 		'openid.mode'			: 'id_res',
 		'openid.identity'		: requestData['openid.identity'],
 		'openid.assoc_handle'	: association.handle,
 		'openid.return_to'		: requestData['openid.return_to'],
-		'openid.signed'			: 'identity,mode,return_to',
-		'openid.sig'			: base64.b64encode(util.get_hmac(token_key, token_contents))
+		'openid.signed'			: SIGNED_FIELDS,
+		'openid.sig'			: base64.b64encode(association.sign(token_contents))
 	}
 	
 	if(association.handle != requestData.get('openid.assoc_handle', association.handle)):
-		log.msg("[get_login_response] Retrieved association handle doesn't match request: %r" % requestData['openid.assoc_handle'])
+		util.debug("[get_login_response] Retrieved association handle doesn't match request: %r", requestData['openid.assoc_handle'])
 		return_dict['openid.invalidate_handle'] = requestData['openid.assoc_handle']
 	
 	return util.appendQuery(requestData['openid.return_to'], return_dict)
 
+def get_token_contents(identity, return_to):
+	"""
+	Return the message signed in a positive assertion.
+	
+	This is the key-value form of the L{SIGNED_FIELDS}, filled into
+	a preformatted string rather than built and sorted each time.
+	
+	@rtype: str
+	"""
+	return _TOKEN_FORMAT % (identity, return_to)
+
 def check_authentication(registry, requestData):
 	"""
 	Verify authentication for a previous "dumb" request.
@@ -240,27 +365,39 @@ def check_authentication(registry, requestData):
 	valid_string = repr(registry.validate(requestData, False)).lower()
 	association = registry.initiate(requestData, False)
 	
-	log.msg('[check_authentication] request: %r' % requestData)
-	log.msg('[check_authentication] association: %r' % association)
+	util.debug('[check_authentication] handle %r is %s, using association %r', requestData['openid.assoc_handle'], valid_string, association)
 	if(association.handle == requestData['openid.assoc_handle']):
-		output = util.kvstr({'openid.mode':'id_res'}, is_valid=valid_string)
+		output = kvform.encode({'openid.mode':'id_res', 'is_valid':valid_string})
 	else:
-		output = util.kvstr({'openid.mode':'id_res'}, is_valid=valid_string, invalidate_handle=requestData['openid.assoc_handle'])
-	
-	log.msg('[check_authentication] returning: %r' % output)
+		output = kvform.encode({'openid.mode':'id_res', 'is_valid':valid_string, 'invalidate_handle':requestData['openid.assoc_handle']})
 	
 	return output
 
+DIRECT_MODES = dict(
+	associate				= associate,
+	check_authentication	= check_authentication,
+)
+
 class OpenIDRegistry(object):
 	"""
 	A holding area for shared secrets.
 	"""
-	def __init__(self):
+	def __init__(self, smart=None, dumb=None):
 		"""
 		Create a new OpenID shared secret registry.
+		
+		@param smart: where to keep smart associations, defaults to memory
+		@type smart: L{txopenid.store.IAssociationStore}
+		
+		@param dumb: where to keep dumb associations, defaults to memory
+		@type dumb: L{txopenid.store.IAssociationStore}
 		"""
-		self.smart = {}
-		self.dumb = {}
+		if(smart is None):
+			smart = store.MemoryAssociationStore()
+		if(dumb is None):
+			dumb = store.MemoryAssociationStore()
+		self.smart = smart
+		self.dumb = dumb
 	
 	def initiate(self, requestData, is_smart):
 		"""
@@ -279,32 +416,22 @@ class OpenIDRegistry(object):
 		else:
 			assoc_type = 'HMAC-SHA1'
 		
-		# TODO: i think this section also needs to check expiry dates
-		# on shared secrets, returning new association handles if
-		# appropriate.
 		handle = requestData.get('openid.assoc_handle', None)
 		
 		if(is_smart):
-			log.msg('Trying to find smart association')
 			bank = self.smart
 		else:
-			log.msg('Trying to find dumb association')
 			bank = self.dumb
 		
-		if(handle in bank):
-			log.msg('    found handle: %r' % handle)
-			association = bank[handle]
-			if(time.time() - association.created > association.expires_in):
-				log.msg('    association expired, returning new')
-				del bank[association.handle]
-				association = OpenIDAssociation(requestData, assoc_type)
-				bank[association.handle] = association
+		association = bank.get(handle)
+		if(association is not None):
+			if(time.time() > association.expires):
+				util.debug('[initiate] association expired, replacing: %r', association)
+				bank.remove(association.handle)
+				association = bank.create(requestData, assoc_type)
 		else:
-			association = OpenIDAssociation(requestData, assoc_type)
-			bank[association.handle] = association
-			log.msg('    saved handle: %r' % association.handle)
-		
-		log.msg('    association: %r' % association)
+			association = bank.create(requestData, assoc_type)
+			util.debug('[initiate] created %s association: %r', ('dumb', 'smart')[bool(is_smart)], association)
 		
 		return association
 	
@@ -324,43 +451,83 @@ class OpenIDRegistry(object):
 		handle = requestData['openid.assoc_handle']
 		
 		if(is_smart):
-			log.msg('Validating smart association')
 			bank = self.smart
 		else:
-			log.msg('Validating dumb association')
 			bank = self.dumb
 		
-		if(handle in bank):
-			log.msg('    found handle: %r' % handle)
-			association = bank[handle]
-			log.msg('    association: %r' % association)
-			if(time.time() - association.created > association.expires_in):
-				log.msg('    association expired, denying handle')
-				del bank[association.handle]
+		association = bank.get(handle)
+		if(association is not None):
+			if(time.time() > association.expires):
+				util.debug('[validate] association expired, denying handle: %r', association)
+				bank.remove(association.handle)
 				return False
 		else:
-			log.msg('    denied handle: %r' % handle)
+			util.debug('[validate] denied unknown handle: %r', handle)
 			return False
 		
-		token_contents = util.kvstr(mode='id_res',
-								identity=requestData['openid.identity'],
-								return_to=requestData['openid.return_to'])
+		try:
+			sig = base64.b64decode(requestData.get('openid.sig', ''))
+		except TypeError:
+			util.debug('[validate] malformed signature for handle: %r', handle)
+			return False
+		
+		token_contents = get_token_contents(requestData['openid.identity'], requestData['openid.return_to'])
+		return util.compare_digest(association.sign(token_contents), sig)
+	
+	def sweep(self, now=None):
+		"""
+		Remove expired associations from both banks.
 		
-		valid_sig = base64.b64encode(util.get_hmac(association.secret, token_contents))
+		This is meant to be called periodically, e.g., from a
+		L{twisted.application.internet.TimerService}.
 		
-		log.msg('Comparing %r' % requestData['openid.sig'])
-		log.msg('to valid  %r' % valid_sig)
+		@param now: the current time, defaults to time.time()
+		@type now: float
 		
-		return requestData['openid.sig'] == valid_sig
+		@return: the number of associations removed
+		@rtype: int
+		"""
+		count = self.smart.expire(now) + self.dumb.expire(now)
+		if(count):
+			util.info('Expired %d associations', count)
+		return count
+	
+	def stats(self):
+		"""
+		Return counts of live, expired and evicted associations.
+		
+		@return: counters for each bank
+		@rtype: dict(str => dict(str => int))
+		"""
+		result = {}
+		for name, bank in (('smart', self.smart), ('dumb', self.dumb)):
+			result[name] = dict(
+				live	= len(bank),
+				expired	= getattr(bank, 'expired', 0),
+				evicted	= getattr(bank, 'evicted', 0),
+			)
+		return result
 
 class OpenIDAssociation(object):
 	"""
-	A convenience object that creates keys and the like
-	for us when passed a request dictionary.
+	A convenience object that creates keys and the like for us.
+	
+	Registries may hold a great many of these, so they use slots,
+	and keep their expiry deadline as a precomputed timestamp.
+	
+	@ivar created: creation time, in seconds since the epoch
+	@type created: int
+	
+	@ivar expires: expiry time, in seconds since the epoch
+	@type expires: int
 	"""
-	def __init__(self, requestData, assoc_type='HMAC-SHA1', handle=None):
+	__slots__ = ('handle', 'assoc_type', 'secret', 'created', 'expires')
+	
+	def __init__(self, assoc_type='HMAC-SHA1', handle=None, secret=None, created=None, expires_in=ASSOCIATION_LIFETIME):
 		"""
-		Create a new association with the provided requestData.
+		Create a new association.
+		
+		If no secret is provided, one will be derived from the handle.
 		"""
 		if(handle):
 			self.handle = handle
@@ -368,28 +535,170 @@ class OpenIDAssociation(object):
 			self.handle = base64.b64encode(util.handle())
 		
 		self.assoc_type = assoc_type
-		self.secret = util.secret(self.handle, assoc_type)
-		self.created = time.time()
-		self.expires_in = '86400'
-		
-		if(DH_SHA1_ENABLED and requestData.get('openid.session_type') == 'DH-SHA1'):
-			self.dh_modulus = util.mklong(base64.b64decode(requestData['openid.dh_modulus']))
-			self.dh_gen = util.mklong(base64.b64decode(requestData['openid.dh_gen']))
-			self.dh_consumer_public = util.mklong(base64.b64decode(requestData['openid.dh_consumer_public']))
-			self.dh_server_private = util.mkkey()
-			self.dh_server_public = base64.b64encode(util.btwoc(pow(self.dh_gen, self.dh_server_private) % self.dh_modulus))
-			self.dh_shared_secret = pow(self.dh_consumer_public, self.dh_server_private) % self.dh_modulus
-			self.enc_mac_key = util.secret(util.btwoc(self.dh_shared_secret), 'HMAC-SHA1') ^ self.secret
+		if(secret is None):
+			self.secret = util.secret(self.handle, assoc_type)
 		else:
-			self.mac_key = base64.b64encode(self.secret)
+			self.secret = secret
+		
+		if(created is None):
+			created = int(time.time())
+		self.created = created
+		self.expires = created + expires_in
+	
+	def _get_expires_in(self):
+		return self.expires - self.created
+	
+	def _set_expires_in(self, expires_in):
+		self.expires = self.created + int(expires_in)
+	
+	expires_in = property(_get_expires_in, _set_expires_in, doc="lifetime of this association, in seconds")
+	
+	@property
+	def mac_key(self):
+		"""
+		The base64-encoded secret, as sent to smart consumers.
+		"""
+		return base64.b64encode(self.secret)
+	
+	def sign(self, message):
+		"""
+		Return the HMAC of the provided message, keyed with this association's secret.
+		
+		The HMAC object keyed with the secret is prepared on first use and
+		kept in L{HMAC_CACHE}, then copied to sign each message. Keeping it
+		on the association would more than double the association's size.
+		When the cache is full, an arbitrary entry makes room; keeping it
+		in LRU order costs about as much as preparing the HMAC again.
+		
+		@type message: str
+		@rtype: str
+		"""
+		entry = HMAC_CACHE.get(self.handle)
+		if(entry is None or entry[0] != self.secret):
+			if(len(HMAC_CACHE) >= HMAC_CACHE_SIZE):
+				HMAC_CACHE.popitem()
+			entry = HMAC_CACHE[self.handle] = (self.secret, util.prepare_hmac(self.secret, self.assoc_type))
+		mac = entry[1].copy()
+		mac.update(message)
+		return mac.digest()
 	
 	def __repr__(self):
-		return str(self.__dict__)
+		return '<OpenIDAssociation %s handle=%r created=%r expires=%r>' % (self.assoc_type, self.handle, self.created, self.expires)
 
-class OpenIDRequest(dict):
+class DiffieHellman(object):
 	"""
-	A wrapper class for NevowRequest objects.
+	The server's half of a Diffie-Hellman key exchange.
+	
+	@ivar public: the server's public key
+	@type public: long
 	"""
+	__slots__ = ('modulus', 'generator', 'private', 'public')
+	
+	def __init__(self, modulus=DH_P_VALUE, generator=DH_G_VALUE, private=None):
+		"""
+		Create a new keypair.
+		
+		@param private: the private key, defaults to a new random one
+		@type private: long
+		"""
+		if(private is None):
+			private = util.mkkey()
+		self.modulus = modulus
+		self.generator = generator
+		self.private = private
+		self.public = pow(generator, private, modulus)
+	
+	def encrypt(self, consumer_public, secret, hash):
+		"""
+		Encrypt a MAC key for the consumer with the provided public key.
+		
+		@param consumer_public: the consumer's public key
+		@type consumer_public: long
+		
+		@param secret: the MAC key
+		@type secret: str
+		
+		@param hash: hash constructor for the session type, e.g., hashlib.sha1
+		
+		@return: the hashed shared secret, XORed with the MAC key
+		@rtype: str
+		
+		@raise ValueError: if the public key is out of range, or the
+			hash doesn't match the size of the MAC key
+		"""
+		if not(1 < consumer_public < self.modulus - 1):
+			raise ValueError("invalid dh_consumer_public")
+		shared_secret = pow(consumer_public, self.private, self.modulus)
+		digest = hash(util.btwoc(shared_secret)).digest()
+		if(len(digest) != len(secret)):
+			raise ValueError("session type doesn't match association type")
+		return util.strxor(digest, secret)
+
+class DHKeyPool(object):
+	"""
+	Server keypairs for the default modulus, computed ahead of time.
+	
+	Each keypair is only handed out once; L{fill} should be called
+	periodically to replace them. If the pool runs dry, new keypairs
+	are computed on demand.
+	
+	The pool doesn't save any work; the same keypairs are computed on
+	the same thread either way. It only moves the work out of the
+	associate request, so a burst of requests is answered quickly.
+	
+	@ivar size: the most keypairs to keep on hand
+	@type size: int
+	
+	@ivar batch: the most keypairs to compute in one call to L{fill}
+	@type batch: int
+	"""
+	def __init__(self, size=100, batch=5):
+		self.size = size
+		self.batch = batch
+		self.keypairs = []
+	
+	def get(self):
+		"""
+		Return an unused keypair.
+		
+		@rtype: L{DiffieHellman}
+		"""
+		if(self.keypairs):
+			return self.keypairs.pop()
+		return DiffieHellman()
+	
+	def fill(self):
+		"""
+		Compute keypairs toward filling the pool.
+		
+		At most L{batch} keypairs are computed, so a periodic call on
+		the reactor thread never blocks it for long.
+		
+		@return: the number of keypairs added
+		@rtype: int
+		"""
+		count = min(self.size - len(self.keypairs), self.batch)
+		for i in range(count):
+			self.keypairs.append(DiffieHellman())
+		return max(count, 0)
+	
+	def __len__(self):
+		return len(self.keypairs)
+
+class IOpenIDRequest(Interface):
+	"""
+	The parsed OpenID request, cached as a component of the Nevow request.
+	"""
+
+class OpenIDRequest(object):
+	"""
+	The parameters of an OpenID request.
+	
+	This is a read-only mapping; it doesn't hold on to the Nevow
+	request it was parsed from. Use L{parse_request} to get the
+	instance cached on the current request.
+	"""
+	__slots__ = ('params', 'method')
 	
 	def __init__(self, request):
 		"""
@@ -400,20 +709,78 @@ class OpenIDRequest(dict):
 		worry about having multiple GET params of the
 		same name, or complex POST values.
 		"""
+		params = {}
 		if(getattr(request, 'args', None)):
 			for key in request.args:
-				self[key] = request.args[key][0]
+				params[key] = request.args[key][0]
 		if(getattr(request, 'fields', None)):
 			for key in request.fields:
-				self[key] = request.fields[key].value
+				params[key] = request.fields[key].value
 		
-		self.request = request
+		object.__setattr__(self, 'params', params)
+		object.__setattr__(self, 'method', getattr(request, 'method', None))
+	
+	def __setattr__(self, name, value):
+		raise AttributeError("OpenIDRequest objects are read-only")
+	
+	__delattr__ = __setattr__
+	
+	def __getitem__(self, key):
+		return self.params[key]
+	
+	def __contains__(self, key):
+		return key in self.params
+	
+	def __iter__(self):
+		return iter(self.params)
+	
+	def __len__(self):
+		return len(self.params)
+	
+	def __repr__(self):
+		return '<OpenIDRequest %s %r>' % (self.method, self.params)
+	
+	def get(self, key, default=None):
+		return self.params.get(key, default)
+	
+	def keys(self):
+		return self.params.keys()
+	
+	def items(self):
+		return self.params.items()
 	
-	def clear_request(self):
+	def openid_fields(self):
 		"""
-		Clear out any existing POST or GET data.
-		
-		This allows us to take some shortcuts after parsing form data.
+		Return a new dict of just the openid.* parameters.
 		"""
-		self.request.args = {}
-		self.request.fields = {}
+		return dict([(k, v) for k, v in self.params.iteritems() if k.startswith('openid.')])
+
+def parse_request(request):
+	"""
+	Return the parsed OpenID request for the provided Nevow request.
+	
+	The parameters are only parsed once per request.
+	
+	@param request: the current request
+	@type request: L{nevow.appserver.NevowRequest}
+	
+	@rtype: L{OpenIDRequest}
+	"""
+	requestData = request.getComponent(IOpenIDRequest)
+	if(requestData is None):
+		requestData = OpenIDRequest(request)
+		request.setComponent(IOpenIDRequest, requestData)
+	return requestData
+
+def clear_request(request):
+	"""
+	Clear out any existing POST or GET data.
+	
+	This allows us to take some shortcuts after parsing form data.
+	
+	@param request: the current request
+	@type request: L{nevow.appserver.NevowRequest}
+	"""
+	request.args = {}
+	request.fields = {}
+	request.setComponent(IOpenIDRequest, OpenIDRequest(request))
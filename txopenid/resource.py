@@ -11,9 +11,9 @@ consumer, and allow the end-user to assign trust to particular roots, validate
 identities, and perform the inital login.
 """
 
-import os
+import os, re
 
-from zope.interface import implements
+from zope.interface import Interface, implements
 
 from twisted.python import log, failure
 from twisted.internet.defer import inlineCallbacks, returnValue, maybeDeferred
@@ -21,7 +21,21 @@ from twisted.cred import credentials
 
 from nevow import inevow, rend, loaders, tags, url
 
-from txopenid import assets, util, session, protocol
+from txopenid import assets, util, session, protocol, template
+
+_SECRET_FIELD = re.compile(r'^((?:enc_)?mac_key):.*$', re.M)
+
+class _Redacted(object):
+	"""
+	A response body that hides association secrets when it's logged.
+	
+	The body is only scanned if the message is actually logged.
+	"""
+	def __init__(self, output):
+		self.output = output
+	
+	def __repr__(self):
+		return repr(_SECRET_FIELD.sub(r'\1:<redacted>', self.output))
 
 def get_assets_path(*path):
 	"""
@@ -33,6 +47,69 @@ def get_assets_path(*path):
 	"""
 	return os.path.join(os.path.dirname(assets.__file__), *path)
 
+def get_request_data(ctx):
+	"""
+	Fetch the parsed OpenID request for the current request.
+	
+	@param ctx: the current context
+	@type ctx: L{nevow.context.WebContext}
+	
+	@rtype: L{txopenid.protocol.OpenIDRequest}
+	"""
+	return protocol.parse_request(inevow.IRequest(ctx))
+
+HIDDEN_FIELD = template.Fragment(tags.input(type='hidden', name=tags.slot('name'), value=tags.slot('value')))
+CANCEL_BUTTON = template.Fragment(tags.input(type='submit', name='submit', value='cancel'))
+
+URL_LIST = template.Fragment([tags.h3()[tags.slot('title')], tags.ul(_class="url-list")[tags.slot('items')]])
+URL_ITEM = template.Fragment(tags.li()[tags.slot('url')])
+URL_CHECKBOX_ITEM = template.Fragment(tags.li()[[
+	tags.input(type='checkbox', name=tags.slot('name'), value='1'),
+	tags.slot('url'),
+]])
+
+def render_openid_fields(ctx):
+	"""
+	Replicate the current request's openid.* fields as hidden form fields.
+	
+	@param ctx: the current context
+	@type ctx: L{nevow.context.WebContext}
+	
+	@rtype: L{nevow.tags.xml}
+	"""
+	requestData = get_request_data(ctx)
+	return tags.xml(''.join([
+		HIDDEN_FIELD.render(name=k, value=v)
+		for k, v in requestData.items()
+		if k.startswith('openid.')
+	]))
+
+def render_url_list(title, items, prefix=None):
+	"""
+	Render a titled list of identity or root records.
+	
+	@param items: records with 'id' and 'url' keys
+	@type items: list(dict)
+	
+	@param prefix: if set, each item gets a checkbox named prefix + the record id
+	@type prefix: str
+	
+	@rtype: L{nevow.tags.xml}
+	"""
+	if(prefix is None):
+		rendered = [URL_ITEM.render(url=item['url']) for item in items]
+	else:
+		rendered = [URL_CHECKBOX_ITEM.render(name='%s%s' % (prefix, item['id']), url=item['url']) for item in items]
+	return URL_LIST(title=title, items=tags.xml(''.join(rendered)))
+
+class ICurrentUser(Interface):
+	"""
+	The user authenticated for the current request.
+	
+	Pages are shared by every request in flight, so this is kept as
+	a component of the request instead.
+	"""
+
 class UserStubPage(rend.Page):
 	"""
 	Organizational resource, simply redirects to the login page.
@@ -49,7 +126,7 @@ class LoginPage(rend.Page):
 	would have returned a ProviderPage.
 	"""
 	implements(inevow.IResource)
-	docFactory = loaders.xmlfile(get_assets_path('login-page.xml'))
+	docFactory = template.load('login-page.xml')
 	
 	def __init__(self, pool, portal):
 		"""
@@ -72,9 +149,9 @@ class LoginPage(rend.Page):
 		@see: L{nevow.inevow.IResource}
 		"""
 		request = inevow.IRequest(ctx)
-		requestData = protocol.OpenIDRequest(request)
+		requestData = protocol.parse_request(request)
 		
-		log.msg('UserPage request: %r' % requestData)
+		util.debug('[LoginPage] request for mode %r', requestData.get('openid.mode'))
 		if(requestData.get('submit') == 'cancel'):
 			return_to = requestData.get('openid.return_to', protocol.OPENID_LOGIN_URL)
 			redirect = util.appendQuery(return_to, {'openid.mode':'cancel'})
@@ -87,16 +164,11 @@ class LoginPage(rend.Page):
 			creds = session.getSessionCredentials(ctx)
 		
 		iface, user, logout = yield self.portal.login(creds, None, inevow.IResource)
-		
-		for k, v in requestData.items():
-			if not(k.startswith('openid.')):
-				del requestData[k]
-		
 		yield session.updateSession(self.pool, request, user)
 		
 		if(user):
 			if('openid.mode' in requestData):
-				redirect = util.appendQuery(protocol.OPENID_PROVIDER_URL, requestData)
+				redirect = util.appendQuery(protocol.OPENID_PROVIDER_URL, requestData.openid_fields())
 				request.redirect(redirect)
 				returnValue('')
 			else:
@@ -111,24 +183,15 @@ class LoginPage(rend.Page):
 		"""
 		Template function to replicate openid.* form fields.
 		"""
-		request = inevow.IRequest(ctx)
-		requestData = protocol.OpenIDRequest(request)
-		result = []
-		
-		for k, v in requestData.items():
-			if(k.startswith('openid.')):
-				result.append(tags.input(type='hidden', name=k, value=v))
-		
-		return result
+		return render_openid_fields(ctx)
 	
 	def data_cancel(self, ctx, data):
 		"""
 		Template function to create a cancel button only during Consumer request.
 		"""
-		request = inevow.IRequest(ctx)
-		requestData = protocol.OpenIDRequest(request)
+		requestData = get_request_data(ctx)
 		if(requestData.get('openid.mode')):
-			return tags.input(type='submit', name='submit', value='cancel')
+			return CANCEL_BUTTON()
 		return ''
 
 class LogoutPage(rend.Page):
@@ -164,8 +227,8 @@ class LogoutPage(rend.Page):
 
 class AbstractUserPage(rend.Page):
 	"""
-	All subclasses of this class will have self.user set
-	to the currently authenticated user.
+	All subclasses of this class can find the currently
+	authenticated user with L{getUser}.
 	"""
 	def __init__(self, pool, portal):
 		"""
@@ -180,10 +243,28 @@ class AbstractUserPage(rend.Page):
 		self.pool = pool
 		self.portal = portal
 	
+	def getUser(self, ctx):
+		"""
+		Return the user authenticated for the current request.
+		
+		@return: the current user, or None
+		@rtype: L{txopenid.user.User}
+		"""
+		return inevow.IRequest(ctx).getComponent(ICurrentUser)
+	
+	def setUser(self, ctx, user):
+		"""
+		Set the user authenticated for the current request.
+		"""
+		inevow.IRequest(ctx).setComponent(ICurrentUser, user)
+	
 	@inlineCallbacks
 	def authenticate(self, ctx):
 		"""
 		Authenticate the current session.
+		
+		@return: the current user, or None
+		@rtype: L{txopenid.user.User}
 		"""
 		request = inevow.IRequest(ctx)
 		
@@ -191,26 +272,31 @@ class AbstractUserPage(rend.Page):
 		iface, user, logout = yield self.portal.login(creds, None, inevow.IResource)
 		yield session.updateSession(self.pool, request, user)
 		
-		self.user = user
+		self.setUser(ctx, user)
+		returnValue(user)
 	
 	@inlineCallbacks
 	def authRedirect(self, ctx):
 		"""
 		Authenticate the current session, redirecting to login if necessary.
 		"""
-		yield self.authenticate(ctx)
-		if(self.user is None):
+		user = yield self.authenticate(ctx)
+		if(user is None):
 			request = inevow.IRequest(ctx)
 			request.redirect(protocol.OPENID_LOGIN_URL)
 			returnValue(True)
 		returnValue(False)
 	
+USER_INFO = template.Fragment(tags.p()[
+	"authorization information for ", tags.slot('name'), " (username '", tags.slot('username'), "').",
+])
+
 class InfoPage(AbstractUserPage):
 	"""
 	This page displays the details for the connected user.
 	"""
 	implements(inevow.IResource)
-	docFactory = loaders.xmlfile(get_assets_path('info-page.xml'))
+	docFactory = template.load('info-page.xml')
 	
 	@inlineCallbacks
 	def renderHTTP(self, ctx):
@@ -225,45 +311,44 @@ class InfoPage(AbstractUserPage):
 		"""
 		Template function to display basic user info.
 		"""
-		return tags.p()[
-			"authorization information for %s (username '%s')." % (
-				self.user['first'] + ' ' + self.user['last'],
-				self.user['username'],
-			)
-		]
+		user = self.getUser(ctx)
+		return USER_INFO(name=user['first'] + ' ' + user['last'], username=user['username'])
 	
 	@inlineCallbacks
 	def data_identities(self, ctx, data):
 		"""
 		Template function to display a list of user identities.
 		"""
-		result = yield self.user.getIdentities()
-		output = [tags.h3()['identities'],
-			tags.ul(_class="url-list")[[
-				tags.li()[item['url']] for item in result
-			]]
-		]
-		returnValue(output)
+		result = yield self.getUser(ctx).getIdentities()
+		returnValue(render_url_list('identities', result))
 	
 	@inlineCallbacks
 	def data_trusted_roots(self, ctx, data):
 		"""
 		Template function to display a list of user roots.
 		"""
-		result = yield self.user.getTrustedRoots()
-		output = [tags.h3()['trusted roots'],
-			tags.ul(_class="url-list")[[
-				tags.li()[item['url']] for item in result
-			]]
-		]
-		returnValue(output)
+		result = yield self.getUser(ctx).getTrustedRoots()
+		returnValue(render_url_list('trusted roots', result))
+
+APPROVE_IDENTITY = template.Fragment(tags.div(_class="trustable")[[
+	tags.small()["click 'approve new identity' to verify access to this URL:"],
+	tags.br(),
+	tags.strong()[tags.slot('url')],
+	tags.input(type="submit", name="submit", value="approve new identity"),
+]])
+NEW_IDENTITY_FORM = template.Fragment(tags.div(_class="trustable")[[
+	tags.small()["enter a new identity URL here and click 'approve new identity':"],
+	tags.br(),
+	tags.input(type='text', size="60", name='openid.identity', value=''),
+	tags.input(type="submit", name="submit", value="approve new identity"),
+]])
 
 class IdentityPage(AbstractUserPage):
 	"""
 	This page displays the details for the connected user.
 	"""
 	implements(inevow.IResource)
-	docFactory = loaders.xmlfile(get_assets_path('identity-page.xml'))
+	docFactory = template.load('identity-page.xml')
 	
 	@inlineCallbacks
 	def renderHTTP(self, ctx):
@@ -273,26 +358,27 @@ class IdentityPage(AbstractUserPage):
 		@see: L{nevow.inevow.IResource}
 		"""
 		request = inevow.IRequest(ctx)
-		requestData = protocol.OpenIDRequest(request)
+		requestData = protocol.parse_request(request)
 		
 		result = yield self.authRedirect(ctx)
 		if(result):
 			returnValue('')
 		
 		if('submit' in requestData):
-			requestData.clear_request()
+			protocol.clear_request(request)
 			if(requestData.get('submit') == 'remove selected'):
-				yield self.removeIdent(requestData)
+				yield self.removeIdent(self.getUser(ctx), requestData)
 			elif(requestData.get('submit') == 'approve new identity'):
-				result = yield self.approveIdent(requestData)
-				if(result is not None):
-					returnValue(result)
+				return_to = yield self.approveIdent(self.getUser(ctx), requestData)
+				if(return_to is not None):
+					request.redirect(return_to)
+					returnValue('')
 		
 		result = yield maybeDeferred(super(IdentityPage, self).renderHTTP, ctx)
 		returnValue(result)
 	
 	@inlineCallbacks
-	def removeIdent(self, requestData):
+	def removeIdent(self, user, requestData):
 		"""
 		Form support to remove selected identities.
 		"""
@@ -302,33 +388,30 @@ class IdentityPage(AbstractUserPage):
 				junk, identity_id = k.split('-')
 				identity_ids.append(identity_id)
 		
-		yield self.pool.removeUserIdentities(self.user, identity_ids)
+		yield self.pool.removeUserIdentities(user, identity_ids)
 		returnValue(None)
 	
 	@inlineCallbacks
-	def approveIdent(self, requestData):
+	def approveIdent(self, user, requestData):
 		"""
 		Form support to approve specified identity.
+		
+		@return: where to continue the OpenID flow, if anywhere
+		@rtype: str
 		"""
 		identity = requestData['openid.identity']
 		
 		existing_user_id = yield self.pool.getUserIdForIdentity(identity)
 		if(existing_user_id):
-			if(existing_user_id == self.user['id']):
+			if(existing_user_id == user['id']):
 				raise ValueError('You have already registered that identity.')
 			else:
 				raise ValueError('Another user has already registered that identity.')
 		
-		result = yield self.pool.saveUserIdentity(self.user, identity)
+		result = yield self.pool.saveUserIdentity(user, identity)
 		
 		if(requestData.get('openid.mode') not in (None, 'checkid_immediate')):
-			for k, v in requestData.items():
-				if not(k.startswith('openid.')):
-					del requestData[k]
-			
-			return_to = util.appendQuery(protocol.OPENID_PROVIDER_URL, requestData)
-			requestData.request.redirect(return_to)
-			returnValue('')
+			returnValue(util.appendQuery(protocol.OPENID_PROVIDER_URL, requestData.openid_fields()))
 		else:
 			returnValue(None)
 	
@@ -337,60 +420,45 @@ class IdentityPage(AbstractUserPage):
 		"""
 		Template function to display a checkbox list of user identities.
 		"""
-		result = yield self.user.getIdentities()
-		output = [tags.h3()['identities'],
-			tags.ul(_class="url-list")[[
-				tags.li()[[
-					tags.input(type='checkbox', name='identity-%s' % item['id'], value='1'),
-					item['url'],
-				]]
-				for item in result
-			]]
-		]
-		returnValue(output)
+		result = yield self.getUser(ctx).getIdentities()
+		returnValue(render_url_list('identities', result, 'identity-'))
 	
 	def data_new_identity(self, ctx, data):
 		"""
 		Template function to display the new identity form.
 		"""
-		request = inevow.IRequest(ctx)
-		requestData = protocol.OpenIDRequest(request)
+		requestData = get_request_data(ctx)
 		current_identity = requestData.get('openid.identity', None)
 		if(current_identity):
-			return tags.div(_class="trustable")[[
-				tags.small()["click 'approve new identity' to verify access to this URL:"],
-				tags.br(),
-				tags.strong()[current_identity],
-				tags.input(type="submit", name="submit", value="approve new identity"),
-			]]
+			return APPROVE_IDENTITY(url=current_identity)
 		else:
-			return tags.div(_class="trustable")[[
-				tags.small()["enter a new identity URL here and click 'approve new identity':"],
-				tags.br(),
-				tags.input(type='text', size="60", name='openid.identity', value=''),
-				tags.input(type="submit", name="submit", value="approve new identity"),
-			]]
+			return NEW_IDENTITY_FORM()
 	
 	def data_openid_fields(self, ctx, data):
 		"""
 		Template function to replicate openid.* form fields.
 		"""
-		request = inevow.IRequest(ctx)
-		requestData = protocol.OpenIDRequest(request)
-		result = []
-		
-		for k, v in requestData.items():
-			if(k.startswith('openid.')):
-				result.append(tags.input(type='hidden', name=k, value=v))
-		
-		return result
+		return render_openid_fields(ctx)
+
+APPROVE_ROOT = template.Fragment(tags.div(_class="trustable")[[
+	tags.small()["click 'approve new root' to verify access to this URL:"],
+	tags.br(),
+	tags.strong()[tags.slot('url')],
+	tags.input(type="submit", name="submit", value="approve new root"),
+]])
+NEW_ROOT_FORM = template.Fragment(tags.div(_class="trustable")[[
+	tags.small()["enter a new root here and click 'approve new root':"],
+	tags.br(),
+	tags.input(type='text', size="60", name='openid.trust_root', value=''),
+	tags.input(type="submit", name="submit", value="approve new root"),
+]])
 
 class TrustPage(AbstractUserPage):
 	"""
 	This page displays the details for the connected user.
 	"""
 	implements(inevow.IResource)
-	docFactory = loaders.xmlfile(get_assets_path('trust-page.xml'))
+	docFactory = template.load('trust-page.xml')
 	
 	@inlineCallbacks
 	def renderHTTP(self, ctx):
@@ -400,26 +468,27 @@ class TrustPage(AbstractUserPage):
 		@see: L{nevow.inevow.IResource}
 		"""
 		request = inevow.IRequest(ctx)
-		requestData = protocol.OpenIDRequest(request)
+		requestData = protocol.parse_request(request)
 		
 		result = yield self.authRedirect(ctx)
 		if(result):
 			returnValue('')
 		
 		if('submit' in requestData):
-			requestData.clear_request()
+			protocol.clear_request(request)
 			if(requestData.get('submit') == 'remove selected'):
-				yield self.removeRoot(requestData)
+				yield self.removeRoot(self.getUser(ctx), requestData)
 			elif(requestData.get('submit') == 'approve new root'):
-				result = yield self.approveRoot(requestData)
-				if(result is not None):
-					returnValue(result)
+				return_to = yield self.approveRoot(self.getUser(ctx), requestData)
+				if(return_to is not None):
+					request.redirect(return_to)
+					returnValue('')
 		
 		result = yield maybeDeferred(super(TrustPage, self).renderHTTP, ctx)
 		returnValue(result)
 	
 	@inlineCallbacks
-	def removeRoot(self, requestData):
+	def removeRoot(self, user, requestData):
 		"""
 		Form support to remove selected roots.
 		"""
@@ -429,25 +498,22 @@ class TrustPage(AbstractUserPage):
 				junk, root_id = k.split('-')
 				root_ids.append(root_id)
 		
-		yield self.pool.removeUserRoots(self.user, root_ids)
+		yield self.pool.removeUserRoots(user, root_ids)
 		returnValue(None)
 	
 	@inlineCallbacks
-	def approveRoot(self, requestData):
+	def approveRoot(self, user, requestData):
 		"""
 		Form support to approve specified root.
+		
+		@return: where to continue the OpenID flow, if anywhere
+		@rtype: str
 		"""
 		root = requestData['openid.trust_root']
-		result = yield self.pool.saveUserRoot(self.user, root)
+		result = yield self.pool.saveUserRoot(user, root)
 		
 		if(requestData.get('openid.mode') not in (None, 'checkid_immediate')):
-			for k, v in requestData.items():
-				if not(k.startswith('openid.')):
-					del requestData[k]
-			
-			return_to = util.appendQuery(protocol.OPENID_PROVIDER_URL, requestData)
-			requestData.request.redirect(return_to)
-			returnValue('')
+			returnValue(util.appendQuery(protocol.OPENID_PROVIDER_URL, requestData.openid_fields()))
 		else:
 			returnValue(None)
 	
@@ -456,53 +522,25 @@ class TrustPage(AbstractUserPage):
 		"""
 		Template function to display a checkbox list of user roots.
 		"""
-		result = yield self.user.getTrustedRoots()
-		output = [tags.h3()['trusted roots'],
-			tags.ul(_class="url-list")[[
-				tags.li()[[
-					tags.input(type='checkbox', name='root-%s' % item['id'], value='1'),
-					item['url'],
-				]]
-				for item in result
-			]]
-		]
-		returnValue(output)
+		result = yield self.getUser(ctx).getTrustedRoots()
+		returnValue(render_url_list('trusted roots', result, 'root-'))
 	
 	def data_new_root(self, ctx, data):
 		"""
 		Template function to display the new root form.
 		"""
-		request = inevow.IRequest(ctx)
-		requestData = protocol.OpenIDRequest(request)
+		requestData = get_request_data(ctx)
 		current_root = requestData.get('openid.trust_root', None)
 		if(current_root):
-			return tags.div(_class="trustable")[[
-				tags.small()["click 'approve new root' to verify access to this URL:"],
-				tags.br(),
-				tags.strong()[current_root],
-				tags.input(type="submit", name="submit", value="approve new root"),
-			]]
+			return APPROVE_ROOT(url=current_root)
 		else:
-			return tags.div(_class="trustable")[[
-				tags.small()["enter a new root here and click 'approve new root':"],
-				tags.br(),
-				tags.input(type='text', size="60", name='openid.trust_root', value=''),
-				tags.input(type="submit", name="submit", value="approve new root"),
-			]]
+			return NEW_ROOT_FORM()
 	
 	def data_openid_fields(self, ctx, data):
 		"""
 		Template function to replicate openid.* form fields.
 		"""
-		request = inevow.IRequest(ctx)
-		requestData = protocol.OpenIDRequest(request)
-		result = []
-		
-		for k, v in requestData.items():
-			if(k.startswith('openid.')):
-				result.append(tags.input(type='hidden', name=k, value=v))
-		
-		return result
+		return render_openid_fields(ctx)
 
 class ProviderPage(AbstractUserPage):
 	"""
@@ -512,55 +550,156 @@ class ProviderPage(AbstractUserPage):
 	implements(inevow.IResource)
 	
 	@inlineCallbacks
+	def authorize(self, ctx, identity, root):
+		"""
+		Authenticate the current session for a checkid request.
+		
+		Instead of separate session, user, identity and trust lookups,
+		this loads the user and their identity and trust status in a
+		single query. Infant sessions aren't in the DB yet, so they
+		go through the usual portal login.
+		
+		@param identity: the requested identity
+		@type identity: str
+		
+		@param root: the requested trust root
+		@type root: str
+		
+		@return: the current user, or None
+		@rtype: L{txopenid.user.User}
+		"""
+		request = inevow.IRequest(ctx)
+		sid = request.getCookie(session.COOKIE_KEY)
+		valid = session.isValidSid(sid)
+		if(valid):
+			infant = yield maybeDeferred(session.INFANT_SESSIONS.get, sid)
+		if not(valid) or infant is not None:
+			user = yield self.authenticate(ctx)
+			returnValue(user)
+		
+		user = yield self.pool.loadAuthorization(sid, identity, root)
+		yield session.updateSession(self.pool, request, user)
+		
+		self.setUser(ctx, user)
+		returnValue(user)
+	
 	def renderHTTP(self, ctx):
 		"""
 		OpenID provider flow begins here.
 		
+		Direct modes are answered immediately by L{renderDirect},
+		everything else goes through L{renderIndirect}.
+		
 		@see: L{nevow.inevow.IResource}
 		"""
 		request = inevow.IRequest(ctx)
-		requestData = protocol.OpenIDRequest(request)
+		requestData = protocol.parse_request(request)
+		mode = requestData.get('openid.mode')
 		
-		yield self.authenticate(ctx)
+		if(session.LAZY_SESSIONS and mode in protocol.DIRECT_MODES):
+			return self.renderDirect(request, requestData, mode)
+		return self.renderIndirect(ctx, requestData, mode)
+	
+	def renderDirect(self, request, requestData, mode):
+		"""
+		Answer a direct (server-to-server) request straight from the registry.
+		
+		These come from the consumer's server, not a browser, so there's
+		no one to keep a session for; the portal login and template
+		rendering are skipped, and the response isn't deferred.
+		
+		@param request: the current request
+		@type request: L{nevow.appserver.NevowRequest}
+		
+		@param requestData: the current request data
+		@type requestData: L{txopenid.protocol.OpenIDRequest}
+		
+		@param mode: the requested mode, one of L{txopenid.protocol.DIRECT_MODES}
+		@type mode: str
+		
+		@return: the response body
+		@rtype: str
+		"""
+		try:
+			output = protocol.DIRECT_MODES[mode](self.portal.realm.registry, requestData)
+		except:
+			output = self.serverError(request, requestData)
+		return self.respond(request, output)
+	
+	@inlineCallbacks
+	def renderIndirect(self, ctx, requestData, mode):
+		"""
+		Answer a request after authenticating the current session.
+		
+		@param requestData: the current request data
+		@type requestData: L{txopenid.protocol.OpenIDRequest}
+		
+		@param mode: the requested mode
+		@type mode: str
+		"""
+		request = inevow.IRequest(ctx)
+		
+		if(mode in ('checkid_immediate', 'checkid_setup')):
+			user = yield self.authorize(ctx, requestData.get('openid.identity'), requestData.get('openid.trust_root'))
+		else:
+			user = yield self.authenticate(ctx)
 		
 		output = False
 		try:
-			mode = requestData.get('openid.mode')
 			registry = self.portal.realm.registry
-			if(mode == 'associate'):
-				output = protocol.associate(registry, requestData)
-			elif(mode == 'checkid_immediate'):
-				output = yield protocol.checkid_immediate(registry, requestData, self.user)
+			if(mode == 'checkid_immediate'):
+				output = yield protocol.checkid_immediate(registry, requestData, user)
 			elif(mode == 'checkid_setup'):
-				output = yield protocol.checkid_setup(registry, requestData, self.user)
-			elif(mode == 'check_authentication'):
-				output = protocol.check_authentication(registry, requestData)
+				output = yield protocol.checkid_setup(registry, requestData, user)
+			elif(mode in protocol.DIRECT_MODES):
+				output = protocol.DIRECT_MODES[mode](registry, requestData)
 			else:
-				output = util.handleError(requestData, "invalid mode '%s' specified" % requestData.get('openid.mode'))
+				output = util.handleError(request, requestData, "invalid mode '%s' specified" % requestData.get('openid.mode'))
 		except:
-			reason = failure.Failure()
-			log.err(reason)
-			
-			# This should really never happen, since the protocol code itself
-			# should attempt to give more informative messages when reasonable
-			output = util.handleError(requestData, "A server error occurred: %s" % reason.getErrorMessage())
+			output = self.serverError(request, requestData)
 		
+		if(output is False):
+			returnValue(super(ProviderPage, self).renderHTTP(ctx))
+		returnValue(self.respond(request, output))
+	
+	def serverError(self, request, requestData):
+		"""
+		Log the current exception, and return an error response for it.
+		"""
+		reason = failure.Failure()
+		log.err(reason)
+		
+		# This should really never happen, since the protocol code itself
+		# should attempt to give more informative messages when reasonable
+		return util.handleError(request, requestData, "A server error occurred: %s" % reason.getErrorMessage())
+	
+	def respond(self, request, output):
+		"""
+		Redirect to the provided URL, or return the provided response body.
+		"""
 		if(isinstance(output, url.URL)):
-			log.msg('REDIRECT: %r' % output)
+			util.debug('[ProviderPage] redirect: %r', output)
 			request.redirect(output)
-			returnValue('')
-		else:
-			if(output is False):
-				returnValue(super(ProviderPage, self).renderHTTP(ctx))
-			log.msg('OUTPUT: %r' % output)
-			returnValue(output)
+			return ''
+		util.debug('[ProviderPage] output: %r', _Redacted(output))
+		return output
+
+LOGGED_IN = template.Fragment(tags.p()[
+	"You have been successfully logged in as ", tags.slot('username'),
+])
+CONSUMER_LOGIN_FORM = template.Fragment(tags.form(method="POST")[[
+	tags.p()['Enter your OpenID identifier to login:'],
+	tags.label(_for="openid-field")["id:"],
+	tags.input(type="text", size="60", name="identity"),
+	tags.input(type="submit", name="submit", value="login"),
+]])
 
 class ConsumerPage(AbstractUserPage):
 	"""
 	This resource allows you to authenticate using an OpenID provider.
 	"""
 	implements(inevow.IResource)
-	docFactory = loaders.xmlfile(get_assets_path('consumer-page.xml'))
+	docFactory = template.load('consumer-page.xml')
 	
 	@inlineCallbacks
 	def renderHTTP(self, ctx):
@@ -570,7 +709,7 @@ class ConsumerPage(AbstractUserPage):
 		@see: L{nevow.inevow.IResource}
 		"""
 		request = inevow.IRequest(ctx)
-		requestData = protocol.OpenIDRequest(request)
+		requestData = protocol.parse_request(request)
 		
 		yield self.authenticate(ctx)
 		
@@ -581,15 +720,8 @@ class ConsumerPage(AbstractUserPage):
 		returnValue(result)
 	
 	def data_login_form(self, ctx, data):
-		if(self.user):
-			result = tags.p()[
-				"You have been successfully logged in as %s" % self.user.username
-			]
+		user = self.getUser(ctx)
+		if(user):
+			return LOGGED_IN(username=user['username'])
 		else:
-			result = tags.form(method="POST")[[
-				tags.p()['Enter your OpenID identifier to login:'],
-				tags.label(_for="openid-field")["id:"],
-				tags.input(type="text", size="60", name="identity"),
-				tags.input(type="submit", name="submit", value="login"),
-			]]
-		return result
+			return CONSUMER_LOGIN_FORM()
@@ -27,51 +27,282 @@ will want to set QUARANTINE_INFANT_SESSIONS to False.
 @var COOKIE_KEY: the session cookie name
 @type COOKIE_KEY: str
 
-@var CLEANUP_CHANCE: the odds that old sessions will be cleanup during this request
-@type CLEANUP_CHANCE: int
-
 @var QUARANTINE_INFANT_SESSIONS: should new sessions be quarantined until they are used a second time?
 @type QUARANTINE_INFANT_SESSIONS: bool
 
 @var INFANT_SESSIONS: holding area for new sessions
-@type INFANT_SESSIONS: dict(str => dict)
+@type INFANT_SESSIONS: L{InfantSessionStore} or L{SharedInfantSessionStore}
 
 @var INFANT_SESSION_TIMEOUT: if a session hasn't been verified in this long, remove it
 @type INFANT_SESSION_TIMEOUT: int
+
+@var LAZY_SESSIONS: should direct (server-to-server) OpenID requests skip sessions entirely?
+@type LAZY_SESSIONS: bool
+
+@var SESSION_WRITER: if set, access time updates are batched through this writer
+@type SESSION_WRITER: L{SessionWriter}
+
+@var TOUCH_INTERVAL: only save a new access time once the stored one is this many seconds old
+@type TOUCH_INTERVAL: int
+
+@var SESSION_CACHE: if set, session records are cached here; any object with
+	memcache-style get/set/delete methods will do, such as a L{txopenid.cache.LRUCache},
+	or a memcache client shared between processes, wrapped in a L{txopenid.cache.ThreadedCache}.
+	An in-process cache must only be used when a single provider process
+	is running, since a logout isn't seen by the other processes until
+	their cached copy of the session times out.
+@type SESSION_CACHE: L{txopenid.cache.LRUCache} or L{txopenid.cache.ThreadedCache}
+
+@var SESSION_CACHE_TIMEOUT: seconds to keep a session record in SESSION_CACHE
+@type SESSION_CACHE_TIMEOUT: int
 """
 
-import time, md5, random, os, thread, threading
+import re, time, heapq
 
 from zope.interface import implements
 
 from twisted.python import log
-from twisted.internet.defer import inlineCallbacks, returnValue, maybeDeferred, Deferred
+from twisted.internet import task
+from twisted.internet.defer import inlineCallbacks, returnValue, maybeDeferred, Deferred, succeed
 from twisted.cred import portal, checkers, credentials
+from twisted.application import service
 
-from nevow import inevow, rend
+from nevow import inevow
 
-from txopenid import db
+from txopenid import db, util
 
 COOKIE_KEY = 'sid'
-CLEANUP_CHANCE = 100
 
 QUARANTINE_INFANT_SESSIONS = True
-INFANT_SESSIONS = {}
 INFANT_SESSION_TIMEOUT = 3600
+LAZY_SESSIONS = True
+
+SESSION_WRITER = None
+TOUCH_INTERVAL = 60
+SESSION_CACHE = None
+SESSION_CACHE_TIMEOUT = 60
+
+class InfantSessionStore(object):
+	"""
+	An in-process holding area for infant sessions.
+	
+	Sessions are grouped into buckets by creation time, so expiring
+	them only touches the buckets that have aged out, rather than
+	every session in the store. A session may outlive
+	INFANT_SESSION_TIMEOUT by up to bucket_size seconds.
+	
+	@ivar maxsize: the most sessions to hold; once full, the oldest are evicted
+	@type maxsize: int
+	
+	@ivar expired: count of sessions removed by L{expire}
+	@type expired: int
+	
+	@ivar evicted: count of sessions discarded to stay under maxsize
+	@type evicted: int
+	"""
+	def __init__(self, timeout=None, bucket_size=60, maxsize=100000):
+		"""
+		Create a new, empty store.
+		
+		@param timeout: seconds to hold a session, or None to use INFANT_SESSION_TIMEOUT
+		@type timeout: int
+		
+		@param bucket_size: span of creation times grouped together, in seconds
+		@type bucket_size: int
+		
+		@param maxsize: the most sessions to hold
+		@type maxsize: int
+		"""
+		self.timeout = timeout
+		self.bucket_size = bucket_size
+		self.maxsize = maxsize
+		self.sessions = {}
+		self.buckets = {}
+		self.heap = []
+		self.expired = 0
+		self.evicted = 0
+	
+	def get(self, sid, default=None):
+		"""
+		Return the infant session with the provided ID, or default.
+		"""
+		return self.sessions.get(sid, default)
+	
+	def pop(self, sid, default=None):
+		"""
+		Remove and return the infant session with the provided ID, or default.
+		"""
+		session = self.sessions.pop(sid, None)
+		if(session is None):
+			return default
+		self.buckets[self._bucket(session)].discard(sid)
+		return session
+	
+	def expire(self, now=None):
+		"""
+		Remove any sessions older than the timeout.
+		
+		@param now: the current time, defaults to time.time()
+		@type now: int
+		
+		@return: the number of sessions removed
+		@rtype: int
+		"""
+		if(now is None):
+			now = time.time()
+		timeout = self.timeout
+		if(timeout is None):
+			timeout = INFANT_SESSION_TIMEOUT
+		cutoff = (now - timeout) // self.bucket_size
+		count = 0
+		while(self.heap and self.heap[0] < cutoff):
+			for sid in self.buckets.pop(heapq.heappop(self.heap)):
+				util.debug('Expiring infant session %s', sid)
+				del self.sessions[sid]
+				count += 1
+		self.expired += count
+		return count
+	
+	def stats(self):
+		"""
+		Return size, expiry and eviction counters.
+		
+		@rtype: dict(str => int)
+		"""
+		return dict(
+			size	= len(self.sessions),
+			expired	= self.expired,
+			evicted	= self.evicted,
+		)
+	
+	def _bucket(self, session):
+		return int(session['created']) // self.bucket_size
+	
+	def set(self, sid, session):
+		"""
+		Hold the provided session until it's used again, or expires.
+		"""
+		self.pop(sid)
+		bucket = self._bucket(session)
+		if(bucket not in self.buckets):
+			self.buckets[bucket] = set()
+			heapq.heappush(self.heap, bucket)
+		self.buckets[bucket].add(sid)
+		self.sessions[sid] = session
+		
+		while(len(self.sessions) > self.maxsize):
+			oldest = self.buckets[self.heap[0]]
+			if not(oldest):
+				del self.buckets[heapq.heappop(self.heap)]
+				continue
+			del self.sessions[oldest.pop()]
+			self.evicted += 1
+	
+	def __setitem__(self, sid, session):
+		self.set(sid, session)
+	
+	def __getitem__(self, sid):
+		return self.sessions[sid]
+	
+	def __delitem__(self, sid):
+		if(self.pop(sid) is None):
+			raise KeyError(sid)
+	
+	def __contains__(self, sid):
+		return sid in self.sessions
+	
+	def __len__(self):
+		return len(self.sessions)
+
+class SharedInfantSessionStore(object):
+	"""
+	Keep infant sessions in a cache shared between provider processes.
+	
+	Any object with memcache-style get/set/delete methods will do; the
+	cache is responsible for expiring (and evicting) sessions itself.
+	A memcache client should be wrapped in a L{txopenid.cache.ThreadedCache},
+	so it doesn't block the reactor.
+	
+	Unlike L{InfantSessionStore}, every method returns a Deferred, so
+	callers use L{maybeDeferred} to accept either kind of store.
+	Malformed session IDs are never looked up.
+	
+	@ivar client: the shared cache
+	@type client: L{txopenid.cache.ThreadedCache}
+	"""
+	def __init__(self, client, timeout=None):
+		"""
+		Create a store using the provided cache client.
+		
+		@param timeout: seconds to hold a session, or None to use INFANT_SESSION_TIMEOUT
+		@type timeout: int
+		"""
+		self.client = client
+		self.timeout = timeout
+	
+	@inlineCallbacks
+	def get(self, sid, default=None):
+		"""
+		Return the infant session with the provided ID, or default.
+		"""
+		session = None
+		if(isValidSid(sid)):
+			session = yield maybeDeferred(self.client.get, 'infant:' + sid)
+		if(session is None):
+			returnValue(default)
+		returnValue(session)
+	
+	@inlineCallbacks
+	def pop(self, sid, default=None):
+		"""
+		Remove and return the infant session with the provided ID, or default.
+		"""
+		session = yield self.get(sid)
+		if(session is None):
+			returnValue(default)
+		yield maybeDeferred(self.client.delete, 'infant:' + sid)
+		returnValue(session)
+	
+	def set(self, sid, session):
+		"""
+		Hold the provided session until it's used again, or expires.
+		
+		@raise ValueError: if the session ID is malformed
+		"""
+		if not(isValidSid(sid)):
+			raise ValueError("invalid session id: %r" % sid)
+		timeout = self.timeout
+		if(timeout is None):
+			timeout = INFANT_SESSION_TIMEOUT
+		return maybeDeferred(self.client.set, 'infant:' + sid, session, time=timeout)
+	
+	def expire(self, now=None):
+		"""
+		Sessions are expired by the cache, so there's nothing to do here.
+		
+		@return: 0
+		@rtype: int
+		"""
+		return 0
+
+INFANT_SESSIONS = InfantSessionStore()
+
+_SID_PATTERN = re.compile(r'[0-9a-f]{32}\Z')
 
 def createSessionCookie(request):
 	"""
-	Make a number based on current time, pid, remote ip
-	and two random ints, then hash with md5. This should
-	be fairly unique and very difficult to guess.
+	Make a new session id from 128 random bits, as 32 hex digits.
 	"""
-	t = long(time.time()*10000)
-	pid = os.getpid()
-	rnd1 = random.randint(0, 999999999)
-	rnd2 = random.randint(0, 999999999)
-	ip = request.getClientIP()
+	return util.hextoken(16)
+
+def isValidSid(sid):
+	"""
+	Is the provided session ID in the format made by L{createSessionCookie}?
 	
-	return md5.new("%d%d%d%d%s" % (t, pid, rnd1, rnd2, ip)).hexdigest()
+	Session IDs come from a cookie, and are used in cache keys and
+	queries, so anything else is ignored before it gets that far.
+	"""
+	return bool(sid) and _SID_PATTERN.match(sid) is not None
 
 @inlineCallbacks
 def destroySession(pool, request):
@@ -84,6 +315,9 @@ def destroySession(pool, request):
 	if(sid):
 		date = time.strftime("%a, %d-%b-%Y %H:%M:%S GMT", time.gmtime(time.time() - 86400))
 		request.addCookie(COOKIE_KEY, '', path='/', expires=date)
+	if(isValidSid(sid)):
+		if(SESSION_CACHE is not None):
+			yield maybeDeferred(SESSION_CACHE.delete, 'session:' + sid)
 		yield pool.destroySession(sid)
 	
 	returnValue(None)
@@ -99,6 +333,10 @@ def updateSession(pool, request, user=None):
 	updateSession is also responsible for setting the session cookie
 	if it doesn't yet exist.
 	
+	Only changed columns are written, and a change to the access time
+	alone isn't written until the stored value is more than
+	TOUCH_INTERVAL seconds old.
+	
 	@param pool: the database connection to use.
 	@type pool: L{txopenid.db.Connection}
 	
@@ -109,15 +347,13 @@ def updateSession(pool, request, user=None):
 	@type user: L{txopenid.user.User}
 	"""
 	sid = request.getCookie(COOKIE_KEY)
-	if not(sid):
+	if not(isValidSid(sid)):
 		sid = createSessionCookie(request)
 		request.addCookie(COOKIE_KEY, sid, path='/')
 	
-	if(sid in INFANT_SESSIONS):
-		session = INFANT_SESSIONS[sid]
-		del INFANT_SESSIONS[sid]
-	else:
-		session = yield pool.loadSession(sid)
+	session = yield maybeDeferred(INFANT_SESSIONS.pop, sid)
+	if(session is None):
+		session = yield loadSession(pool, sid)
 	
 	if(session and session['accessed'] - session['created'] > session['timeout']):
 		destroySession(pool, request)
@@ -126,6 +362,7 @@ def updateSession(pool, request, user=None):
 		user = None
 		session = None
 	
+	infant = False
 	if not(session):
 		session = dict(
 			id = sid,
@@ -135,20 +372,77 @@ def updateSession(pool, request, user=None):
 			data = None,
 			_new = True
 		)
-		if(QUARANTINE_INFANT_SESSIONS):
-			INFANT_SESSIONS[sid] = session
+		infant = QUARANTINE_INFANT_SESSIONS
 	
-	session['accessed'] = int(time.time())
-	if(user and user['id']):
+	now = int(time.time())
+	last_accessed = session.get('accessed', 0)
+	session['accessed'] = now
+	session['expires_at'] = now + session['timeout']
+	user_changed = False
+	if(user and user['id'] and session['user_id'] != user['id']):
 		session['user_id'] = user['id']
+		user_changed = True
 	
-	if(sid not in INFANT_SESSIONS):
+	if(infant):
+		yield maybeDeferred(INFANT_SESSIONS.set, sid, session)
+	elif(session.get('_new')):
 		yield pool.saveSession(session)
+		yield _cacheSession(session)
+	elif(user_changed):
+		yield pool.saveSession(session, ['user_id', 'accessed', 'expires_at'])
+		yield _cacheSession(session)
+	elif(now - last_accessed >= TOUCH_INTERVAL):
+		if(SESSION_WRITER is not None):
+			SESSION_WRITER.touch(sid, now)
+		else:
+			yield pool.saveSession(session, ['accessed', 'expires_at'])
+		yield _cacheSession(session)
+
+@inlineCallbacks
+def loadSession(pool, sid):
+	"""
+	Return the stored session record for the provided session ID.
+	
+	If SESSION_CACHE is set, it's checked first, and records loaded
+	from the DB are added to it.
+	
+	@param pool: the database connection to use.
+	@type pool: L{txopenid.db.Connection}
+	
+	@param sid: the session ID
+	@type sid: str
+	
+	@return: a copy of the session record, or None
+	@rtype: dict
+	"""
+	if not(isValidSid(sid)):
+		returnValue(None)
+	
+	if(SESSION_CACHE is None):
+		session = yield pool.loadSession(sid)
+		returnValue(session)
 	
-	if(random.randint(1, CLEANUP_CHANCE) == 1):
-		_cleanupInfantSessions()
-		log.msg('Expiring abandoned sessions')
-		pool.cleanupSessions()
+	session = yield maybeDeferred(SESSION_CACHE.get, 'session:' + sid)
+	if(session is None):
+		session = yield pool.loadSession(sid)
+		if(session):
+			yield _cacheSession(session)
+	
+	if(session):
+		returnValue(dict(session))
+	returnValue(None)
+
+def _cacheSession(session):
+	"""
+	Put a copy of the provided (stored) session record in SESSION_CACHE.
+	
+	@return: a Deferred firing once the record is cached
+	"""
+	if(SESSION_CACHE is None):
+		return succeed(None)
+	record = dict(session)
+	record.pop('_new', None)
+	return maybeDeferred(SESSION_CACHE.set, 'session:' + session['id'], record, time=SESSION_CACHE_TIMEOUT)
 
 def getSessionCredentials(ctx):
 	"""
@@ -162,7 +456,7 @@ def getSessionCredentials(ctx):
 	"""
 	request = inevow.IRequest(ctx)
 	cookie = request.getCookie(COOKIE_KEY)
-	if(cookie):
+	if(isValidSid(cookie)):
 		creds = SessionCredentials(cookie)
 	else:
 		creds = credentials.Anonymous()
@@ -170,12 +464,12 @@ def getSessionCredentials(ctx):
 
 def _cleanupInfantSessions():
 	"""
-	Iterate through the infant session cache and remove expired sessions.
+	Remove expired sessions from the infant session store.
+	
+	@return: the number of sessions removed
+	@rtype: int
 	"""
-	for sid, session in INFANT_SESSIONS.items():
-		if(time.time() - session['created'] > INFANT_SESSION_TIMEOUT):
-			log.msg('Expiring infant session %s' % sid)
-			del INFANT_SESSIONS[sid]
+	return INFANT_SESSIONS.expire()
 
 class SessionRealm(object):
 	"""
@@ -300,10 +594,22 @@ class SessionChecker(object):
 		@rtype: int
 		"""
 		sid = creds.getSid()
-		if(sid in INFANT_SESSIONS):
-			returnValue(INFANT_SESSIONS[sid]['user_id'])
+		if not(isValidSid(sid)):
+			returnValue(checkers.ANONYMOUS)
+		
+		infant = yield maybeDeferred(INFANT_SESSIONS.get, sid)
+		if(infant is not None):
+			returnValue(infant['user_id'])
 		
-		result = yield self.pool.verifySession(sid)
+		if(SESSION_CACHE is not None):
+			# the same record will be needed by updateSession
+			session = yield loadSession(self.pool, sid)
+			if(session and session['accessed'] - session['created'] < session['timeout']):
+				result = session['user_id']
+			else:
+				result = None
+		else:
+			result = yield self.pool.verifySession(sid)
 		if(result):
 			returnValue(result)
 		else:
@@ -325,3 +631,172 @@ class SessionChecker(object):
 			returnValue(result)
 		else:
 			returnValue(checkers.ANONYMOUS)
+
+class SessionWriter(service.Service):
+	"""
+	Coalesce session access time updates in memory, and write them
+	to the DB in batches.
+	
+	Requests that only touch a session would otherwise each issue
+	their own UPDATE; instead, only the latest access time for each
+	session is kept, and they are all written every C{interval} seconds.
+	
+	@ivar pool: the current database connection
+	@type pool: L{txopenid.db.Connection}
+	
+	@ivar interval: seconds between writes
+	@type interval: float
+	
+	@ivar pending: access times waiting to be written
+	@type pending: dict(str => int)
+	"""
+	def __init__(self, pool, interval=0.5):
+		"""
+		Create a new session writer.
+		
+		@param pool: the current database connection
+		@type pool: L{txopenid.db.Connection}
+		
+		@param interval: seconds between writes
+		@type interval: float
+		"""
+		self.pool = pool
+		self.interval = interval
+		self.pending = {}
+		self.loop = None
+	
+	def touch(self, sid, accessed):
+		"""
+		Record a new access time for the provided session.
+		
+		@param sid: the session ID
+		@type sid: str
+		
+		@param accessed: the new access time
+		@type accessed: int
+		"""
+		self.pending[sid] = accessed
+	
+	def flush(self):
+		"""
+		Write all pending access times.
+		
+		If the write fails, the access times are kept for the next
+		attempt, unless they've been superseded in the meantime.
+		"""
+		if not(self.pending):
+			return succeed(None)
+		
+		batch = self.pending
+		self.pending = {}
+		
+		def _failed(reason):
+			log.err(reason, 'Failed to write %d session access times' % len(batch))
+			for sid, accessed in batch.items():
+				self.pending.setdefault(sid, accessed)
+		
+		d = self.pool.touchSessions(batch)
+		d.addErrback(_failed)
+		return d
+	
+	def startService(self):
+		service.Service.startService(self)
+		self.loop = task.LoopingCall(self.flush)
+		self.loop.start(self.interval, now=False)
+	
+	def stopService(self):
+		service.Service.stopService(self)
+		if(self.loop is not None and self.loop.running):
+			self.loop.stop()
+		return self.flush()
+
+class SessionReaper(service.Service):
+	"""
+	Periodically remove expired sessions, off the request path.
+	
+	Expired sessions are deleted in chunks of at most C{chunk_size} rows,
+	using the indexed expires_at column, and no more than C{max_chunks}
+	chunks are deleted per pass, so a large backlog is worked off over
+	several passes instead of locking up the session table.
+	
+	@ivar passes: number of completed passes
+	@type passes: int
+	
+	@ivar reaped: number of stored sessions removed
+	@type reaped: int
+	
+	@ivar infants_reaped: number of infant sessions removed
+	@type infants_reaped: int
+	
+	@ivar last_duration: seconds taken by the most recent pass
+	@type last_duration: float
+	"""
+	def __init__(self, pool, interval=60, chunk_size=1000, max_chunks=10):
+		"""
+		Create a new session reaper.
+		
+		@param pool: the current database connection
+		@type pool: L{txopenid.db.Connection}
+		
+		@param interval: seconds between passes
+		@type interval: float
+		
+		@param chunk_size: the most sessions to delete per statement
+		@type chunk_size: int
+		
+		@param max_chunks: the most statements to run per pass
+		@type max_chunks: int
+		"""
+		self.pool = pool
+		self.interval = interval
+		self.chunk_size = chunk_size
+		self.max_chunks = max_chunks
+		self.loop = None
+		
+		self.passes = 0
+		self.reaped = 0
+		self.infants_reaped = 0
+		self.last_duration = 0.0
+	
+	@inlineCallbacks
+	def reap(self):
+		"""
+		Run one pass, removing expired infant and stored sessions.
+		
+		@return: the number of stored sessions removed
+		@rtype: int
+		"""
+		started = time.time()
+		self.infants_reaped += _cleanupInfantSessions()
+		
+		count = 0
+		for chunk in range(self.max_chunks):
+			removed = yield self.pool.reapSessions(self.chunk_size)
+			count += removed
+			if(removed < self.chunk_size):
+				break
+		
+		self.reaped += count
+		self.passes += 1
+		self.last_duration = time.time() - started
+		if(count):
+			util.info('Expired %d abandoned sessions', count)
+		returnValue(count)
+	
+	def _reap(self):
+		"""
+		Run a pass from the timer, logging (rather than propagating) failures.
+		"""
+		d = self.reap()
+		d.addErrback(log.err, 'Failed to expire abandoned sessions')
+		return d
+	
+	def startService(self):
+		service.Service.startService(self)
+		self.loop = task.LoopingCall(self._reap)
+		self.loop.start(self.interval, now=False)
+	
+	def stopService(self):
+		service.Service.stopService(self)
+		if(self.loop is not None and self.loop.running):
+			self.loop.stop()
@@ -0,0 +1,549 @@
+# txopenid
+# Copyright (c) 2007 Phil Christensen
+#
+# See LICENSE for details
+
+"""
+Association storage.
+
+An L{txopenid.protocol.OpenIDRegistry} keeps its smart and dumb associations
+in a pair of association stores. The default L{MemoryAssociationStore} is
+private to the current process, which is fine for a single provider, but
+means that a check_authentication request will fail if it arrives at a
+different process than the one that minted the handle.
+
+L{SQLiteAssociationStore} keeps associations in a database file instead,
+so provider processes on one host pointed at the same file will share
+the same associations. Its queries block the reactor thread, and every
+write locks the whole file, so it's only suitable for low-volume
+providers; busier ones should use a L{StatelessAssociationStore}.
+
+L{StatelessAssociationStore} doesn't keep associations at all. Instead,
+each handle carries its own creation time, lifetime and type, sealed with
+a key derived from a L{MasterKey} that all provider processes share, and
+the association secret is derived from the same key.
+
+@var STATELESS_HANDLE_VERSION: format version of stateless handles
+@type STATELESS_HANDLE_VERSION: int
+
+@var STATELESS_ASSOC_TYPES: association types encodable in a stateless handle
+@type STATELESS_ASSOC_TYPES: dict(str => int)
+"""
+
+import sqlite3, struct, hmac, hashlib, base64, binascii, time, os, heapq
+
+from zope.interface import Interface, implements
+
+from txopenid import util
+
+STATELESS_HANDLE_VERSION = 1
+STATELESS_ASSOC_TYPES = {
+	'HMAC-SHA1'		: 1,
+	'HMAC-SHA256'	: 2,
+}
+
+_STATELESS_HANDLE_FORMAT = '>BBBIII8s'
+_STATELESS_HANDLE_SIZE = struct.calcsize(_STATELESS_HANDLE_FORMAT)
+_STATELESS_BANKS = ('dumb', 'smart')
+
+class IAssociationStore(Interface):
+	"""
+	I hold L{txopenid.protocol.OpenIDAssociation} objects by handle.
+	"""
+	def create(requestData, assoc_type):
+		"""
+		Create, save and return a new association.
+		
+		@param requestData: the current request
+		@type requestData: L{txopenid.protocol.OpenIDRequest}
+		
+		@param assoc_type: the association type, e.g., 'HMAC-SHA1'
+		@type assoc_type: str
+		
+		@return: the new association
+		@rtype: L{txopenid.protocol.OpenIDAssociation}
+		"""
+	
+	def get(handle):
+		"""
+		Return the association for the provided handle.
+		
+		@param handle: the association handle
+		@type handle: str
+		
+		@return: the association, or None if not found
+		@rtype: L{txopenid.protocol.OpenIDAssociation}
+		"""
+	
+	def save(association):
+		"""
+		Add (or replace) the provided association.
+		
+		@param association: the association to save
+		@type association: L{txopenid.protocol.OpenIDAssociation}
+		"""
+	
+	def remove(handle):
+		"""
+		Remove the association for the provided handle, if any.
+		
+		@param handle: the association handle
+		@type handle: str
+		"""
+	
+	def expire(now=None):
+		"""
+		Remove associations that expired before the provided time.
+		
+		@param now: the current time, defaults to time.time()
+		@type now: float
+		
+		@return: the number of associations removed
+		@rtype: int
+		"""
+	
+	def __contains__(handle):
+		"""
+		Is there an association for the provided handle?
+		"""
+	
+	def __len__():
+		"""
+		Return the number of stored associations.
+		"""
+
+class MemoryAssociationStore(object):
+	"""
+	Keep associations in a dict local to this process.
+	
+	Expiry deadlines are kept in a heap, so L{expire} only has to look at
+	associations that have actually expired. If C{maxsize} is set, saving
+	a new association past that limit evicts the associations closest to
+	expiry.
+	
+	@ivar maxsize: the most associations to keep, or None for no limit
+	@type maxsize: int
+	
+	@ivar expired: count of associations removed by L{expire}
+	@type expired: int
+	
+	@ivar evicted: count of associations removed to stay under C{maxsize}
+	@type evicted: int
+	"""
+	implements(IAssociationStore)
+	
+	def __init__(self, maxsize=None):
+		"""
+		Create a new, empty association store.
+		
+		@param maxsize: the most associations to keep, or None for no limit
+		@type maxsize: int
+		"""
+		self.maxsize = maxsize
+		self.associations = {}
+		self.deadlines = {}
+		self.heap = []
+		self.expired = 0
+		self.evicted = 0
+	
+	def create(self, requestData, assoc_type):
+		"""
+		@see: L{IAssociationStore.create}
+		"""
+		from txopenid import protocol
+		association = protocol.OpenIDAssociation(assoc_type)
+		self.save(association)
+		return association
+	
+	def get(self, handle):
+		"""
+		@see: L{IAssociationStore.get}
+		"""
+		return self.associations.get(handle)
+	
+	def save(self, association):
+		"""
+		@see: L{IAssociationStore.save}
+		"""
+		handle = association.handle
+		deadline = association.expires
+		self.associations[handle] = association
+		self.deadlines[handle] = deadline
+		heapq.heappush(self.heap, (deadline, handle))
+		
+		if(self.maxsize is not None):
+			while(len(self.associations) > self.maxsize):
+				if(self._pop() is not None):
+					self.evicted += 1
+	
+	def remove(self, handle):
+		"""
+		@see: L{IAssociationStore.remove}
+		"""
+		if(self.associations.pop(handle, None) is not None):
+			del self.deadlines[handle]
+			# removed entries stay in the heap until their deadline;
+			# rebuild it if they start to outnumber the live ones
+			if(len(self.heap) > 2 * len(self.associations) + 64):
+				self.heap = [(d, h) for h, d in self.deadlines.items()]
+				heapq.heapify(self.heap)
+	
+	def expire(self, now=None):
+		"""
+		@see: L{IAssociationStore.expire}
+		"""
+		if(now is None):
+			now = time.time()
+		count = 0
+		while(self.heap and self.heap[0][0] <= now):
+			if(self._pop() is not None):
+				count += 1
+		self.expired += count
+		return count
+	
+	def _pop(self):
+		"""
+		Remove the association with the earliest deadline.
+		
+		@return: the removed handle, or None if the heap entry was stale
+		"""
+		deadline, handle = heapq.heappop(self.heap)
+		if(self.deadlines.get(handle) != deadline):
+			return None
+		del self.associations[handle]
+		del self.deadlines[handle]
+		return handle
+	
+	def __contains__(self, handle):
+		return handle in self.associations
+	
+	def __len__(self):
+		return len(self.associations)
+
+class SQLiteAssociationStore(object):
+	"""
+	Keep associations in a SQLite database file.
+	
+	Several stores (in one or many processes) may share a single file;
+	the C{bank} name keeps smart and dumb associations apart.
+	
+	Every call runs its query synchronously, on the calling (reactor)
+	thread, and waits up to C{timeout} seconds for another process's
+	lock. That's acceptable for a low-volume provider on a single host,
+	but nothing more; use a L{StatelessAssociationStore} otherwise.
+	
+	@ivar bank: the name of the association bank, e.g., 'smart' or 'dumb'
+	@type bank: str
+	"""
+	implements(IAssociationStore)
+	
+	def __init__(self, path, bank, timeout=10):
+		"""
+		Open (and if necessary, create) the association database.
+		
+		@param path: path to the database file
+		@type path: str
+		
+		@param bank: the name of the association bank
+		@type bank: str
+		
+		@param timeout: seconds to wait on a lock held by another process
+		@type timeout: int
+		"""
+		self.bank = bank
+		self.conn = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+		self.conn.execute("CREATE TABLE IF NOT EXISTS association ("
+							"bank TEXT NOT NULL, "
+							"handle TEXT NOT NULL, "
+							"assoc_type TEXT NOT NULL, "
+							"secret BLOB NOT NULL, "
+							"created INTEGER NOT NULL, "
+							"expires_in INTEGER NOT NULL, "
+							"expires INTEGER NOT NULL, "
+							"PRIMARY KEY (bank, handle))")
+		self._upgrade()
+		self.conn.execute("CREATE INDEX IF NOT EXISTS association_expiry_idx ON association (bank, expires)")
+	
+	def _upgrade(self):
+		"""
+		Add the expires column to a database file made before it existed.
+		
+		@see: docs/migrate-association-expires.sqlite
+		"""
+		self.conn.execute("BEGIN IMMEDIATE")
+		try:
+			columns = [row[1] for row in self.conn.execute("PRAGMA table_info(association)")]
+			if('expires' not in columns):
+				self.conn.execute("ALTER TABLE association ADD COLUMN expires INTEGER NOT NULL DEFAULT 0")
+				self.conn.execute("UPDATE association SET expires = created + expires_in")
+		except:
+			self.conn.execute("ROLLBACK")
+			raise
+		self.conn.execute("COMMIT")
+	
+	def create(self, requestData, assoc_type):
+		"""
+		@see: L{IAssociationStore.create}
+		"""
+		from txopenid import protocol
+		association = protocol.OpenIDAssociation(assoc_type)
+		self.save(association)
+		return association
+	
+	def get(self, handle):
+		"""
+		@see: L{IAssociationStore.get}
+		"""
+		if(handle is None):
+			return None
+		
+		association_query = ("SELECT assoc_type, secret, created, expires_in FROM association "
+							"WHERE bank = ? AND handle = ?")
+		row = self.conn.execute(association_query, [self.bank, handle]).fetchone()
+		if(row is None):
+			return None
+		
+		from txopenid import protocol
+		assoc_type, secret, created, expires_in = row
+		return protocol.OpenIDAssociation(str(assoc_type), str(handle), str(secret), created, expires_in)
+	
+	def save(self, association):
+		"""
+		@see: L{IAssociationStore.save}
+		"""
+		association_operation = ("INSERT OR REPLACE INTO association "
+								"(bank, handle, assoc_type, secret, created, expires_in, expires) "
+								"VALUES (?, ?, ?, ?, ?, ?, ?)")
+		self.conn.execute(association_operation, [self.bank, association.handle,
+			association.assoc_type, sqlite3.Binary(association.secret),
+			association.created, association.expires_in, association.expires])
+	
+	def remove(self, handle):
+		"""
+		@see: L{IAssociationStore.remove}
+		"""
+		self.conn.execute("DELETE FROM association WHERE bank = ? AND handle = ?", [self.bank, handle])
+	
+	def expire(self, now=None):
+		"""
+		@see: L{IAssociationStore.expire}
+		"""
+		if(now is None):
+			now = time.time()
+		cursor = self.conn.execute("DELETE FROM association WHERE bank = ? AND expires <= ?", [self.bank, now])
+		return cursor.rowcount
+	
+	def __contains__(self, handle):
+		row = self.conn.execute("SELECT 1 FROM association WHERE bank = ? AND handle = ?", [self.bank, handle]).fetchone()
+		return row is not None
+	
+	def __len__(self):
+		return self.conn.execute("SELECT COUNT(*) FROM association WHERE bank = ?", [self.bank]).fetchone()[0]
+
+class MasterKey(object):
+	"""
+	A server master secret, from which a new signing key is derived
+	every C{interval} seconds.
+	
+	Since the derived keys only depend on the master secret and the
+	clock, every process sharing the master secret rotates to the same
+	key at the same time, without any coordination.
+	
+	@ivar interval: seconds between key rotations
+	@type interval: int
+	
+	@ivar retain: how many previous keys are still accepted
+	@type retain: int
+	"""
+	def __init__(self, secret, interval=86400, retain=1):
+		"""
+		Create a new master key.
+		
+		@param secret: the shared master secret
+		@type secret: str
+		
+		@param interval: seconds between key rotations
+		@type interval: int
+		
+		@param retain: how many previous keys are still accepted; this
+			should cover the lifetime of an association.
+		@type retain: int
+		"""
+		self.secret = secret
+		self.interval = interval
+		self.retain = retain
+		self.keys = {}
+	
+	@classmethod
+	def fromFile(cls, path, **kwargs):
+		"""
+		Load the master secret from the provided file.
+		
+		The file is created with a new random secret if it doesn't exist.
+		"""
+		if not(os.path.exists(path)):
+			f = os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600), 'w')
+			try:
+				f.write(binascii.hexlify(os.urandom(32)))
+			finally:
+				f.close()
+		f = open(path)
+		try:
+			secret = binascii.unhexlify(f.read().strip())
+		finally:
+			f.close()
+		return cls(secret, **kwargs)
+	
+	def epoch(self, now=None):
+		"""
+		Return the key epoch for the provided time (default now).
+		"""
+		if(now is None):
+			now = time.time()
+		return int(now) // self.interval
+	
+	def getKey(self, epoch):
+		"""
+		Return the derived key for the provided epoch.
+		
+		@return: the key, or None if the epoch is no longer (or not yet) valid
+		@rtype: str
+		"""
+		current = self.epoch()
+		if(epoch > current or epoch < current - self.retain):
+			return None
+		if(epoch not in self.keys):
+			for old in [e for e in self.keys if e < current - self.retain]:
+				del self.keys[old]
+			self.keys[epoch] = hmac.new(self.secret, 'epoch:%d' % epoch, hashlib.sha256).digest()
+		return self.keys[epoch]
+
+class StatelessAssociationStore(object):
+	"""
+	Encode associations into their handles instead of storing them.
+	
+	Handles are the base64 encoding of a packed header (version, bank,
+	association type, key epoch, creation time, lifetime and a random
+	nonce) followed by a MAC of that header. The association secret is
+	derived from the epoch key and the header, so validating a handle
+	needs no lookup and no memory.
+	
+	Stateless associations can't be revoked; L{remove} does nothing and
+	handles simply stop working when they expire.
+	
+	@ivar master_key: the source of handle signing keys
+	@type master_key: L{MasterKey}
+	
+	@ivar bank: the name of the association bank, e.g., 'smart' or 'dumb'
+	@type bank: str
+	"""
+	implements(IAssociationStore)
+	
+	def __init__(self, master_key, bank, expires_in=86400):
+		"""
+		Create a new stateless association store.
+		
+		@param master_key: the source of handle signing keys
+		@type master_key: L{MasterKey}
+		
+		@param bank: the name of the association bank, 'smart' or 'dumb'
+		@type bank: str
+		
+		@param expires_in: lifetime of new associations, in seconds
+		@type expires_in: int
+		"""
+		self.master_key = master_key
+		self.bank = bank
+		self.bank_code = _STATELESS_BANKS.index(bank)
+		self.expires_in = expires_in
+	
+	def _seal(self, key, header, assoc_type):
+		"""
+		Return the MAC and association secret for the provided header.
+		
+		The secret is as long as the association type's digest.
+		"""
+		mac = hmac.new(key, 'handle:' + header, hashlib.sha1).digest()
+		secret = hmac.new(key, 'secret:' + header, util.get_hash(assoc_type)).digest()
+		return mac, secret
+	
+	def create(self, requestData, assoc_type):
+		"""
+		@see: L{IAssociationStore.create}
+		"""
+		if(assoc_type not in STATELESS_ASSOC_TYPES):
+			raise NotImplementedError("invalid assoc_handle type: %s" % assoc_type)
+		
+		now = int(time.time())
+		epoch = self.master_key.epoch(now)
+		header = struct.pack(_STATELESS_HANDLE_FORMAT, STATELESS_HANDLE_VERSION, self.bank_code,
+			STATELESS_ASSOC_TYPES[assoc_type], epoch, now, self.expires_in, os.urandom(8))
+		mac, secret = self._seal(self.master_key.getKey(epoch), header, assoc_type)
+		
+		from txopenid import protocol
+		return protocol.OpenIDAssociation(assoc_type, base64.b64encode(header + mac), secret, now, self.expires_in)
+	
+	def get(self, handle):
+		"""
+		@see: L{IAssociationStore.get}
+		"""
+		if(handle is None):
+			return None
+		try:
+			raw = base64.b64decode(handle)
+		except (TypeError, binascii.Error):
+			return None
+		
+		header = raw[:_STATELESS_HANDLE_SIZE]
+		if(len(header) != _STATELESS_HANDLE_SIZE):
+			return None
+		
+		version, bank_code, type_code, epoch, created, expires_in, nonce = struct.unpack(
+			_STATELESS_HANDLE_FORMAT, header)
+		if(version != STATELESS_HANDLE_VERSION or bank_code != self.bank_code):
+			return None
+		
+		key = self.master_key.getKey(epoch)
+		if(key is None):
+			return None
+		
+		for assoc_type, code in STATELESS_ASSOC_TYPES.items():
+			if(code == type_code):
+				break
+		else:
+			return None
+		
+		mac, secret = self._seal(key, header, assoc_type)
+		if not(util.compare_digest(raw[len(header):], mac)):
+			return None
+		
+		from txopenid import protocol
+		return protocol.OpenIDAssociation(assoc_type, handle, secret, created, expires_in)
+	
+	def save(self, association):
+		"""
+		Stateless associations are never saved.
+		
+		@see: L{IAssociationStore.save}
+		"""
+	
+	def remove(self, handle):
+		"""
+		Stateless associations can't be removed; they just expire.
+		
+		@see: L{IAssociationStore.remove}
+		"""
+	
+	def expire(self, now=None):
+		"""
+		There is nothing to expire.
+		
+		@see: L{IAssociationStore.expire}
+		"""
+		return 0
+	
+	def __contains__(self, handle):
+		return self.get(handle) is not None
+	
+	def __len__(self):
+		return 0
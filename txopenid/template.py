@@ -0,0 +1,87 @@
+# txopenid
+# Copyright (c) 2007 Phil Christensen
+#
+# See LICENSE for details
+
+"""
+Precompiled page templates and markup fragments.
+
+Page templates are parsed and precompiled once, when first loaded,
+into flattened static markup and the directives for their dynamic
+parts. Fragments do the same for the markup built by template functions,
+so only the slot values are escaped and joined per request.
+"""
+
+import os, cgi
+
+from nevow import loaders, flat, tags
+
+from txopenid import assets, webroot
+
+ASSETS_PATH = os.path.dirname(os.path.abspath(assets.__file__))
+
+def load(name):
+	"""
+	Return a precompiled document factory for the named template.
+	
+	Unlike L{nevow.loaders.xmlfile}, the file isn't checked for changes
+	on every request. Links to assets are rewritten to their
+	fingerprinted URLs.
+	
+	@param name: a template filename in the assets directory
+	@type name: str
+	
+	@rtype: L{nevow.loaders.xmlstr}
+	"""
+	template = open(os.path.join(ASSETS_PATH, name)).read()
+	for asset_name, asset in webroot.get_assets().items():
+		if(asset_name == asset.name):
+			template = template.replace('"%s%s"' % (webroot.ASSETS_URL, asset_name), '"%s"' % webroot.url(asset_name))
+	docFactory = loaders.xmlstr(template)
+	docFactory.load()
+	return docFactory
+
+class Fragment(object):
+	"""
+	A piece of markup flattened once, with named slots filled per render.
+	
+	Slot values are escaped, unless they're already markup (L{nevow.tags.xml}).
+	
+	@ivar chunks: static markup, interleaved with slot directives
+	@type chunks: list
+	"""
+	def __init__(self, stan):
+		"""
+		Precompile the provided tag tree.
+		
+		@param stan: markup containing L{nevow.tags.slot} placeholders
+		"""
+		self.chunks = flat.precompile(stan)
+	
+	def render(self, **slots):
+		"""
+		Return the markup for this fragment, with the provided slot values.
+		
+		@rtype: str
+		"""
+		output = []
+		for chunk in self.chunks:
+			if(isinstance(chunk, str)):
+				output.append(chunk)
+				continue
+			value = slots[chunk.name]
+			if(isinstance(value, tags.xml)):
+				output.append(value.content)
+			elif(isinstance(value, unicode)):
+				output.append(cgi.escape(value.encode('utf-8'), chunk.isAttrib))
+			else:
+				output.append(cgi.escape(str(value), chunk.isAttrib))
+		return ''.join(output)
+	
+	def __call__(self, **slots):
+		"""
+		Return this fragment as markup to be returned from a template function.
+		
+		@rtype: L{nevow.tags.xml}
+		"""
+		return tags.xml(self.render(**slots))
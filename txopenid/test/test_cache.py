@@ -0,0 +1,51 @@
+# txopenid
+# Copyright (c) 2007 Phil Christensen
+#
+# See LICENSE for details
+
+"""
+Test cache module.
+"""
+
+from twisted.trial import unittest
+
+from txopenid import cache
+
+class LRUCacheTestCase(unittest.TestCase):
+	def setUp(self):
+		self.now = 1000.0
+		self.patch(cache, '_now', lambda: self.now)
+		self.cache = cache.LRUCache(maxsize=2, timeout=60)
+	
+	def tearDown(self):
+		pass
+	
+	def test_get(self):
+		self.cache.set('one', 1)
+		self.failUnlessEqual(self.cache.get('one'), 1)
+		self.failUnlessEqual(self.cache.get('two'), None)
+		self.failUnlessEqual(self.cache.stats(), dict(hits=1, misses=1, size=1))
+	
+	def test_delete(self):
+		self.cache.set('one', 1)
+		self.cache.delete('one')
+		self.cache.delete('one')
+		self.failUnlessEqual(self.cache.get('one'), None)
+	
+	def test_timeout(self):
+		self.cache.set('one', 1)
+		self.cache.set('two', 2, time=120)
+		self.now += 61
+		self.failUnlessEqual(self.cache.get('one'), None)
+		self.failUnlessEqual(self.cache.get('two'), 2)
+	
+	def test_lru(self):
+		self.cache.set('one', 1)
+		self.cache.set('two', 2)
+		self.cache.get('one')
+		self.cache.set('three', 3)
+		
+		self.failUnlessEqual(len(self.cache), 2)
+		self.failUnlessEqual(self.cache.get('one'), 1)
+		self.failUnlessEqual(self.cache.get('two'), None)
+		self.failUnlessEqual(self.cache.get('three'), 3)
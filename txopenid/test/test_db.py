@@ -0,0 +1,152 @@
+# txopenid
+# Copyright (c) 2007 Phil Christensen
+#
+# See LICENSE for details
+
+"""
+Test db module.
+"""
+
+from twisted.trial import unittest
+from twisted.internet.defer import inlineCallbacks, succeed, Deferred
+
+from txopenid import db, user
+
+class TestConnectionPool(object):
+	"""
+	Answers queries with the provided records, or URL queries with the
+	provided URLs, either at once or when the test fires the pending query.
+	"""
+	def __init__(self, urls=(), records=None):
+		self.urls = list(urls)
+		self.records = records
+		self.queries = []
+		self.operations = []
+		self.pending = None
+	
+	def runQuery(self, query, args):
+		self.queries.append((query, args))
+		if(self.records is not None):
+			rows = self.records
+		else:
+			rows = [dict(url=url) for url in self.urls]
+		if(self.pending is not None):
+			d = self.pending
+			self.pending = None
+			return d.addCallback(lambda _: rows)
+		return succeed(rows)
+	
+	def runOperation(self, query, args):
+		self.operations.append((query, args))
+		return succeed(None)
+
+class UserURLCacheTestCase(unittest.TestCase):
+	def setUp(self):
+		self.pool = db.Connection()
+		self.pool.conn = TestConnectionPool(['http://www.example.com/old'])
+		self.user = user.User(dict(id=1))
+	
+	def tearDown(self):
+		pass
+	
+	@inlineCallbacks
+	def test_cached(self):
+		urls = yield self.pool._getUserURLs('identity', self.user)
+		self.failUnlessEqual(urls, frozenset(['http://www.example.com/old']))
+		urls = yield self.pool._getUserURLs('identity', self.user)
+		self.failUnlessEqual(urls, frozenset(['http://www.example.com/old']))
+		self.failUnlessEqual(len(self.pool.conn.queries), 1)
+	
+	@inlineCallbacks
+	def test_invalidated(self):
+		writes = [
+			('identity', 'saveUserIdentity', 'http://www.example.com/new'),
+			('identity', 'removeUserIdentities', [1]),
+			('trusted_root', 'saveUserRoot', 'http://www.example.com/new'),
+			('trusted_root', 'removeUserRoots', [1]),
+		]
+		for user_id, (table, method, arg) in enumerate(writes):
+			u = user.User(dict(id=user_id))
+			self.pool.conn.urls = ['http://www.example.com/old']
+			urls = yield self.pool._getUserURLs(table, u)
+			self.failUnlessEqual(urls, frozenset(['http://www.example.com/old']))
+			
+			self.pool.conn.urls = ['http://www.example.com/new']
+			yield getattr(self.pool, method)(u, arg)
+			urls = yield self.pool._getUserURLs(table, u)
+			self.failUnlessEqual(urls, frozenset(['http://www.example.com/new']), method)
+	
+	@inlineCallbacks
+	def test_stale_fill(self):
+		"""
+		A query that was running when the URLs changed isn't cached.
+		"""
+		query = self.pool.conn.pending = Deferred()
+		d = self.pool._getUserURLs('identity', self.user)
+		yield self.pool.saveUserIdentity(self.user, 'http://www.example.com/new')
+		query.callback(None)
+		urls = yield d
+		self.failUnlessEqual(urls, frozenset(['http://www.example.com/old']))
+		self.failUnlessEqual(self.pool.user_fills, {})
+		
+		self.pool.conn.urls = ['http://www.example.com/old', 'http://www.example.com/new']
+		urls = yield self.pool._getUserURLs('identity', self.user)
+		self.failUnlessEqual(urls, frozenset(['http://www.example.com/old', 'http://www.example.com/new']))
+		self.failUnlessEqual(len(self.pool.conn.queries), 2)
+		
+		urls = yield self.pool._getUserURLs('identity', self.user)
+		self.failUnlessEqual(len(self.pool.conn.queries), 2)
+
+class AuthorizationTestCase(unittest.TestCase):
+	def setUp(self):
+		self.pool = db.Connection()
+		self.pool.conn = TestConnectionPool()
+	
+	def tearDown(self):
+		pass
+	
+	@inlineCallbacks
+	def test_authorized(self):
+		self.pool.conn.records = [dict(id=1, username='test', has_identity=1, trusts_root=1)]
+		u = yield self.pool.loadAuthorization('a' * 32, 'http://www.example.com/test', 'http://www.example.com/trust')
+		
+		self.failUnlessEqual(self.pool.conn.queries[0][1], ['http://www.example.com/test', 'http://www.example.com/trust', 'a' * 32])
+		self.failUnlessEqual(dict(u), dict(id=1, username='test'))
+		self.failUnless(u.pool is self.pool)
+		self.failUnlessEqual(u.known_identities, {'http://www.example.com/test':True})
+		self.failUnlessEqual(u.known_roots, {'http://www.example.com/trust':True})
+	
+	@inlineCallbacks
+	def test_unauthorized(self):
+		self.pool.conn.records = [dict(id=1, username='test', has_identity=0, trusts_root=0)]
+		u = yield self.pool.loadAuthorization('a' * 32, 'http://www.example.com/test', 'http://www.example.com/trust')
+		
+		self.failUnlessEqual(dict(u), dict(id=1, username='test'))
+		self.failUnlessEqual(u.known_identities, {'http://www.example.com/test':False})
+		self.failUnlessEqual(u.known_roots, {'http://www.example.com/trust':False})
+	
+	@inlineCallbacks
+	def test_no_session(self):
+		self.pool.conn.records = []
+		u = yield self.pool.loadAuthorization('a' * 32, 'http://www.example.com/test', 'http://www.example.com/trust')
+		self.failUnlessEqual(u, None)
+	
+	@inlineCallbacks
+	def test_known(self):
+		"""
+		Checks answered by loadAuthorization don't query the database again.
+		"""
+		self.pool.conn.records = [dict(id=1, has_identity=1, trusts_root=0)]
+		u = yield self.pool.loadAuthorization('a' * 32, 'http://www.example.com/test', 'http://www.example.com/trust')
+		
+		self.failUnlessEqual(u.hasIdentity('http://www.example.com/test'), True)
+		self.failUnlessEqual(u.trustsRoot('http://www.example.com/trust'), False)
+		self.failUnlessEqual(len(self.pool.conn.queries), 1)
+		
+		self.pool.conn.records = None
+		self.pool.conn.urls = ['http://www.example.com/other']
+		result = yield u.hasIdentity('http://www.example.com/other')
+		self.failUnlessEqual(result, True)
+		result = yield u.trustsRoot('http://www.example.com/untrusted')
+		self.failUnlessEqual(result, False)
+		self.failUnlessEqual(len(self.pool.conn.queries), 3)
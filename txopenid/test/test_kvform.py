@@ -0,0 +1,88 @@
+# txopenid
+# Copyright (c) 2007 Phil Christensen
+#
+# See LICENSE for details
+
+"""
+Test kvform module.
+"""
+
+import cStringIO
+
+from twisted.trial import unittest
+
+from txopenid import kvform
+
+class KVFormTestCase(unittest.TestCase):
+	def setUp(self):
+		pass
+	
+	def tearDown(self):
+		pass
+	
+	def test_encode(self):
+		value = dict(
+			one		= 1,
+			two		= 2,
+			three	= 3,
+		)
+		expected = 'one:1\nthree:3\ntwo:2\n'
+		got = kvform.encode(value)
+		self.failUnlessEqual(got, expected, "Got %r when expecting %r" % (got, expected))
+	
+	def test_encode_order(self):
+		value = dict(
+			one		= 1,
+			two		= 2,
+			three	= 3,
+		)
+		expected = 'two:2\none:1\n'
+		got = kvform.encode(value, ('two', 'one'))
+		self.failUnlessEqual(got, expected, "Got %r when expecting %r" % (got, expected))
+	
+	def test_encode_empty(self):
+		self.failUnlessEqual(kvform.encode({}), '')
+	
+	def test_encode_signed(self):
+		response = {
+			'openid.mode'			: 'id_res',
+			'openid.identity'		: 'http://www.example.com/test',
+			'openid.return_to'		: 'http://www.example.com/return',
+			'openid.assoc_handle'	: 'some handle',
+		}
+		expected = 'return_to:http://www.example.com/return\nmode:id_res\nidentity:http://www.example.com/test\n'
+		got = kvform.encode_signed(response, 'return_to,mode,identity')
+		self.failUnlessEqual(got, expected, "Got %r when expecting %r" % (got, expected))
+		self.failUnlessRaises(KeyError, kvform.encode_signed, response, 'identity,trust_root')
+	
+	def test_write(self):
+		value = dict(
+			one		= 1,
+			two		= 2,
+			three	= 3,
+		)
+		buffer = cStringIO.StringIO()
+		buffer.write('prefix\n')
+		kvform.write(buffer, value)
+		kvform.write(buffer, value, ('two',))
+		expected = 'prefix\none:1\nthree:3\ntwo:2\ntwo:2\n'
+		got = buffer.getvalue()
+		self.failUnlessEqual(got, expected, "Got %r when expecting %r" % (got, expected))
+	
+	def test_decode(self):
+		expected = {
+			'assoc_type'	: 'HMAC-SHA1',
+			'mac_key'		: 'y/NsSugej//MGmCmUyauWLSlZKM=',
+			'empty'			: '',
+			'url'			: 'http://www.example.com:8080/',
+		}
+		got = kvform.decode(kvform.encode(expected))
+		self.failUnlessEqual(got, expected, "Got %r when expecting %r" % (got, expected))
+	
+	def test_decode_lenient(self):
+		got = kvform.decode('one:1\n\ntwo:2')
+		self.failUnlessEqual(got, dict(one='1', two='2'))
+		self.failUnlessEqual(kvform.decode(''), {})
+	
+	def test_decode_invalid(self):
+		self.failUnlessRaises(ValueError, kvform.decode, 'one:1\nno colon here\n')
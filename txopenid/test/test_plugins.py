@@ -0,0 +1,30 @@
+# txopenid
+# Copyright (c) 2007 Phil Christensen
+#
+# See LICENSE for details
+
+"""
+Test the twistd plugins.
+"""
+
+from twisted.trial import unittest
+
+from twisted.plugins import txopenid_consumer
+
+from txopenid import session
+
+class ConsumerPluginTestCase(unittest.TestCase):
+	def setUp(self):
+		pass
+	
+	def tearDown(self):
+		pass
+	
+	def test_session_reaper(self):
+		config = txopenid_consumer.Options()
+		config.parseOptions(['--reap-interval', '30'])
+		consumerService = txopenid_consumer.serviceMaker.makeService(config)
+		
+		reapers = [child for child in consumerService if isinstance(child, session.SessionReaper)]
+		self.failUnlessEqual(len(reapers), 1)
+		self.failUnlessEqual(reapers[0].interval, 30.0)
@@ -12,9 +12,9 @@ import sha, cgi, base64, urllib
 from twisted.trial import unittest
 from twisted.internet.defer import inlineCallbacks, returnValue
 
-from nevow import url
+from nevow import url, testutil
 
-from txopenid import util, protocol
+from txopenid import util, protocol, kvform
 from txopenid.test import TestUser
 
 test_handle = '72LSndh2ZN9VKt08GRPA6NaAEp0tTG2Puxq5vGnrqVkF2iRPl001s1DXL9t+y6Gik8QswcPEZ6rlZymoHFHkpw=='
@@ -25,10 +25,11 @@ class TestRegistry(object):
 		self.validation = validation
 	
 	def initiate(self, requestData, smart):
+		assoc_type = requestData.get('openid.assoc_type', 'HMAC-SHA1')
 		if(self.handle):
-			association = protocol.OpenIDAssociation(requestData, handle=self.handle)
+			association = protocol.OpenIDAssociation(assoc_type, handle=self.handle)
 		else:
-			association = protocol.OpenIDAssociation(requestData)
+			association = protocol.OpenIDAssociation(assoc_type)
 		return association
 	
 	def validate(self, requestData, is_smart):
@@ -74,6 +75,140 @@ class ProtocolTestCase(unittest.TestCase):
 		
 		self.failUnlessEqual(result, expecting)
 	
+	def associate_dh(self, session_type, **args):
+		consumer = protocol.DiffieHellman()
+		requestData = {
+			'openid.mode'				: 'associate',
+			'openid.session_type'		: session_type,
+			'openid.dh_consumer_public'	: base64.b64encode(util.btwoc(consumer.public)),
+		}
+		requestData.update(args)
+		result = protocol.associate(TestRegistry(test_handle), requestData)
+		response = kvform.decode(result)
+		
+		self.failIf('mac_key' in response)
+		self.failUnlessEqual(response['session_type'], session_type)
+		server_public = util.mklong(base64.b64decode(response['dh_server_public']))
+		shared_secret = pow(server_public, consumer.private, protocol.DH_P_VALUE)
+		digest = protocol.DH_SESSION_TYPES[session_type](util.btwoc(shared_secret)).digest()
+		return util.strxor(digest, base64.b64decode(response['enc_mac_key']))
+	
+	def test_associate_dh_sha1(self):
+		mac_key = self.associate_dh('DH-SHA1')
+		self.failUnlessEqual(mac_key, util.secret(test_handle))
+	
+	def test_associate_dh_explicit_modulus(self):
+		mac_key = self.associate_dh('DH-SHA1', **{
+			'openid.dh_modulus'	: base64.b64encode(util.btwoc(protocol.DH_P_VALUE)),
+			'openid.dh_gen'		: base64.b64encode(util.btwoc(2)),
+		})
+		self.failUnlessEqual(mac_key, util.secret(test_handle))
+	
+	def test_associate_dh_pool(self):
+		pool = protocol.DHKeyPool(2)
+		self.patch(protocol, 'DH_KEY_POOL', pool)
+		self.failUnlessEqual(pool.fill(), 2)
+		self.failUnlessEqual(pool.fill(), 0)
+		
+		mac_key = self.associate_dh('DH-SHA1')
+		self.failUnlessEqual(mac_key, util.secret(test_handle))
+		self.failUnlessEqual(len(pool), 1)
+	
+	def test_associate_dh_sha256(self):
+		mac_key = self.associate_dh('DH-SHA256', **{
+			'openid.assoc_type'	: 'HMAC-SHA256',
+		})
+		self.failUnlessEqual(len(mac_key), 32)
+		self.failUnlessEqual(mac_key, util.secret(test_handle, 'HMAC-SHA256'))
+	
+	def test_dh_pool_batch(self):
+		pool = protocol.DHKeyPool(5, batch=2)
+		self.failUnlessEqual(pool.fill(), 2)
+		self.failUnlessEqual(pool.fill(), 2)
+		self.failUnlessEqual(pool.fill(), 1)
+		self.failUnlessEqual(pool.fill(), 0)
+		self.failUnlessEqual(len(pool), 5)
+	
+	def associate_error(self, requestData):
+		requestData['openid.mode'] = 'associate'
+		result = protocol.associate(TestRegistry(test_handle), requestData)
+		response = kvform.decode(result)
+		
+		self.failUnlessEqual(response['error_code'], 'unsupported-type')
+		self.failUnless(response['error'])
+		self.failIf('assoc_handle' in response)
+		return response
+	
+	def test_associate_dh_mismatch(self):
+		# a SHA256 session can't encrypt a SHA1 MAC key
+		consumer = protocol.DiffieHellman()
+		self.associate_error({
+			'openid.session_type'		: 'DH-SHA256',
+			'openid.dh_consumer_public'	: base64.b64encode(util.btwoc(consumer.public)),
+		})
+	
+	def test_associate_dh_invalid_public(self):
+		self.associate_error({
+			'openid.session_type'		: 'DH-SHA1',
+			'openid.dh_consumer_public'	: base64.b64encode(util.btwoc(1)),
+		})
+	
+	def test_associate_dh_missing_public(self):
+		self.associate_error({
+			'openid.session_type'		: 'DH-SHA1',
+		})
+	
+	def test_associate_dh_malformed(self):
+		self.associate_error({
+			'openid.session_type'		: 'DH-SHA1',
+			'openid.dh_consumer_public'	: 'not&base64',
+		})
+	
+	def test_associate_dh_large_modulus(self):
+		modulus = (1 << 4096) - 1
+		response = self.associate_error({
+			'openid.session_type'		: 'DH-SHA1',
+			'openid.dh_modulus'			: base64.b64encode(util.btwoc(modulus)),
+			'openid.dh_consumer_public'	: base64.b64encode(util.btwoc(12345)),
+		})
+		self.failUnless('2048' in response['error'])
+	
+	def test_associate_dh_invalid_generator(self):
+		self.associate_error({
+			'openid.session_type'		: 'DH-SHA1',
+			'openid.dh_gen'				: base64.b64encode(util.btwoc(1)),
+			'openid.dh_consumer_public'	: base64.b64encode(util.btwoc(12345)),
+		})
+	
+	def test_associate_unsupported_type(self):
+		response = self.associate_error({
+			'openid.assoc_type'			: 'HMAC-MD5',
+		})
+		self.failUnlessEqual(response['assoc_type'], 'HMAC-SHA1')
+		self.failUnlessEqual(response['session_type'], 'DH-SHA1')
+	
+	def test_associate_unsupported_type_dh_disabled(self):
+		self.patch(protocol, 'DH_ENABLED', False)
+		response = self.associate_error({
+			'openid.assoc_type'			: 'HMAC-MD5',
+		})
+		self.failUnlessEqual(response['assoc_type'], 'HMAC-SHA1')
+		self.failIf('session_type' in response)
+	
+	def test_associate_unsupported_session_type(self):
+		response = self.associate_error({
+			'openid.session_type'		: 'DH-MD5',
+		})
+		self.failIf('mac_key' in response)
+	
+	def test_associate_dh_disabled(self):
+		self.patch(protocol, 'DH_ENABLED', False)
+		result = protocol.associate(TestRegistry(test_handle), {
+			'openid.session_type'		: 'DH-SHA1',
+			'openid.dh_consumer_public'	: base64.b64encode(util.btwoc(12345)),
+		})
+		self.failUnless('mac_key:y/NsSugej//MGmCmUyauWLSlZKM=\n' in result)
+	
 	@inlineCallbacks
 	def test_checkid_immediate_passes(self):
 		registry = TestRegistry(test_handle)
@@ -279,6 +414,29 @@ class ProtocolTestCase(unittest.TestCase):
 		normalized = protocol.OpenIDRequest(request)
 		self.failUnlessEqual(normalized['two'], '2')
 		self.failUnlessEqual(normalized['five'], '5')
+	
+	def test_OpenIDRequest_readonly(self):
+		normalized = protocol.OpenIDRequest(TestNevowRequest(args={'openid.mode':'associate'}))
+		def assign():
+			normalized['openid.mode'] = 'cancel'
+		self.failUnlessRaises(TypeError, assign)
+		self.failUnlessRaises(AttributeError, setattr, normalized, 'request', None)
+		self.failIf(hasattr(normalized, '__dict__'))
+	
+	def test_OpenIDRequest_openid_fields(self):
+		normalized = protocol.OpenIDRequest(TestNevowRequest(args={'openid.mode':'checkid_setup', 'submit':'login'}))
+		self.failUnlessEqual(normalized.openid_fields(), {'openid.mode':'checkid_setup'})
+		self.failUnless('submit' in normalized)
+	
+	def test_parse_request(self):
+		request = testutil.FakeRequest(args={'openid.mode':['associate']})
+		requestData = protocol.parse_request(request)
+		self.failUnlessEqual(requestData['openid.mode'], 'associate')
+		self.failUnlessIdentical(protocol.parse_request(request), requestData)
+		
+		protocol.clear_request(request)
+		self.failUnlessEqual(len(protocol.parse_request(request)), 0)
+		self.failUnlessEqual(requestData['openid.mode'], 'associate')
 
 class RegistryTestCase(unittest.TestCase):
 	def setUp(self):
@@ -353,6 +511,100 @@ class RegistryTestCase(unittest.TestCase):
 		if not(result):
 			self.fail('Validation failed when it should have passed.')
 	
+	def test_sign(self):
+		association = protocol.OpenIDAssociation()
+		for message in ('mode:id_res\n', 'some other message', 'mode:id_res\n'):
+			self.failUnlessEqual(association.sign(message), util.get_hmac(association.secret, message))
+	
+	def test_sign_cache(self):
+		self.patch(protocol, 'HMAC_CACHE', {})
+		self.patch(protocol, 'HMAC_CACHE_SIZE', 2)
+		associations = [protocol.OpenIDAssociation() for i in range(3)]
+		associations.append(protocol.OpenIDAssociation('HMAC-SHA256', handle=associations[0].handle))
+		for association in associations * 2:
+			self.failUnlessEqual(association.sign('mode:id_res\n'),
+				util.get_hmac(association.secret, 'mode:id_res\n', association.assoc_type))
+			self.failUnless(len(protocol.HMAC_CACHE) <= 2)
+	
+	def test_validate_sha256(self):
+		registry = protocol.OpenIDRegistry()
+		association = registry.initiate(TestRequest({
+			'openid.mode'			: 'associate',
+			'openid.assoc_type'		: 'HMAC-SHA256',
+		}), True)
+		self.failUnlessEqual(association.assoc_type, 'HMAC-SHA256')
+		
+		token_contents = util.kvstr(mode='id_res',
+								identity='http://www.example.com/test',
+								return_to='http://www.example.com/return')
+		
+		valid_sig = base64.b64encode(util.get_hmac(association.secret, token_contents, 'HMAC-SHA256'))
+		
+		result = registry.validate(TestRequest({
+			'openid.mode'			: 'check_authentication',
+			'openid.identity'		: 'http://www.example.com/test',
+			'openid.return_to'		: 'http://www.example.com/return',
+			'openid.assoc_handle'	: association.handle,
+			'openid.sig'			: valid_sig,
+			'openid.signed'			: 'identity,mode,return_to',
+		}), True)
+		
+		if not(result):
+			self.fail('Validation failed when it should have passed.')
+	
+	def test_token_contents(self):
+		expected = util.kvstr(mode='id_res',
+							identity='http://www.example.com/test',
+							return_to='http://www.example.com/return')
+		got = protocol.get_token_contents('http://www.example.com/test', 'http://www.example.com/return')
+		self.failUnlessEqual(got, expected, "Got %r when expecting %r" % (got, expected))
+		
+		signed = kvform.encode_signed({
+			'openid.mode'			: 'id_res',
+			'openid.identity'		: 'http://www.example.com/test',
+			'openid.return_to'		: 'http://www.example.com/return',
+		}, protocol.SIGNED_FIELDS)
+		self.failUnlessEqual(got, signed, "Got %r when expecting %r" % (got, signed))
+	
+	def test_validate_bad_signatures(self):
+		registry = protocol.OpenIDRegistry()
+		association = registry.initiate(TestRequest({
+			'openid.mode'			: 'associate',
+		}), True)
+		
+		token_contents = protocol.get_token_contents('http://www.example.com/test', 'http://www.example.com/return')
+		valid_sig = association.sign(token_contents)
+		
+		for sig in (valid_sig[:-1] + chr(ord(valid_sig[-1]) ^ 1), valid_sig[:-1], valid_sig + 'x', ''):
+			result = registry.validate(TestRequest({
+				'openid.mode'			: 'check_authentication',
+				'openid.identity'		: 'http://www.example.com/test',
+				'openid.return_to'		: 'http://www.example.com/return',
+				'openid.assoc_handle'	: association.handle,
+				'openid.sig'			: base64.b64encode(sig),
+				'openid.signed'			: 'identity,mode,return_to',
+			}), True)
+			self.failIf(result, 'Validation passed for signature %r' % sig)
+		
+		for sig in ('not&base64', None):
+			request = TestRequest({
+				'openid.mode'			: 'check_authentication',
+				'openid.identity'		: 'http://www.example.com/test',
+				'openid.return_to'		: 'http://www.example.com/return',
+				'openid.assoc_handle'	: association.handle,
+				'openid.signed'			: 'identity,mode,return_to',
+			})
+			if(sig is not None):
+				request['openid.sig'] = sig
+			self.failIf(registry.validate(request, True), 'Validation passed for signature %r' % sig)
+	
+	def test_initiate_unsupported(self):
+		registry = protocol.OpenIDRegistry()
+		self.failUnlessRaises(NotImplementedError, registry.initiate, TestRequest({
+			'openid.mode'			: 'associate',
+			'openid.assoc_type'		: 'HMAC-MD5',
+		}), True)
+	
 	def test_validate_fails(self):
 		registry = protocol.OpenIDRegistry()
 		association = registry.initiate(TestRequest({
@@ -6,3 +6,220 @@
 """
 Test resource module.
 """
+
+import time
+
+from twisted.trial import unittest
+from twisted.internet.defer import inlineCallbacks, succeed, maybeDeferred, Deferred
+
+from nevow import testutil, context, inevow
+
+from txopenid import resource, session, protocol, util, user
+from txopenid.test.test_session import TestPool
+
+FIRST = '1' * 32
+SECOND = '2' * 32
+
+class TestRealm(object):
+	def __init__(self):
+		self.registry = protocol.OpenIDRegistry()
+
+class TestPortal(object):
+	def __init__(self):
+		self.realm = TestRealm()
+		self.logins = []
+	
+	def login(self, creds, mind, *interfaces):
+		self.logins.append(creds)
+		return succeed((inevow.IResource, None, lambda: None))
+
+class TestSlowPortal(object):
+	def __init__(self):
+		self.pending = {}
+	
+	def login(self, creds, mind, *interfaces):
+		d = self.pending[creds.getSid()] = Deferred()
+		return d
+
+class TestAuthorizationPool(TestPool):
+	def __init__(self, sessions=None, users=None):
+		TestPool.__init__(self, sessions)
+		self.users = users or {}
+		self.authorizations = []
+	
+	def loadAuthorization(self, sid, identity, root):
+		self.authorizations.append((sid, identity, root))
+		if(sid not in self.users):
+			return succeed(None)
+		record, has_identity, trusts_root = self.users[sid]
+		u = user.User(record)
+		u.pool = self
+		u.known_identities[identity] = has_identity
+		u.known_roots[root] = trusts_root
+		return succeed(u)
+
+class AbstractUserPageTestCase(unittest.TestCase):
+	def setUp(self):
+		self.portal = TestSlowPortal()
+		self.page = resource.AbstractUserPage(TestPool(), self.portal)
+		self.patch(session, 'SESSION_WRITER', None)
+		self.patch(session, 'INFANT_SESSIONS', session.InfantSessionStore())
+	
+	def tearDown(self):
+		pass
+	
+	def test_concurrent_users(self):
+		first = context.RequestContext(tag=testutil.FakeRequest(cookies={session.COOKIE_KEY:FIRST}))
+		second = context.RequestContext(tag=testutil.FakeRequest(cookies={session.COOKIE_KEY:SECOND}))
+		d1 = self.page.authenticate(first)
+		d2 = self.page.authenticate(second)
+		
+		self.portal.pending[SECOND].callback((inevow.IResource, dict(id=2), lambda: None))
+		self.portal.pending[FIRST].callback((inevow.IResource, dict(id=1), lambda: None))
+		
+		self.failUnlessEqual(self.page.getUser(first), dict(id=1))
+		self.failUnlessEqual(self.page.getUser(second), dict(id=2))
+		return d1.addCallback(lambda _: d2)
+
+class ProviderPageTestCase(unittest.TestCase):
+	def setUp(self):
+		self.pool = TestPool()
+		self.portal = TestPortal()
+		self.page = resource.ProviderPage(self.pool, self.portal)
+		self.patch(session, 'INFANT_SESSIONS', session.InfantSessionStore())
+	
+	def tearDown(self):
+		pass
+	
+	def render(self, **args):
+		request = testutil.FakeRequest(args=dict([(k, [v]) for k, v in args.items()]))
+		ctx = context.RequestContext(tag=request)
+		d = maybeDeferred(self.page.renderHTTP, ctx)
+		d.addCallback(lambda output: (request, output))
+		return d
+	
+	@inlineCallbacks
+	def test_associate_lazy(self):
+		request, output = yield self.render(**{'openid.mode':'associate'})
+		
+		self.failUnless('assoc_handle:' in output)
+		self.failUnlessEqual(self.portal.logins, [])
+		self.failUnlessEqual(request.cookies, {})
+		self.failUnlessEqual(len(session.INFANT_SESSIONS), 0)
+	
+	def test_direct_not_deferred(self):
+		request = testutil.FakeRequest(args={
+			'openid.mode'			: ['check_authentication'],
+			'openid.assoc_handle'	: ['missing-handle'],
+		})
+		output = self.page.renderHTTP(context.RequestContext(tag=request))
+		
+		self.failUnless(isinstance(output, str))
+		self.failUnless('is_valid:false' in output)
+		self.failUnless('invalidate_handle:missing-handle' in output)
+		self.failUnlessEqual(self.portal.logins, [])
+	
+	@inlineCallbacks
+	def test_associate_eager(self):
+		self.patch(session, 'LAZY_SESSIONS', False)
+		request, output = yield self.render(**{'openid.mode':'associate'})
+		
+		self.failUnless('assoc_handle:' in output)
+		self.failUnlessEqual(len(self.portal.logins), 1)
+		self.failUnless(session.COOKIE_KEY in request.cookies)
+		self.failUnlessEqual(len(session.INFANT_SESSIONS), 1)
+	
+	@inlineCallbacks
+	def test_output_log_redacted(self):
+		messages = []
+		self.patch(util, 'LOG_LEVEL', util.DEBUG)
+		self.patch(util.log, 'msg', lambda message, **kw: messages.append(message))
+		request, output = yield self.render(**{'openid.mode':'associate'})
+		
+		mac_key = [line for line in output.split('\n') if line.startswith('mac_key:')][0]
+		logged = [message for message in messages if message.startswith('[ProviderPage] output:')]
+		self.failUnlessEqual(len(logged), 1)
+		self.failIf(mac_key[len('mac_key:'):] in logged[0])
+		self.failUnless('mac_key:<redacted>' in logged[0])
+
+class AuthorizeTestCase(unittest.TestCase):
+	def setUp(self):
+		now = int(time.time())
+		self.pool = TestAuthorizationPool(
+			sessions = {
+				FIRST	: dict(id=FIRST, user_id=1, created=now, accessed=now, timeout=3600),
+				SECOND	: dict(id=SECOND, user_id=2, created=now, accessed=now, timeout=3600),
+			},
+			users = {
+				FIRST	: (dict(id=1), True, True),
+				SECOND	: (dict(id=2), False, False),
+			},
+		)
+		self.portal = TestPortal()
+		self.page = resource.ProviderPage(self.pool, self.portal)
+		self.patch(session, 'SESSION_WRITER', None)
+		self.patch(session, 'INFANT_SESSIONS', session.InfantSessionStore())
+	
+	def tearDown(self):
+		pass
+	
+	def authorize(self, sid):
+		cookies = {}
+		if(sid is not None):
+			cookies[session.COOKIE_KEY] = sid
+		ctx = context.RequestContext(tag=testutil.FakeRequest(cookies=cookies))
+		d = self.page.authorize(ctx, 'http://www.example.com/test', 'http://www.example.com/trust')
+		return d.addCallback(lambda u: (ctx, u))
+	
+	@inlineCallbacks
+	def test_authorized(self):
+		ctx, u = yield self.authorize(FIRST)
+		
+		self.failUnlessEqual(u['id'], 1)
+		self.failUnless(self.page.getUser(ctx) is u)
+		self.failUnlessEqual(u.hasIdentity('http://www.example.com/test'), True)
+		self.failUnlessEqual(u.trustsRoot('http://www.example.com/trust'), True)
+		self.failUnlessEqual(self.pool.authorizations, [(FIRST, 'http://www.example.com/test', 'http://www.example.com/trust')])
+		self.failUnlessEqual(self.portal.logins, [])
+	
+	@inlineCallbacks
+	def test_unauthorized(self):
+		ctx, u = yield self.authorize(SECOND)
+		
+		self.failUnlessEqual(u['id'], 2)
+		self.failUnlessEqual(u.hasIdentity('http://www.example.com/test'), False)
+		self.failUnlessEqual(u.trustsRoot('http://www.example.com/trust'), False)
+		self.failUnlessEqual(self.portal.logins, [])
+	
+	@inlineCallbacks
+	def test_no_session(self):
+		ctx, u = yield self.authorize('3' * 32)
+		
+		self.failUnlessEqual(u, None)
+		self.failUnlessEqual(self.page.getUser(ctx), None)
+		self.failUnlessEqual(len(self.pool.authorizations), 1)
+		self.failUnlessEqual(self.portal.logins, [])
+	
+	@inlineCallbacks
+	def test_infant_session(self):
+		"""
+		Sessions that aren't in the DB yet go through the portal.
+		"""
+		now = int(time.time())
+		session.INFANT_SESSIONS.set(FIRST, dict(id=FIRST, user_id=0, created=now, accessed=now, timeout=3600))
+		ctx, u = yield self.authorize(FIRST)
+		
+		self.failUnlessEqual(self.pool.authorizations, [])
+		self.failUnlessEqual(len(self.portal.logins), 1)
+		self.failUnlessEqual(self.portal.logins[0].getSid(), FIRST)
+	
+	@inlineCallbacks
+	def test_invalid_sid(self):
+		for sid in (None, 'not-a-session-id', FIRST.upper() + 'F', "1' OR '1'='1"):
+			ctx, u = yield self.authorize(sid)
+			self.failUnlessEqual(u, None)
+		
+		self.failUnlessEqual(self.pool.authorizations, [])
+		self.failUnlessEqual(len(self.portal.logins), 4)
+		for creds in self.portal.logins:
+			self.failIf(isinstance(creds, session.SessionCredentials))
@@ -0,0 +1,328 @@
+# txopenid
+# Copyright (c) 2007 Phil Christensen
+#
+# See LICENSE for details
+
+"""
+Test session module.
+"""
+
+import time
+
+from twisted.trial import unittest
+from twisted.internet.defer import inlineCallbacks, succeed, fail
+
+from txopenid import session, cache
+
+EXISTING = 'a' * 32
+RECENT = 'b' * 32
+EXPIRED = 'c' * 32
+MISSING = 'd' * 32
+
+class TestPool(object):
+	def __init__(self, sessions=None):
+		self.sessions = sessions or {}
+		self.saved = []
+		self.touched = []
+		self.touch_error = None
+		self.loaded = []
+		self.expired = 0
+		self.reaped = []
+	
+	def loadSession(self, sid):
+		self.loaded.append(sid)
+		if(sid in self.sessions):
+			return succeed(dict(self.sessions[sid]))
+		return succeed(None)
+	
+	def saveSession(self, record, columns=None):
+		if(columns is not None):
+			record = dict([(column, record[column]) for column in columns])
+		self.saved.append(dict(record))
+		return succeed(True)
+	
+	def touchSessions(self, accessed):
+		if(self.touch_error is not None):
+			return fail(self.touch_error)
+		self.touched.append(dict(accessed))
+		return succeed(None)
+	
+	def reapSessions(self, limit):
+		count = min(limit, self.expired)
+		self.expired -= count
+		self.reaped.append(count)
+		return succeed(count)
+
+class TestSessionRequest(object):
+	def __init__(self, sid=None):
+		self.cookies = {}
+		if(sid is not None):
+			self.cookies[session.COOKIE_KEY] = sid
+	
+	def getCookie(self, key):
+		return self.cookies.get(key)
+	
+	def addCookie(self, key, value, **kwargs):
+		self.cookies[key] = value
+	
+	def getClientIP(self):
+		return '127.0.0.1'
+
+class SessionWriterTestCase(unittest.TestCase):
+	def setUp(self):
+		self.pool = TestPool()
+		self.writer = session.SessionWriter(self.pool)
+	
+	def tearDown(self):
+		pass
+	
+	def test_coalesce(self):
+		self.writer.touch('one', 100)
+		self.writer.touch('two', 100)
+		self.writer.touch('one', 101)
+		self.writer.flush()
+		
+		self.failUnlessEqual(self.pool.touched, [{'one':101, 'two':100}])
+		self.failUnlessEqual(self.writer.pending, {})
+	
+	def test_flush_empty(self):
+		self.writer.flush()
+		self.failUnlessEqual(self.pool.touched, [])
+	
+	def test_flush_failed(self):
+		self.pool.touch_error = RuntimeError('database went away')
+		self.writer.touch('one', 100)
+		self.writer.touch('two', 100)
+		d = self.writer.flush()
+		self.writer.touch('two', 101)
+		
+		self.failUnlessEqual(len(self.flushLoggedErrors(RuntimeError)), 1)
+		self.failUnlessEqual(self.writer.pending, {'one':100, 'two':101})
+		return d
+
+class UpdateSessionTestCase(unittest.TestCase):
+	def setUp(self):
+		now = int(time.time())
+		self.pool = TestPool({
+			EXISTING : dict(id=EXISTING, user_id=1, created=now - 120, accessed=now - 120, timeout=3600, data=None),
+			RECENT : dict(id=RECENT, user_id=1, created=now - 10, accessed=now - 10, timeout=3600, data=None),
+		})
+		self.writer = session.SessionWriter(self.pool)
+		self.patch(session, 'SESSION_WRITER', self.writer)
+	
+	def tearDown(self):
+		pass
+	
+	@inlineCallbacks
+	def test_touch(self):
+		yield session.updateSession(self.pool, TestSessionRequest(EXISTING), dict(id=1))
+		
+		self.failUnlessEqual(self.pool.saved, [])
+		self.failUnless(EXISTING in self.writer.pending)
+	
+	@inlineCallbacks
+	def test_touch_throttled(self):
+		yield session.updateSession(self.pool, TestSessionRequest(RECENT), dict(id=1))
+		
+		self.failUnlessEqual(self.pool.saved, [])
+		self.failUnlessEqual(self.writer.pending, {})
+	
+	@inlineCallbacks
+	def test_touch_unbatched(self):
+		self.patch(session, 'SESSION_WRITER', None)
+		yield session.updateSession(self.pool, TestSessionRequest(EXISTING), dict(id=1))
+		
+		self.failUnlessEqual(len(self.pool.saved), 1)
+		self.failUnlessEqual(sorted(self.pool.saved[0].keys()), ['accessed', 'expires_at'])
+		self.failUnlessEqual(self.pool.saved[0]['expires_at'], self.pool.saved[0]['accessed'] + 3600)
+	
+	@inlineCallbacks
+	def test_user_changed(self):
+		yield session.updateSession(self.pool, TestSessionRequest(RECENT), dict(id=2))
+		
+		self.failUnlessEqual(sorted(self.pool.saved[0].keys()), ['accessed', 'expires_at', 'user_id'])
+		self.failUnlessEqual(self.pool.saved[0]['user_id'], 2)
+		self.failUnlessEqual(self.writer.pending, {})
+
+class SessionCacheTestCase(unittest.TestCase):
+	def setUp(self):
+		now = int(time.time())
+		self.pool = TestPool({
+			EXISTING : dict(id=EXISTING, user_id=1, created=now - 120, accessed=now - 120, timeout=3600, data=None),
+			EXPIRED : dict(id=EXPIRED, user_id=1, created=now - 7200, accessed=now - 120, timeout=3600, data=None),
+		})
+		self.patch(session, 'SESSION_WRITER', None)
+		self.patch(session, 'SESSION_CACHE', cache.LRUCache())
+		self.checker = session.SessionChecker(self.pool)
+	
+	def tearDown(self):
+		pass
+	
+	@inlineCallbacks
+	def test_single_load(self):
+		user_id = yield self.checker.checkSessionCredentials(session.SessionCredentials(EXISTING))
+		self.failUnlessEqual(user_id, 1)
+		
+		yield session.updateSession(self.pool, TestSessionRequest(EXISTING), dict(id=1))
+		user_id = yield self.checker.checkSessionCredentials(session.SessionCredentials(EXISTING))
+		self.failUnlessEqual(user_id, 1)
+		
+		self.failUnlessEqual(self.pool.loaded, [EXISTING])
+	
+	@inlineCallbacks
+	def test_cached_write(self):
+		yield session.updateSession(self.pool, TestSessionRequest(EXISTING), dict(id=1))
+		record = yield session.loadSession(self.pool, EXISTING)
+		self.failUnlessEqual(record['accessed'], self.pool.saved[0]['accessed'])
+	
+	@inlineCallbacks
+	def test_expired(self):
+		user_id = yield self.checker.checkSessionCredentials(session.SessionCredentials(EXPIRED))
+		self.failUnlessIdentical(user_id, session.checkers.ANONYMOUS)
+	
+	@inlineCallbacks
+	def test_missing(self):
+		user_id = yield self.checker.checkSessionCredentials(session.SessionCredentials(MISSING))
+		self.failUnlessIdentical(user_id, session.checkers.ANONYMOUS)
+
+	@inlineCallbacks
+	def test_invalid_sid(self):
+		for sid in ('existing', EXISTING.upper(), EXISTING + '\n', 'session key with spaces', ''):
+			user_id = yield self.checker.checkSessionCredentials(session.SessionCredentials(sid))
+			self.failUnlessIdentical(user_id, session.checkers.ANONYMOUS)
+			record = yield session.loadSession(self.pool, sid)
+			self.failUnlessEqual(record, None)
+		self.failUnlessEqual(self.pool.loaded, [])
+		
+		request = TestSessionRequest('not a session id')
+		yield session.updateSession(self.pool, request)
+		self.failUnless(session.isValidSid(request.getCookie(session.COOKIE_KEY)))
+	
+	@inlineCallbacks
+	def test_threaded(self):
+		self.patch(session, 'SESSION_CACHE', cache.ThreadedCache(cache.LRUCache()))
+		user_id = yield self.checker.checkSessionCredentials(session.SessionCredentials(EXISTING))
+		self.failUnlessEqual(user_id, 1)
+		record = yield session.loadSession(self.pool, EXISTING)
+		self.failUnlessEqual(record['id'], EXISTING)
+		self.failUnlessEqual(self.pool.loaded, [EXISTING])
+
+class InfantSessionStoreTestCase(unittest.TestCase):
+	def setUp(self):
+		self.store = session.InfantSessionStore(timeout=3600, bucket_size=60, maxsize=3)
+	
+	def tearDown(self):
+		pass
+	
+	def test_pop(self):
+		self.store['one'] = dict(id='one', created=1000)
+		self.failUnless('one' in self.store)
+		self.failUnlessEqual(self.store.get('one')['id'], 'one')
+		
+		self.failUnlessEqual(self.store.pop('one')['id'], 'one')
+		self.failIf('one' in self.store)
+		self.failUnlessEqual(self.store.pop('one'), None)
+		self.failUnlessEqual(len(self.store), 0)
+	
+	def test_expire(self):
+		self.store['old'] = dict(id='old', created=1000)
+		self.store['older'] = dict(id='older', created=990)
+		self.store['new'] = dict(id='new', created=2000)
+		
+		# whole buckets are expired once they've aged out
+		self.failUnlessEqual(self.store.expire(4600), 0)
+		self.failUnlessEqual(self.store.expire(4680), 2)
+		self.failUnlessEqual(self.store.sessions.keys(), ['new'])
+		self.failUnlessEqual(self.store.expire(4680), 0)
+		self.failUnlessEqual(self.store.expired, 2)
+	
+	def test_expire_popped(self):
+		self.store['one'] = dict(id='one', created=1000)
+		self.store.pop('one')
+		self.failUnlessEqual(self.store.expire(9000), 0)
+		self.failUnlessEqual(self.store.heap, [])
+	
+	def test_maxsize(self):
+		for i in range(5):
+			self.store['s%d' % i] = dict(id='s%d' % i, created=1000 + (i * 60))
+		
+		self.failUnlessEqual(len(self.store), 3)
+		self.failUnlessEqual(self.store.evicted, 2)
+		self.failUnlessEqual(sorted(self.store.sessions.keys()), ['s2', 's3', 's4'])
+	
+	@inlineCallbacks
+	def test_shared(self):
+		self.patch(session, 'SESSION_WRITER', None)
+		self.patch(session, 'INFANT_SESSIONS', session.SharedInfantSessionStore(cache.ThreadedCache(cache.LRUCache())))
+		pool = TestPool()
+		request = TestSessionRequest()
+		
+		yield session.updateSession(pool, request)
+		sid = request.getCookie(session.COOKIE_KEY)
+		infant = yield session.INFANT_SESSIONS.get(sid)
+		self.failUnlessEqual(infant['id'], sid)
+		self.failUnlessEqual(pool.saved, [])
+		
+		yield session.updateSession(pool, TestSessionRequest(sid))
+		infant = yield session.INFANT_SESSIONS.get(sid)
+		self.failUnlessEqual(infant, None)
+		self.failUnlessEqual(pool.saved[0]['id'], sid)
+
+	@inlineCallbacks
+	def test_shared_invalid_sid(self):
+		client = cache.LRUCache()
+		store = session.SharedInfantSessionStore(client)
+		for sid in ('infant key with spaces', 'x' * 300, None):
+			infant = yield store.get(sid)
+			self.failUnlessEqual(infant, None)
+			infant = yield store.pop(sid)
+			self.failUnlessEqual(infant, None)
+			self.failUnlessRaises(ValueError, store.set, sid, dict(id=sid, created=0))
+		self.failUnlessEqual(client.stats()['misses'], 0)
+
+class SessionCookieTestCase(unittest.TestCase):
+	def setUp(self):
+		pass
+	
+	def tearDown(self):
+		pass
+	
+	def test_unique(self):
+		request = TestSessionRequest()
+		sids = set(session.createSessionCookie(request) for i in range(1000))
+		self.failUnlessEqual(len(sids), 1000)
+		for sid in sids:
+			self.failUnlessEqual(len(sid), 32)
+			self.failUnlessEqual(sid.strip('0123456789abcdef'), '')
+
+class SessionReaperTestCase(unittest.TestCase):
+	def setUp(self):
+		self.pool = TestPool()
+		self.reaper = session.SessionReaper(self.pool, chunk_size=10, max_chunks=3)
+		self.patch(session, 'INFANT_SESSIONS', session.InfantSessionStore())
+		session.INFANT_SESSIONS['old'] = dict(id='old', created=0)
+		session.INFANT_SESSIONS['new'] = dict(id='new', created=int(time.time()))
+	
+	def tearDown(self):
+		pass
+	
+	@inlineCallbacks
+	def test_reap(self):
+		self.pool.expired = 15
+		count = yield self.reaper.reap()
+		
+		self.failUnlessEqual(count, 15)
+		self.failUnlessEqual(self.pool.reaped, [10, 5])
+		self.failUnlessEqual(session.INFANT_SESSIONS.sessions.keys(), ['new'])
+		self.failUnlessEqual(self.reaper.infants_reaped, 1)
+	
+	@inlineCallbacks
+	def test_reap_limited(self):
+		self.pool.expired = 45
+		count = yield self.reaper.reap()
+		self.failUnlessEqual(count, 30)
+		count = yield self.reaper.reap()
+		self.failUnlessEqual(count, 15)
+		
+		self.failUnlessEqual(self.reaper.passes, 2)
+		self.failUnlessEqual(self.reaper.reaped, 45)
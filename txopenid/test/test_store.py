@@ -0,0 +1,333 @@
+# txopenid
+# Copyright (c) 2007 Phil Christensen
+#
+# See LICENSE for details
+
+"""
+Test store module.
+"""
+
+import base64, time, cgi, sqlite3
+
+from twisted.trial import unittest
+
+from txopenid import util, protocol, store
+from txopenid.test.test_protocol import TestRequest
+
+class MemoryStoreTestCase(unittest.TestCase):
+	def setUp(self):
+		self.store = self.createStore()
+	
+	def tearDown(self):
+		pass
+	
+	def createStore(self):
+		return store.MemoryAssociationStore()
+	
+	def test_save(self):
+		association = protocol.OpenIDAssociation()
+		self.store.save(association)
+		
+		self.failUnless(association.handle in self.store)
+		self.failUnlessEqual(len(self.store), 1)
+		
+		found = self.store.get(association.handle)
+		self.failUnlessEqual(found.handle, association.handle)
+		self.failUnlessEqual(found.assoc_type, association.assoc_type)
+		self.failUnlessEqual(found.secret, association.secret)
+		self.failUnlessEqual(found.created, association.created)
+	
+	def test_get_missing(self):
+		self.failUnlessEqual(self.store.get('missing-handle'), None)
+		self.failUnlessEqual(self.store.get(None), None)
+		self.failIf('missing-handle' in self.store)
+	
+	def test_remove(self):
+		association = protocol.OpenIDAssociation()
+		self.store.save(association)
+		self.store.remove(association.handle)
+		
+		self.failIf(association.handle in self.store)
+		self.failUnlessEqual(len(self.store), 0)
+		
+		# removing twice is harmless
+		self.store.remove(association.handle)
+	
+	def test_expire(self):
+		old = protocol.OpenIDAssociation(created=int(time.time()) - 90000)
+		self.store.save(old)
+		new = protocol.OpenIDAssociation()
+		self.store.save(new)
+		
+		self.failUnlessEqual(self.store.expire(), 1)
+		self.failIf(old.handle in self.store)
+		self.failUnless(new.handle in self.store)
+		self.failUnlessEqual(self.store.expire(), 0)
+		self.failUnlessEqual(self.store.expire(new.created + 86400), 1)
+		self.failUnlessEqual(len(self.store), 0)
+
+class MemoryStoreLimitTestCase(unittest.TestCase):
+	def setUp(self):
+		pass
+	
+	def tearDown(self):
+		pass
+	
+	def test_maxsize(self):
+		bank = store.MemoryAssociationStore(maxsize=2)
+		now = int(time.time())
+		associations = [protocol.OpenIDAssociation(created=now + i) for i in range(3)]
+		for association in associations:
+			bank.save(association)
+		
+		self.failUnlessEqual(len(bank), 2)
+		self.failUnlessEqual(bank.evicted, 1)
+		self.failIf(associations[0].handle in bank)
+		self.failUnless(associations[1].handle in bank)
+		self.failUnless(associations[2].handle in bank)
+	
+	def test_removed_not_evicted(self):
+		bank = store.MemoryAssociationStore(maxsize=2)
+		associations = [protocol.OpenIDAssociation() for i in range(3)]
+		bank.save(associations[0])
+		bank.save(associations[1])
+		bank.remove(associations[0].handle)
+		bank.save(associations[2])
+		
+		self.failUnlessEqual(len(bank), 2)
+		self.failUnlessEqual(bank.evicted, 0)
+	
+	def test_registry_sweep(self):
+		registry = protocol.OpenIDRegistry()
+		association = registry.initiate(TestRequest({
+			'openid.mode'			: 'associate',
+		}), True)
+		registry.initiate(TestRequest({
+			'openid.mode'			: 'associate',
+		}), False)
+		
+		self.failUnlessEqual(registry.sweep(), 0)
+		self.failUnlessEqual(registry.sweep(association.created + 86401), 2)
+		
+		stats = registry.stats()
+		self.failUnlessEqual(stats['smart'], dict(live=0, expired=1, evicted=0))
+		self.failUnlessEqual(stats['dumb'], dict(live=0, expired=1, evicted=0))
+
+class SQLiteStoreTestCase(MemoryStoreTestCase):
+	def createStore(self):
+		return store.SQLiteAssociationStore(self.mktemp(), 'smart')
+	
+	def test_banks(self):
+		path = self.mktemp()
+		smart = store.SQLiteAssociationStore(path, 'smart')
+		dumb = store.SQLiteAssociationStore(path, 'dumb')
+		
+		association = protocol.OpenIDAssociation()
+		smart.save(association)
+		
+		self.failUnless(association.handle in smart)
+		self.failIf(association.handle in dumb)
+	
+	def test_shared_registry(self):
+		"""
+		A handle minted by one registry can be validated by another
+		registry using the same database file.
+		"""
+		path = self.mktemp()
+		first = protocol.OpenIDRegistry(store.SQLiteAssociationStore(path, 'smart'),
+										store.SQLiteAssociationStore(path, 'dumb'))
+		second = protocol.OpenIDRegistry(store.SQLiteAssociationStore(path, 'smart'),
+										store.SQLiteAssociationStore(path, 'dumb'))
+		
+		association = first.initiate(TestRequest({
+			'openid.mode'			: 'associate',
+		}), False)
+		
+		token_contents = util.kvstr(mode='id_res',
+								identity='http://www.example.com/test',
+								return_to='http://www.example.com/return')
+		
+		valid_sig = base64.b64encode(util.get_hmac(association.secret, token_contents))
+		
+		result = second.validate(TestRequest({
+			'openid.mode'			: 'check_authentication',
+			'openid.identity'		: 'http://www.example.com/test',
+			'openid.return_to'		: 'http://www.example.com/return',
+			'openid.assoc_handle'	: association.handle,
+			'openid.sig'			: valid_sig,
+			'openid.signed'			: 'identity,mode,return_to',
+		}), False)
+		
+		if not(result):
+			self.fail('Validation failed when it should have passed.')
+
+	def test_upgrade(self):
+		"""
+		Database files made before the expires column existed are upgraded.
+		"""
+		path = self.mktemp()
+		conn = sqlite3.connect(path)
+		conn.execute("CREATE TABLE association ("
+						"bank TEXT NOT NULL, "
+						"handle TEXT NOT NULL, "
+						"assoc_type TEXT NOT NULL, "
+						"secret BLOB NOT NULL, "
+						"created INTEGER NOT NULL, "
+						"expires_in INTEGER NOT NULL, "
+						"PRIMARY KEY (bank, handle))")
+		now = int(time.time())
+		conn.execute("INSERT INTO association VALUES ('smart', 'old', 'HMAC-SHA1', ?, ?, 86400)",
+			[sqlite3.Binary('x' * 20), now - 90000])
+		conn.execute("INSERT INTO association VALUES ('smart', 'new', 'HMAC-SHA1', ?, ?, 86400)",
+			[sqlite3.Binary('y' * 20), now])
+		conn.commit()
+		conn.close()
+		
+		bank = store.SQLiteAssociationStore(path, 'smart')
+		self.failUnlessEqual(bank.get('new').expires, now + 86400)
+		self.failUnlessEqual(bank.expire(), 1)
+		self.failIf('old' in bank)
+		
+		# opening it again leaves it alone
+		bank = store.SQLiteAssociationStore(path, 'smart')
+		self.failUnless('new' in bank)
+
+class StatelessStoreTestCase(unittest.TestCase):
+	def setUp(self):
+		self.master_key = store.MasterKey('some master secret')
+		self.store = store.StatelessAssociationStore(self.master_key, 'smart')
+	
+	def tearDown(self):
+		pass
+	
+	def test_create(self):
+		association = self.store.create({}, 'HMAC-SHA1')
+		
+		found = self.store.get(association.handle)
+		self.failUnlessEqual(found.handle, association.handle)
+		self.failUnlessEqual(found.assoc_type, 'HMAC-SHA1')
+		self.failUnlessEqual(found.secret, association.secret)
+		self.failUnlessEqual(found.created, association.created)
+		self.failUnlessEqual(found.expires_in, 86400)
+		self.failUnless(association.handle in self.store)
+	
+	def test_create_sha256(self):
+		association = self.store.create({}, 'HMAC-SHA256')
+		self.failUnlessEqual(len(association.secret), 32)
+		
+		found = self.store.get(association.handle)
+		self.failUnlessEqual(found.assoc_type, 'HMAC-SHA256')
+		self.failUnlessEqual(found.secret, association.secret)
+	
+	def test_create_unsupported(self):
+		self.failUnlessRaises(NotImplementedError, self.store.create, {}, 'HMAC-MD5')
+	
+	def test_unique(self):
+		first = self.store.create({}, 'HMAC-SHA1')
+		second = self.store.create({}, 'HMAC-SHA1')
+		self.failIfEqual(first.handle, second.handle)
+		self.failIfEqual(first.secret, second.secret)
+	
+	def test_tampered(self):
+		association = self.store.create({}, 'HMAC-SHA1')
+		raw = base64.b64decode(association.handle)
+		tampered = base64.b64encode(raw[:10] + chr(ord(raw[10]) ^ 1) + raw[11:])
+		
+		self.failUnlessEqual(self.store.get(tampered), None)
+		self.failUnlessEqual(self.store.get('not a handle'), None)
+		self.failUnlessEqual(self.store.get(None), None)
+	
+	def test_other_bank(self):
+		association = self.store.create({}, 'HMAC-SHA1')
+		dumb = store.StatelessAssociationStore(self.master_key, 'dumb')
+		self.failUnlessEqual(dumb.get(association.handle), None)
+	
+	def test_other_master_key(self):
+		association = self.store.create({}, 'HMAC-SHA1')
+		other = store.StatelessAssociationStore(store.MasterKey('another secret'), 'smart')
+		self.failUnlessEqual(other.get(association.handle), None)
+	
+	def test_retired_key(self):
+		epoch = self.master_key.epoch()
+		self.failIfEqual(self.master_key.getKey(epoch - 1), None)
+		self.failUnlessEqual(self.master_key.getKey(epoch - 2), None)
+		self.failUnlessEqual(self.master_key.getKey(epoch + 1), None)
+	
+	def test_fromFile(self):
+		path = self.mktemp()
+		first = store.MasterKey.fromFile(path)
+		second = store.MasterKey.fromFile(path)
+		self.failUnlessEqual(first.secret, second.secret)
+		self.failUnlessEqual(len(first.secret), 32)
+	
+	def test_login_response_smart(self):
+		"""
+		Login responses are signed with the secret the store derived
+		for the association, not one derived from the handle.
+		"""
+		registry = protocol.OpenIDRegistry(self.store,
+			store.StatelessAssociationStore(self.master_key, 'dumb'))
+		association = registry.initiate(TestRequest({
+			'openid.mode'			: 'associate',
+		}), True)
+		
+		response = protocol.get_login_response(registry, TestRequest({
+			'openid.mode'			: 'checkid_immediate',
+			'openid.identity'		: 'http://www.example.com/test',
+			'openid.assoc_handle'	: association.handle,
+			'openid.return_to'		: 'http://www.example.com/return',
+		}))
+		
+		query = cgi.parse_qs(response.split('?', 1)[1])
+		self.failUnlessEqual(query['openid.assoc_handle'], [association.handle])
+		result = registry.validate(TestRequest([(key, value[0]) for key, value in query.items()]), True)
+		if not(result):
+			self.fail('Validation failed when it should have passed.')
+	
+	def test_login_response_dumb(self):
+		registry = protocol.OpenIDRegistry(self.store,
+			store.StatelessAssociationStore(self.master_key, 'dumb'))
+		
+		response = protocol.get_login_response(registry, TestRequest({
+			'openid.mode'			: 'checkid_setup',
+			'openid.identity'		: 'http://www.example.com/test',
+			'openid.return_to'		: 'http://www.example.com/return',
+		}))
+		
+		query = cgi.parse_qs(response.split('?', 1)[1])
+		result = registry.validate(TestRequest([(key, value[0]) for key, value in query.items()]), False)
+		if not(result):
+			self.fail('Validation failed when it should have passed.')
+	
+	def test_shared_registry(self):
+		"""
+		Registries in different processes only need to share the master secret.
+		"""
+		first = protocol.OpenIDRegistry(
+			store.StatelessAssociationStore(store.MasterKey('some master secret'), 'smart'),
+			store.StatelessAssociationStore(store.MasterKey('some master secret'), 'dumb'))
+		second = protocol.OpenIDRegistry(
+			store.StatelessAssociationStore(store.MasterKey('some master secret'), 'smart'),
+			store.StatelessAssociationStore(store.MasterKey('some master secret'), 'dumb'))
+		
+		association = first.initiate(TestRequest({
+			'openid.mode'			: 'associate',
+		}), False)
+		
+		token_contents = util.kvstr(mode='id_res',
+								identity='http://www.example.com/test',
+								return_to='http://www.example.com/return')
+		
+		valid_sig = base64.b64encode(util.get_hmac(association.secret, token_contents))
+		
+		result = second.validate(TestRequest({
+			'openid.mode'			: 'check_authentication',
+			'openid.identity'		: 'http://www.example.com/test',
+			'openid.return_to'		: 'http://www.example.com/return',
+			'openid.assoc_handle'	: association.handle,
+			'openid.sig'			: valid_sig,
+			'openid.signed'			: 'identity,mode,return_to',
+		}), False)
+		
+		if not(result):
+			self.fail('Validation failed when it should have passed.')
@@ -0,0 +1,58 @@
+# txopenid
+# Copyright (c) 2007 Phil Christensen
+#
+# See LICENSE for details
+
+"""
+Test template module.
+"""
+
+from twisted.trial import unittest
+
+from nevow import tags, flat
+
+from txopenid import template
+
+class FragmentTestCase(unittest.TestCase):
+	def setUp(self):
+		pass
+	
+	def tearDown(self):
+		pass
+	
+	def test_render(self):
+		fragment = template.Fragment(tags.p(_class='x')[tags.strong()[tags.slot('url')]])
+		self.failUnlessEqual(fragment.render(url='http://www.example.com/'),
+			'<p class="x"><strong>http://www.example.com/</strong></p>')
+	
+	def test_escape(self):
+		fragment = template.Fragment(tags.input(type='hidden', name=tags.slot('name'), value=tags.slot('value')))
+		stan = tags.input(type='hidden', name='a"b', value='<&>')
+		self.failUnlessEqual(fragment.render(name='a"b', value='<&>'), flat.flatten(stan))
+		
+		fragment = template.Fragment(tags.p()[tags.slot('text')])
+		self.failUnlessEqual(fragment.render(text='"<&>"'), flat.flatten(tags.p()['"<&>"']))
+		self.failUnlessEqual(fragment.render(text=u'caf\xe9'), '<p>caf\xc3\xa9</p>')
+	
+	def test_markup(self):
+		fragment = template.Fragment(tags.ul()[tags.slot('items')])
+		self.failUnlessEqual(fragment.render(items=tags.xml('<li>one</li>')), '<ul><li>one</li></ul>')
+	
+	def test_call(self):
+		fragment = template.Fragment(tags.br())
+		result = fragment()
+		self.failUnless(isinstance(result, tags.xml))
+		self.failUnlessEqual(result.content, '<br />')
+
+class LoadTestCase(unittest.TestCase):
+	def setUp(self):
+		pass
+	
+	def tearDown(self):
+		pass
+	
+	def test_precompiled(self):
+		docFactory = template.load('login-page.xml')
+		doc = docFactory.load()
+		self.failUnlessIdentical(docFactory.load(), doc)
+		self.failUnless(isinstance(doc[0], str))
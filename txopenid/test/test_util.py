@@ -7,9 +7,10 @@
 Test util module.
 """
 
-import sha, cgi
+import sha, cgi, random, pickle, hashlib, binascii
 
 from twisted.trial import unittest
+from twisted.python import log
 
 from txopenid import util, protocol
 
@@ -32,16 +33,66 @@ class UtilityTestCase(unittest.TestCase):
 		got = util.mklong(value)
 		self.failUnlessEqual(got, expected, "Got %r when expecting %r" % (got, expected))
 	
+	def test_btwoc_roundtrip(self):
+		for bits in range(1, protocol.DH_P_VALUE.bit_length() + 1):
+			for value in (random.getrandbits(bits) | (1 << (bits - 1)), (1 << bits) - 1, 1 << (bits - 1)):
+				encoded = util.btwoc(value)
+				self.failUnlessEqual(util.mklong(encoded), value)
+				# positive values never have the sign bit set, and use the fewest bytes
+				self.failIf(ord(encoded[0]) & 0x80)
+				self.failUnlessEqual(len(encoded), (bits // 8) + 1)
+				
+				self.failUnlessEqual(util.mklong(util.btwoc(-value)), -value)
+		
+		self.failUnlessEqual(util.mklong(util.btwoc(protocol.DH_P_VALUE)), protocol.DH_P_VALUE)
+	
+	def test_btwoc_edges(self):
+		self.failUnlessEqual(util.btwoc(0), '')
+		self.failUnlessEqual(util.mklong(''), 0)
+		self.failUnlessEqual(util.btwoc(127), '\x7f')
+		self.failUnlessEqual(util.btwoc(128), '\x00\x80')
+		self.failUnlessEqual(util.btwoc(-1), '\xff')
+		self.failUnlessEqual(util.btwoc(-128), '\x80')
+		self.failUnlessEqual(util.btwoc(-129), '\xff\x7f')
+		self.failUnlessEqual(util.mklong('\x00\x00\x80'), 128)
+	
+	def test_btwoc_pickle(self):
+		"""
+		The encoding matches the pickle-based one this replaced.
+		"""
+		def pickle_btwoc(value):
+			l = list(pickle.encode_long(value))
+			l.reverse()
+			return ''.join(l)
+		
+		for bits in range(1, protocol.DH_P_VALUE.bit_length() + 1, 7):
+			value = random.getrandbits(bits)
+			self.failUnlessEqual(util.btwoc(value), pickle_btwoc(value))
+			self.failUnlessEqual(util.btwoc(-value), pickle_btwoc(-value))
+	
 	def test_mkkey(self):
 		got = util.mkkey()
 		self.failUnlessEqual(len(str(got)), 100)
 	
+	def test_strxor(self):
+		self.failUnlessEqual(util.strxor('\x00\xff\x0f', '\xff\xff\x00'), '\xff\x00\x0f')
+		self.failUnlessEqual(util.strxor('\x00\x01', '\x00\x01'), '\x00\x00')
+		self.failUnlessEqual(util.strxor('', ''), '')
+		self.failUnlessRaises(ValueError, util.strxor, 'a', 'ab')
+	
 	def test_secret_sha1(self):
 		value = 'some string'
 		expected = '\x8bE\xe4\xbd\x1cj\xcb\x88\xbe\xbfd\x07\xd1b\x05\xf5g\xe6*>'
 		got = util.secret(value)
 		self.failUnlessEqual(got, expected, "Got %r when expecting %r" % (got, expected))
 	
+	def test_secret_sha256(self):
+		value = 'some string'
+		expected = hashlib.sha256(value).digest()
+		got = util.secret(value, 'HMAC-SHA256')
+		self.failUnlessEqual(len(got), 32)
+		self.failUnlessEqual(got, expected, "Got %r when expecting %r" % (got, expected))
+	
 	def test_secret_invalid(self):
 		self.failUnlessRaises(NotImplementedError, util.secret, 'some string', 'otherhashmethod')
 	
@@ -52,6 +103,22 @@ class UtilityTestCase(unittest.TestCase):
 		got = util.get_hmac(key, message)
 		self.failUnlessEqual(got, expected, "Got %r when expecting %r" % (got, expected))
 	
+	def test_get_hmac_sha256(self):
+		# RFC 4231, test case 2
+		expected = binascii.unhexlify('5bdcc146bf60754e6a042426089575c75a003f089d2739839dec58b964ec3843')
+		got = util.get_hmac('Jefe', 'what do ya want for nothing?', 'HMAC-SHA256')
+		self.failUnlessEqual(got, expected, "Got %r when expecting %r" % (got, expected))
+	
+	def test_get_hmac_invalid(self):
+		self.failUnlessRaises(NotImplementedError, util.get_hmac, 'some key', 'some message', 'otherhashmethod')
+	
+	def test_compare_digest(self):
+		digest = util.get_hmac('some key', 'some message')
+		self.failUnless(util.compare_digest(digest, digest[:]))
+		self.failIf(util.compare_digest(digest, digest[:-1] + chr(ord(digest[-1]) ^ 1)))
+		self.failIf(util.compare_digest(digest, digest[:-1]))
+		self.failIf(util.compare_digest(digest, ''))
+	
 	def test_handle(self):
 		h = util.handle()
 		
@@ -60,6 +127,49 @@ class UtilityTestCase(unittest.TestCase):
 			if(ord(c) < 0 or ord(c) > 255):
 				self.fail('Found invalid character in handle string.')
 	
+	def test_handle_unique(self):
+		handles = set(util.handle() for i in range(1000))
+		self.failUnlessEqual(len(handles), 1000)
+	
+	def test_hextoken(self):
+		tokens = set(util.hextoken() for i in range(1000))
+		self.failUnlessEqual(len(tokens), 1000)
+		for t in tokens:
+			self.failUnlessEqual(len(t), 32)
+			self.failUnlessEqual(t.strip('0123456789abcdef'), '')
+	
+	def test_token_pool_refill(self):
+		pool = util.TokenPool(size=100)
+		first = pool.read(60)
+		second = pool.read(60)
+		self.failUnlessEqual(len(first), 60)
+		self.failUnlessEqual(len(second), 60)
+		self.failIfEqual(first, second)
+		self.failUnlessEqual(len(pool.read(250)), 250)
+	
+	def test_token_pool_fork(self):
+		pool = util.TokenPool()
+		pool.read(16)
+		buffered = pool.buffer
+		
+		# pretend this is a child process with a copy of the buffer
+		pool.pid = -1
+		pool.read(16)
+		self.failIfEqual(pool.buffer, buffered)
+	
+	def test_token_entropy(self):
+		"""
+		Every byte value should turn up about as often as every other.
+		"""
+		data = util.token(256 * 1000)
+		counts = [0] * 256
+		for c in data:
+			counts[ord(c)] += 1
+		
+		chi2 = sum([(count - 1000) ** 2 / 1000.0 for count in counts])
+		# 255 degrees of freedom; a chance failure here is far below one in a million
+		self.failUnless(chi2 < 400, 'byte distribution is skewed (chi2 = %f)' % chi2)
+	
 	def test_kvstr(self):
 		value = dict(
 			one		= 1,
@@ -70,6 +180,13 @@ class UtilityTestCase(unittest.TestCase):
 		got = util.kvstr(**value)
 		self.failUnlessEqual(got, expected, "Got %r when expecting %r" % (got, expected))
 	
+	def test_kvstr_unmodified(self):
+		value = {'openid.mode':'id_res'}
+		expected = 'is_valid:true\nopenid.mode:id_res\n'
+		got = util.kvstr(value, is_valid='true')
+		self.failUnlessEqual(got, expected, "Got %r when expecting %r" % (got, expected))
+		self.failUnlessEqual(value, {'openid.mode':'id_res'})
+	
 	def test_appendQuery_base(self):
 		return_to = 'http://www.example.com'
 		error = dict(error='some error occurred')
@@ -90,3 +207,29 @@ class UtilityTestCase(unittest.TestCase):
 		expected = 'http://www.example.com/some/path/?error=some+error+occurred'
 		got = util.appendQuery(return_to, error)
 		self.failUnlessEqual(got, expected, "Got %r when expecting %r" % (got, expected))
+	
+	def test_debug_disabled(self):
+		class Unformattable(object):
+			def __repr__(self):
+				raise AssertionError('disabled debug message was formatted')
+		
+		events = []
+		log.addObserver(events.append)
+		try:
+			util.debug('value: %r', Unformattable())
+		finally:
+			log.removeObserver(events.append)
+		self.failUnlessEqual(events, [])
+	
+	def test_debug_enabled(self):
+		events = []
+		log.addObserver(events.append)
+		util.set_log_level(util.DEBUG)
+		try:
+			util.debug('value: %r', 'something')
+		finally:
+			util.set_log_level(util.INFO)
+			log.removeObserver(events.append)
+		self.failUnlessEqual(len(events), 1)
+		self.failUnlessEqual(events[0]['message'], ("value: 'something'",))
+		self.failUnlessEqual(events[0]['logLevel'], util.DEBUG)
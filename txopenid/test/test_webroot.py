@@ -0,0 +1,92 @@
+# txopenid
+# Copyright (c) 2007 Phil Christensen
+#
+# See LICENSE for details
+
+"""
+Test webroot module.
+"""
+
+import gzip, cStringIO
+
+from twisted.trial import unittest
+
+from nevow import testutil, context
+
+from txopenid import webroot, template
+
+class AssetsResourceTestCase(unittest.TestCase):
+	def setUp(self):
+		self.asset = webroot.Asset('global.css', 'body { color: black; }\n' * 20)
+		self.resource = webroot.AssetsResource({
+			self.asset.name					: self.asset,
+			self.asset.fingerprinted_name	: self.asset,
+		})
+	
+	def tearDown(self):
+		pass
+	
+	def render(self, name, **headers):
+		request = testutil.FakeRequest(headers=headers)
+		ctx = context.RequestContext(tag=request)
+		child, segments = self.resource.locateChild(ctx, name.split('/'))
+		if(child is None):
+			return request, None
+		return request, child.renderHTTP(ctx)
+	
+	def test_fingerprinted(self):
+		request, body = self.render(self.asset.fingerprinted_name)
+		
+		self.failUnlessEqual(body, self.asset.body)
+		self.failUnlessEqual(request.headers['content-type'], 'text/css')
+		self.failUnlessEqual(request.headers['etag'], self.asset.etag)
+		self.failUnless('immutable' in request.headers['cache-control'])
+	
+	def test_plain(self):
+		request, body = self.render('global.css')
+		
+		self.failUnlessEqual(body, self.asset.body)
+		self.failIf('immutable' in request.headers['cache-control'])
+	
+	def test_missing(self):
+		request, body = self.render('missing.css')
+		self.failUnlessEqual(body, None)
+	
+	def test_not_modified(self):
+		request, body = self.render('global.css', **{'if-none-match':'"other", %s' % self.asset.etag})
+		
+		self.failUnlessEqual(body, '')
+		self.failUnlessEqual(request.code, 304)
+	
+	def test_not_modified_gzipped(self):
+		request, body = self.render('global.css', **{
+			'if-none-match'		: self.asset.gzipped_etag,
+			'accept-encoding'	: 'gzip',
+		})
+		
+		self.failUnlessEqual(body, '')
+		self.failUnlessEqual(request.code, 304)
+		self.failUnlessEqual(request.headers['etag'], self.asset.gzipped_etag)
+	
+	def test_gzip(self):
+		request, body = self.render('global.css', **{'accept-encoding':'deflate, gzip'})
+		
+		self.failUnlessEqual(request.headers['content-encoding'], 'gzip')
+		self.failUnlessEqual(request.headers['etag'], self.asset.gzipped_etag)
+		self.failIfEqual(self.asset.gzipped_etag, self.asset.etag)
+		self.failUnlessEqual(request.headers['content-length'], str(len(body)))
+		self.failUnlessEqual(gzip.GzipFile(fileobj=cStringIO.StringIO(body)).read(), self.asset.body)
+		
+		request, body = self.render('global.css', **{'accept-encoding':'gzip;q=0'})
+		self.failUnlessEqual(body, self.asset.body)
+	
+	def test_fingerprint_changes(self):
+		other = webroot.Asset('global.css', 'body { color: white; }\n')
+		self.failIfEqual(other.fingerprinted_name, self.asset.fingerprinted_name)
+		self.failIfEqual(other.etag, self.asset.etag)
+		self.failUnless(other.fingerprinted_name.startswith('global.'))
+		self.failUnless(other.fingerprinted_name.endswith('.css'))
+	
+	def test_template_links(self):
+		doc = ''.join([x for x in template.load('login-page.xml').load() if isinstance(x, str)])
+		self.failUnless(webroot.url('global.css') in doc)
@@ -12,6 +12,12 @@ from txopenid import db
 class User(dict):
 	"""
 	Simple dict subclass to represent user records.
+	
+	@ivar known_identities: identity checks already answered by the db code
+	@type known_identities: dict(str => bool)
+	
+	@ivar known_roots: trust checks already answered by the db code
+	@type known_roots: dict(str => bool)
 	"""
 	def __init__(self, data=None):
 		"""
@@ -19,8 +25,10 @@ class User(dict):
 		"""
 		if(data):
 			self.update(data)
-		# This will be set by the db code
+		# These will be set by the db code
 		self.pool = None
+		self.known_identities = {}
+		self.known_roots = {}
 	
 	def getIdentities(self):
 		"""
@@ -32,6 +40,8 @@ class User(dict):
 		"""
 		Does this user have the provided identity?
 		"""
+		if(identity in self.known_identities):
+			return self.known_identities[identity]
 		return self.pool.checkUserIdentity(self, identity)
 	
 	def getTrustedRoots(self):
@@ -44,4 +54,6 @@ class User(dict):
 		"""
 		Does this user trust the provided root?
 		"""
+		if(root in self.known_roots):
+			return self.known_roots[root]
 		return self.pool.checkUserTrust(self, root)
@@ -5,93 +5,281 @@
 
 """
 OpenID utility functions.
+
+@var DEBUG: log level for protocol debugging messages
+@type DEBUG: int
+
+@var INFO: log level for routine operational messages
+@type INFO: int
+
+@var LOG_LEVEL: messages below this level are discarded without being formatted
+@type LOG_LEVEL: int
+
+@var ASSOC_TYPES: hash constructors for each supported association type
+@type ASSOC_TYPES: dict(str => callable)
+
+@var TOKEN_POOL: source of the random bytes used for handles and session ids
+@type TOKEN_POOL: L{TokenPool}
 """
 
-import pickle, random, sha, hmac, urllib
+import os, binascii, random, hashlib, hmac, urllib, logging, threading
 
 from twisted.python import log
 
 from nevow import url
 
+from txopenid import kvform
+
+DEBUG = logging.DEBUG
+INFO = logging.INFO
+
+LOG_LEVEL = INFO
+
+ASSOC_TYPES = {
+	'HMAC-SHA1'		: hashlib.sha1,
+	'HMAC-SHA256'	: hashlib.sha256,
+}
+
+_system_random = random.SystemRandom()
+
+def set_log_level(level):
+	"""
+	Discard log messages below the provided level.
+	
+	@param level: the lowest level to log, e.g., L{DEBUG}
+	@type level: int
+	"""
+	global LOG_LEVEL
+	LOG_LEVEL = level
+
+def debug(message, *args):
+	"""
+	Log a debugging message.
+	
+	Formatting is deferred until we know the message will be logged,
+	so disabled debug messages are cheap, even with expensive arguments.
+	
+	@param message: a format string
+	@type message: str
+	
+	@param *args: values for the format string
+	"""
+	if(LOG_LEVEL <= DEBUG):
+		log.msg(message % args, logLevel=DEBUG)
+
+def info(message, *args):
+	"""
+	Log an informational message.
+	
+	@see: L{debug}
+	"""
+	if(LOG_LEVEL <= INFO):
+		log.msg(message % args, logLevel=INFO)
+
 def btwoc(value):
 	"""
 	Given some kind of integer (generally a long), this function
 	returns the big-endian two's complement as a binary string.
+	
+	The shortest string that can represent the value is returned,
+	so positive values with the high bit set get a leading zero
+	byte, and zero is the empty string.
 	"""
-	l = list(pickle.encode_long(value))
-	l.reverse()
-	result = ''.join(l)
-	log.msg('[bwtwoc] given %r, made %r' % (value, result))
-	return result
+	if(value == 0):
+		return ''
+	if(value < 0):
+		size = ((-value - 1).bit_length() // 8) + 1
+		value += 1 << (size * 8)
+	else:
+		size = (value.bit_length() // 8) + 1
+	digits = '%x' % value
+	return binascii.unhexlify(digits.zfill(size * 2))
 
 def mklong(btwoc):
 	"""
 	Given a big-endian two's complement string, return the
 	long int it represents.
 	"""
-	l = list(btwoc)
-	l.reverse()
-	result = pickle.decode_long(''.join(l))
-	log.msg('[mklong] given %r, made %r' % (btwoc, result))
+	if not(btwoc):
+		return 0L
+	result = long(binascii.hexlify(btwoc), 16)
+	if(ord(btwoc[0]) & 0x80):
+		result -= 1L << (len(btwoc) * 8)
 	return result
 
 def mkkey():
 	"""
 	Return a random 100-digit number to use as a Diffie-Hellman
 	key value.
+	
+	The number comes from os.urandom, via random.SystemRandom.
 	"""
 	start = int('1' + ('0' * 99))
 	end = int('9' * 100)
-	return random.randint(start, end)
+	return _system_random.randint(start, end)
+
+def strxor(a, b):
+	"""
+	Return the XOR of two strings of the same length.
+	"""
+	if(len(a) != len(b)):
+		raise ValueError("strings must be the same length")
+	if not(a):
+		return ''
+	result = long(binascii.hexlify(a), 16) ^ long(binascii.hexlify(b), 16)
+	return binascii.unhexlify('%0*x' % (len(a) * 2, result))
+
+def get_hash(assoc_type):
+	"""
+	Return the hash constructor for the given association type.
+	
+	@raise NotImplementedError: if the association type isn't supported
+	"""
+	try:
+		return ASSOC_TYPES[assoc_type]
+	except KeyError:
+		raise NotImplementedError("invalid assoc_handle type: %s" % assoc_type)
 
 def secret(assoc_handle, assoc_type='HMAC-SHA1'):
 	"""
 	Take the given handle and create a secret using the
-	given hash type. OpenID 1.1 doesn't support anything
-	but SHA1 at this time, so this is a pretty simple
-	function.
+	given hash type. The secret is as long as the digest,
+	as each association type requires.
 	"""
-	if(assoc_type == 'HMAC-SHA1'):
-		result = sha.new(assoc_handle).digest()
-		log.msg('[secret] given %r, made %r' % (assoc_handle, result))
-		return result
-	raise NotImplementedError("invalid assoc_handle type: %s" % assoc_type)
+	return get_hash(assoc_type)(assoc_handle).digest()
 
-def get_hmac(key, message):
+def get_hmac(key, message, assoc_type='HMAC-SHA1'):
 	"""
 	Encrypt the given message with the specified key.
 	"""
-	result = hmac.new(key, message, sha).digest()
-	log.msg('[hmac] given %r for %r, made %r' % (key, message, result))
+	result = hmac.new(key, message, get_hash(assoc_type)).digest()
 	return result
 
+def prepare_hmac(key, assoc_type='HMAC-SHA1'):
+	"""
+	Return an HMAC object keyed with the given key, but not yet
+	fed any message.
+	
+	Setting up the padded inner and outer key state is most of the
+	cost of signing a short message; callers can keep the result
+	and sign each message with a copy of it.
+	"""
+	return hmac.new(key, digestmod=get_hash(assoc_type))
+
+try:
+	from hmac import compare_digest
+except ImportError:
+	def compare_digest(a, b):
+		"""
+		Are the two strings equal?
+		
+		The comparison takes as long wherever the strings differ, so it
+		doesn't reveal how much of a forged signature was correct.
+		"""
+		if(len(a) != len(b)):
+			return False
+		result = 0
+		for x, y in zip(a, b):
+			result |= ord(x) ^ ord(y)
+		return result == 0
+
+class TokenPool(object):
+	"""
+	Random bytes from os.urandom, read in bulk and handed out in pieces.
+	
+	Reading the OS entropy source is a system call, so doing it once per
+	handle or session id is far slower than slicing a larger buffer. The
+	buffer is discarded after a fork, so a child process never hands out
+	the same bytes as its parent.
+	
+	@ivar size: bytes to read from os.urandom at a time
+	@type size: int
+	"""
+	def __init__(self, size=4096):
+		"""
+		Create a new, empty pool.
+		
+		@param size: bytes to read from os.urandom at a time
+		@type size: int
+		"""
+		self.size = size
+		self.buffer = ''
+		self.offset = 0
+		self.pid = None
+		self.lock = threading.Lock()
+	
+	def read(self, nbytes):
+		"""
+		Return the requested number of random bytes.
+		
+		Bytes are never returned more than once.
+		
+		@rtype: str
+		"""
+		self.lock.acquire()
+		try:
+			if(self.offset + nbytes > len(self.buffer) or self.pid != os.getpid()):
+				self.buffer = os.urandom(max(self.size, nbytes))
+				self.offset = 0
+				self.pid = os.getpid()
+			result = self.buffer[self.offset:self.offset + nbytes]
+			self.offset += nbytes
+			return result
+		finally:
+			self.lock.release()
+
+TOKEN_POOL = TokenPool()
+
+def token(nbytes=16):
+	"""
+	Return a string of random bytes, suitable for use as a secret.
+	
+	@param nbytes: length of the result
+	@type nbytes: int
+	"""
+	return TOKEN_POOL.read(nbytes)
+
+def hextoken(nbytes=16):
+	"""
+	Return a hex-encoded string of random bytes, suitable for use in a cookie.
+	
+	@param nbytes: number of random bytes; the result is twice as long
+	@type nbytes: int
+	"""
+	return binascii.hexlify(TOKEN_POOL.read(nbytes))
+
 def handle():
 	"""
 	Generate a random 8-bit string.
 	"""
-	result = ''
-	for i in range(64):
-		result += chr(random.randint(0,255))
-	return result
+	return token(64)
 
 def kvstr(data=None, **kwargs):
 	"""
 	Take the provided keyword arguments and return
 	a newline-separated list of key-value pairs
+	
+	The provided dict isn't modified.
+	
+	@see: L{txopenid.kvform.encode}
 	"""
 	if(data is None):
-		data = {}
-	data.update(kwargs)
-	
-	keys = data.keys()
-	keys.sort()
-	return ''.join(['%s:%s\n' % (x, data[x]) for x in keys])
+		data = kwargs
+	elif(kwargs):
+		data = dict(data, **kwargs)
+	return kvform.encode(data)
 
-def handleError(requestData, error):
+def handleError(request, requestData, error):
 	"""
 	Given some error during the provided request, generate the proper response format.
+	
+	@param request: the current request
+	@type request: L{nevow.appserver.NevowRequest}
+	
+	@param requestData: the current request data
+	@type requestData: L{txopenid.protocol.OpenIDRequest}
 	"""
-	if(requestData.request.method == 'GET'):
+	if(request.method == 'GET'):
 		if('openid.return_to' in requestData):
 			redirect_dict = {
 				'openid.mode'	: 'error',
@@ -99,13 +287,13 @@ def handleError(requestData, error):
 			}
 			output = url.URL.fromString(appendQuery(requestData['openid.return_to'], redirect_dict))
 		elif(requestData):
-			requestData.request.setResponseCode(400)
+			request.setResponseCode(400)
 			output = kvstr(error="A server error occurred: %s" % error)
 		# an empty GET
 		else:
 			output = 'This is an OpenID server endpoint. For more information, see http://openid.net'
 	else:
-		requestData.request.setResponseCode(400)
+		request.setResponseCode(400)
 		output = kvstr(error="A server error occurred: %s" % error)
 	return output
 
@@ -0,0 +1,251 @@
+# txopenid
+# Copyright (c) 2007 Phil Christensen
+#
+# See LICENSE for details
+
+"""
+Static asset serving.
+
+Every file in the assets webroot is read into memory once, along with
+a gzipped copy, and given a fingerprinted name containing a hash of its
+contents. Pages link to the fingerprinted name (see L{url}), which can
+be cached by browsers forever; the plain name still works, but is only
+cached for a short time.
+
+@var ASSETS_URL: path the L{AssetsResource} is published under
+@type ASSETS_URL: str
+
+@var IMMUTABLE_MAX_AGE: seconds to cache a fingerprinted asset
+@type IMMUTABLE_MAX_AGE: int
+
+@var MAX_AGE: seconds to cache an asset requested by its plain name
+@type MAX_AGE: int
+
+@var WEBROOT_PATH: directory the assets are loaded from
+@type WEBROOT_PATH: str
+"""
+
+import os, sha, gzip, mimetypes, cStringIO
+
+from zope.interface import implements
+
+from twisted.web import http
+
+from nevow import inevow
+
+from txopenid import assets
+
+ASSETS_URL = '/assets/'
+IMMUTABLE_MAX_AGE = 31536000
+MAX_AGE = 3600
+
+WEBROOT_PATH = os.path.join(os.path.dirname(os.path.abspath(assets.__file__)), 'webroot')
+
+_assets = None
+
+class Asset(object):
+	"""
+	A static file, held in memory.
+	
+	@ivar name: path of this file, relative to the webroot
+	@type name: str
+	
+	@ivar fingerprinted_name: name, with a hash of the contents before the extension
+	@type fingerprinted_name: str
+	
+	@ivar body: file contents
+	@type body: str
+	
+	@ivar gzipped: gzipped file contents, or None if compression doesn't help
+	@type gzipped: str
+	
+	@ivar etag: entity tag of the uncompressed contents
+	@type etag: str
+	
+	@ivar gzipped_etag: entity tag of the gzipped contents; a strong ETag
+		has to differ between content-codings
+	@type gzipped_etag: str
+	"""
+	__slots__ = ('name', 'fingerprinted_name', 'content_type', 'etag', 'gzipped_etag', 'body', 'gzipped')
+	
+	def __init__(self, name, body):
+		"""
+		Create an asset with the provided name and contents.
+		"""
+		self.name = name
+		self.body = body
+		
+		digest = sha.new(body).hexdigest()
+		self.etag = '"%s"' % digest[:16]
+		self.gzipped_etag = '"%s-gz"' % digest[:16]
+		base, ext = os.path.splitext(name)
+		self.fingerprinted_name = '%s.%s%s' % (base, digest[:8], ext)
+		self.content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+		
+		buf = cStringIO.StringIO()
+		compressor = gzip.GzipFile(filename='', mode='wb', fileobj=buf, mtime=0)
+		compressor.write(body)
+		compressor.close()
+		self.gzipped = buf.getvalue()
+		if(len(self.gzipped) >= len(body)):
+			self.gzipped = None
+
+def load(path=WEBROOT_PATH):
+	"""
+	Read every file under the provided path.
+	
+	@return: assets by both plain and fingerprinted name
+	@rtype: dict(str => L{Asset})
+	"""
+	result = {}
+	for dirpath, dirnames, filenames in os.walk(path):
+		for filename in filenames:
+			fullpath = os.path.join(dirpath, filename)
+			name = os.path.relpath(fullpath, path).replace(os.sep, '/')
+			asset = Asset(name, open(fullpath, 'rb').read())
+			result[asset.name] = asset
+			result[asset.fingerprinted_name] = asset
+	return result
+
+def get_assets():
+	"""
+	Return the assets in the webroot, loading them the first time.
+	
+	@rtype: dict(str => L{Asset})
+	"""
+	global _assets
+	if(_assets is None):
+		_assets = load()
+	return _assets
+
+def url(name):
+	"""
+	Return the fingerprinted URL for the named asset.
+	
+	@param name: path of the file, relative to the webroot
+	@type name: str
+	"""
+	return ASSETS_URL + get_assets()[name].fingerprinted_name
+
+class AssetsResource(object):
+	"""
+	Serve assets from memory, with caching headers and gzip compression.
+	"""
+	implements(inevow.IResource)
+	
+	def __init__(self, assets=None):
+		"""
+		Create a resource for the provided assets.
+		
+		@param assets: assets by name, defaults to the webroot
+		@type assets: dict(str => L{Asset})
+		"""
+		if(assets is None):
+			assets = get_assets()
+		self.assets = assets
+	
+	def locateChild(self, ctx, segments):
+		"""
+		@see: L{nevow.inevow.IResource}
+		"""
+		name = '/'.join(segments)
+		asset = self.assets.get(name)
+		if(asset is None):
+			return None, ()
+		return AssetResource(asset, name == asset.fingerprinted_name), ()
+	
+	def renderHTTP(self, ctx):
+		"""
+		@see: L{nevow.inevow.IResource}
+		"""
+		request = inevow.IRequest(ctx)
+		request.setResponseCode(http.NOT_FOUND)
+		return ''
+
+class AssetResource(object):
+	"""
+	Serve a single asset.
+	
+	@ivar immutable: was the asset requested by its fingerprinted name?
+	@type immutable: bool
+	"""
+	implements(inevow.IResource)
+	
+	def __init__(self, asset, immutable=False):
+		self.asset = asset
+		self.immutable = immutable
+	
+	def locateChild(self, ctx, segments):
+		"""
+		@see: L{nevow.inevow.IResource}
+		"""
+		return None, ()
+	
+	def renderHTTP(self, ctx):
+		"""
+		Return the asset, or a 304 if the client's copy is current.
+		
+		@see: L{nevow.inevow.IResource}
+		"""
+		request = inevow.IRequest(ctx)
+		asset = self.asset
+		gzipped = asset.gzipped is not None and accepts_gzip(request.getHeader('accept-encoding'))
+		
+		if(gzipped):
+			request.setHeader('etag', asset.gzipped_etag)
+		else:
+			request.setHeader('etag', asset.etag)
+		request.setHeader('vary', 'Accept-Encoding')
+		if(self.immutable):
+			request.setHeader('cache-control', 'public, max-age=%d, immutable' % IMMUTABLE_MAX_AGE)
+		else:
+			request.setHeader('cache-control', 'public, max-age=%d' % MAX_AGE)
+		
+		if(matches(request.getHeader('if-none-match'), asset.etag)):
+			request.setResponseCode(http.NOT_MODIFIED)
+			return ''
+		
+		request.setHeader('content-type', asset.content_type)
+		if(gzipped):
+			request.setHeader('content-encoding', 'gzip')
+			body = asset.gzipped
+		else:
+			body = asset.body
+		request.setHeader('content-length', str(len(body)))
+		
+		if(request.method == 'HEAD'):
+			return ''
+		return body
+
+def matches(if_none_match, etag):
+	"""
+	Does the provided If-None-Match header match this ETag?
+	
+	Both the plain ETag and its gzipped form ('"<hash>-gz"') match;
+	either way, the client already has the current contents.
+	"""
+	if not(if_none_match):
+		return False
+	candidates = [candidate.strip() for candidate in if_none_match.split(',')]
+	gzipped_etag = etag[:-1] + '-gz"'
+	for tag in (etag, gzipped_etag):
+		if(tag in candidates or ('W/' + tag) in candidates):
+			return True
+	return '*' in candidates
+
+def accepts_gzip(accept_encoding):
+	"""
+	Does the provided Accept-Encoding header allow a gzipped response?
+	"""
+	if not(accept_encoding):
+		return False
+	for coding in accept_encoding.split(','):
+		params = coding.strip().split(';')
+		if(params[0].strip().lower() not in ('gzip', 'x-gzip')):
+			continue
+		for param in params[1:]:
+			name, sep, value = param.strip().partition('=')
+			if(name == 'q' and value.strip() in ('0', '0.0', '0.00', '0.000')):
+				return False
+		return True
+	return False